@@ -6,43 +6,13 @@ from flask_login import LoginManager
 from sqlalchemy.orm import DeclarativeBase
 from werkzeug.middleware.proxy_fix import ProxyFix
 
-# Configure logging
-logging.basicConfig(level=logging.DEBUG)
-
 class Base(DeclarativeBase):
     pass
 
 db = SQLAlchemy(model_class=Base)
 
-# Create the app
-app = Flask(__name__)
-app.secret_key = os.environ.get("SESSION_SECRET", "dev-secret-key-change-in-production")
-app.wsgi_app = ProxyFix(app.wsgi_app, x_proto=1, x_host=1)
-
-# Configure the database
-app.config["SQLALCHEMY_DATABASE_URI"] = os.environ.get("DATABASE_URL", "sqlite:///wavelet_fusion.db")
-app.config["SQLALCHEMY_ENGINE_OPTIONS"] = {
-    "pool_recycle": 300,
-    "pool_pre_ping": True,
-}
-app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
-
-# File upload configuration
-app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max file size
-app.config['UPLOAD_FOLDER'] = 'uploads'
-app.config['RESULT_FOLDER'] = 'results'
-app.config['ALLOWED_EXTENSIONS'] = {'png', 'jpg', 'jpeg', 'tiff', 'tif'}
-
-# Create upload and result directories
-os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
-os.makedirs(app.config['RESULT_FOLDER'], exist_ok=True)
-
-# Initialize the app with the extension
-db.init_app(app)
-
-# Initialize Flask-Login
+# Flask-Login, bound to each app by create_app
 login_manager = LoginManager()
-login_manager.init_app(app)
 login_manager.login_view = 'login'
 login_manager.login_message = 'Please log in to access this page.'
 login_manager.login_message_category = 'info'
@@ -52,8 +22,194 @@ def load_user(user_id):
     from models import User
     return User.query.get(int(user_id))
 
-with app.app_context():
-    # Import models to ensure tables are created
-    import models
-    db.create_all()
-    logging.info("Database tables created")
\ No newline at end of file
+def create_app(config=None):
+    """Create and configure the app
+
+    Builds the app, its extensions and routes without touching the
+    database, the filesystem or the imaging libraries; call init_db once
+    to create the folders and schema, and preload_imaging in a pre-fork
+    master to share numpy, OpenCV and PyWavelets with its workers.
+    config overrides the defaults below.
+    """
+    app = Flask(__name__)
+    app.secret_key = os.environ.get("SESSION_SECRET", "dev-secret-key-change-in-production")
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_proto=1, x_host=1)
+
+    # Configure the database
+    app.config["SQLALCHEMY_DATABASE_URI"] = os.environ.get("DATABASE_URL", "sqlite:///wavelet_fusion.db")
+    app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+    app.config['SQLITE_BUSY_TIMEOUT'] = float(os.environ.get("SQLITE_BUSY_TIMEOUT", 15))
+    app.config['DB_POOL_SIZE'] = int(os.environ.get("DB_POOL_SIZE", 10))
+    app.config['DB_MAX_OVERFLOW'] = int(os.environ.get("DB_MAX_OVERFLOW", 20))
+
+    # Sessions listed per dashboard page
+    app.config['DASHBOARD_PAGE_SIZE'] = int(os.environ.get("DASHBOARD_PAGE_SIZE", 20))
+
+    # File upload configuration
+    app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max file size
+    app.config['UPLOAD_FOLDER'] = 'uploads'
+    app.config['RESULT_FOLDER'] = 'results'
+    app.config['COEFFICIENT_FOLDER'] = 'coefficients'
+    app.config['ALLOWED_EXTENSIONS'] = {'png', 'jpg', 'jpeg', 'tiff', 'tif'}
+
+    # Chunked uploads: files may exceed MAX_CONTENT_LENGTH, each chunk may not
+    app.config['MAX_UPLOAD_FILE_SIZE'] = int(os.environ.get("MAX_UPLOAD_FILE_SIZE", 1024 * 1024 * 1024))
+    app.config['UPLOAD_EXPIRY_SECONDS'] = int(os.environ.get("UPLOAD_EXPIRY_SECONDS", 24 * 60 * 60))
+
+    # Tiled (out-of-core) fusion for very large inputs
+    app.config['TILED_FUSION_MIN_PIXELS'] = int(os.environ.get("TILED_FUSION_MIN_PIXELS", 64 * 1024 * 1024))
+    app.config['FUSION_TILE_SIZE'] = int(os.environ.get("FUSION_TILE_SIZE", 1024))
+
+    # Precompute wavelet coefficients in the background as images are uploaded
+    app.config['PRECOMPUTE_COEFFICIENTS'] = os.environ.get("PRECOMPUTE_COEFFICIENTS", "1") == "1"
+    app.config['INGEST_WORKERS'] = int(os.environ.get("INGEST_WORKERS", 2))
+
+    # Result encoder (png, webp or tiff, all lossless) and PNG zlib level;
+    # thumbnail and display renditions are written as JPEG next to each result
+    app.config['RESULT_FORMAT'] = os.environ.get("RESULT_FORMAT", "png")
+    app.config['PNG_COMPRESS_LEVEL'] = int(os.environ.get("PNG_COMPRESS_LEVEL", 1))
+
+    # Content-addressed result cache; unreferenced results are evicted LRU
+    app.config['RESULT_CACHE_MAX_BYTES'] = int(os.environ.get("RESULT_CACHE_MAX_BYTES", 1024 * 1024 * 1024))
+
+    # Render a low-resolution preview of each fusion before the full result
+    app.config['FUSION_PREVIEWS'] = os.environ.get("FUSION_PREVIEWS", "1") == "1"
+    app.config['PREVIEW_MAX_SIDE'] = int(os.environ.get("PREVIEW_MAX_SIDE", 512))
+    app.config['PREVIEW_WORKERS'] = int(os.environ.get("PREVIEW_WORKERS", 2))
+
+    # Fold each upload into a running fusion kept on disk per session, so
+    # the preview is current as soon as the uploads finish
+    app.config['INCREMENTAL_FUSION'] = os.environ.get("INCREMENTAL_FUSION", "1") == "1"
+    app.config['INCREMENTAL_WORKERS'] = int(os.environ.get("INCREMENTAL_WORKERS", 1))
+
+    # Background fusion jobs
+    app.config['FUSION_WORKERS'] = int(os.environ.get("FUSION_WORKERS", os.cpu_count() or 1))
+
+    # Fusion jobs running at once in all processes sharing the database
+    # together (0 = FUSION_WORKERS), so several web workers do not each run
+    # FUSION_WORKERS jobs
+    app.config['FUSION_MAX_RUNNING_JOBS'] = int(os.environ.get("FUSION_MAX_RUNNING_JOBS", 0))
+    app.config['JOB_LEASE_SECONDS'] = int(os.environ.get("JOB_LEASE_SECONDS", 300))
+
+    # Estimated working memory, in bytes, that running fusion jobs may hold
+    # together (0 = half of physical memory). Larger jobs wait their turn,
+    # are tiled, or are refused if they cannot fit at all.
+    app.config['FUSION_MEMORY_BUDGET'] = int(os.environ.get("FUSION_MEMORY_BUDGET", 0))
+
+    # Split each fusion job into stripes fused on this many processes of its
+    # own (1 = off); up to FUSION_WORKERS * FUSION_STRIPE_WORKERS processes busy
+    app.config['FUSION_STRIPE_WORKERS'] = int(os.environ.get("FUSION_STRIPE_WORKERS", 1))
+
+    # Measure the quality of every result (entropy, spatial frequency,
+    # average gradient, mutual information, SSIM), overlapping the encode
+    app.config['QUALITY_METRICS'] = os.environ.get("QUALITY_METRICS", "1") == "1"
+
+    # Storage lifecycle: bytes each user may store (0 = unlimited), how long
+    # idle pending and failed sessions are kept, after how long completed
+    # sessions drop their coefficients and fusion state, and how often the
+    # background sweep runs (0 = never; deletions are still batched)
+    app.config['USER_STORAGE_QUOTA'] = int(os.environ.get("USER_STORAGE_QUOTA", 0))
+    app.config['PENDING_SESSION_TTL'] = int(os.environ.get("PENDING_SESSION_TTL", 7 * 24 * 60 * 60))
+    app.config['FAILED_SESSION_TTL'] = int(os.environ.get("FAILED_SESSION_TTL", 7 * 24 * 60 * 60))
+    app.config['DERIVED_DATA_TTL'] = int(os.environ.get("DERIVED_DATA_TTL", 24 * 60 * 60))
+    app.config['STORAGE_SWEEP_INTERVAL'] = int(os.environ.get("STORAGE_SWEEP_INTERVAL", 600))
+    app.config['ORPHAN_GRACE_SECONDS'] = int(os.environ.get("ORPHAN_GRACE_SECONDS", 60 * 60))
+
+    if config:
+        app.config.update(config)
+
+    # Engine options and SQLite pragmas come from database.py
+    import database
+    database.init_app(app)
+    db.init_app(app)
+    login_manager.init_app(app)
+
+    # Request latency and fusion metrics, served at /metrics
+    import metrics
+    metrics.init_app(app)
+
+    # Initialize the background fusion job dispatcher
+    import jobs
+    jobs.init_app(app)
+
+    # Initialize background coefficient precomputation for uploads
+    import ingest
+    ingest.init_app(app)
+
+    # Initialize quick fusion previews
+    import previews
+    previews.init_app(app)
+
+    # Initialize incremental fusion of uploads
+    import incremental
+    incremental.init_app(app)
+
+    # Initialize background file deletion and storage sweeps
+    import storage
+    storage.init_app(app)
+
+    import routes
+    routes.init_app(app)
+
+    @app.cli.command('init-db')
+    def init_db_command():
+        """Create the storage folders and database tables"""
+        init_db(app)
+
+    return app
+
+def upgrade_schema():
+    """Add columns and indexes introduced after a table was first created
+
+    db.create_all() only creates missing tables, so new (nullable) columns
+    on existing tables are added here with ALTER TABLE, and new indexes
+    are created.
+    """
+    inspector = db.inspect(db.engine)
+    existing_tables = inspector.get_table_names()
+    quote = db.engine.dialect.identifier_preparer.quote
+    
+    for table in db.metadata.sorted_tables:
+        if table.name not in existing_tables:
+            continue
+        existing_columns = {column['name'] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name in existing_columns:
+                continue
+            column_type = column.type.compile(dialect=db.engine.dialect)
+            with db.engine.begin() as connection:
+                connection.execute(db.text(
+                    f"ALTER TABLE {quote(table.name)} ADD COLUMN {quote(column.name)} {column_type}"))
+            logging.info(f"Added column {table.name}.{column.name}")
+        
+        existing_indexes = {index['name'] for index in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name not in existing_indexes:
+                index.create(bind=db.engine)
+                logging.info(f"Created index {index.name}")
+
+def init_db(app):
+    """Create the storage folders and the database schema
+
+    Safe to run on every start: only missing folders, tables, columns and
+    indexes are created.
+    """
+    for folder in ('UPLOAD_FOLDER', 'RESULT_FOLDER', 'COEFFICIENT_FOLDER'):
+        os.makedirs(app.config[folder], exist_ok=True)
+
+    with app.app_context():
+        # Import models to ensure tables are created
+        import models
+        db.create_all()
+        upgrade_schema()
+    logging.info("Database tables created")
+
+def preload_imaging():
+    """Import the imaging stack (numpy, OpenCV, PyWavelets, PIL)
+
+    Web workers otherwise load it on the first request that renders a
+    preview or encodes a rendition. Calling this in a pre-fork master
+    loads it once and shares it with every worker copy-on-write.
+    """
+    import fusion
+    import tiled_fusion
@@ -0,0 +1,228 @@
+"""Fuse many image sets offline, across all cores
+
+Image sets come from a directory of directories (one set per
+sub-directory) or from a manifest. A manifest is a JSON list, or a JSON
+Lines file, of objects like
+
+    {"name": "scene_01", "images": ["a.jpg", "b.jpg"], "output": "out/scene_01.png"}
+
+where "output" is optional and relative image and output paths are
+resolved against the manifest's directory. The output's extension picks
+the result format (.png, .webp or .tif); sets without an output are
+written to --output-dir in --format. Sets whose output already exists
+are skipped, so an interrupted run can simply be started again.
+
+    python batch_fusion.py --input-root sets/ --output-dir fused/ --workers 8
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import logging
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from fusion import (process_fusion, estimate_fusion_memory, read_image_size, SUPPORTED_WAVELETS, MAX_LEVELS,
+                    FUSION_DTYPES, DEFAULT_WAVELET, DEFAULT_LEVELS, DEFAULT_PRECISION)
+from fusion_settings import default_memory_budget
+from encoders import RESULT_FORMATS, DEFAULT_RESULT_FORMAT, result_extension, result_format_of
+from fusion_rules import RULES, DEFAULT_RULE
+
+IMAGE_EXTENSIONS = {'png', 'jpg', 'jpeg', 'tiff', 'tif'}
+
+def is_image_file(filename):
+    return '.' in filename and filename.rsplit('.', 1)[1].lower() in IMAGE_EXTENSIONS
+
+def sets_from_directory(input_root, output_dir, result_format=DEFAULT_RESULT_FORMAT):
+    """One set per sub-directory holding at least two images"""
+    image_sets = []
+    for name in sorted(os.listdir(input_root)):
+        directory = os.path.join(input_root, name)
+        if not os.path.isdir(directory):
+            continue
+        images = [os.path.join(directory, f) for f in sorted(os.listdir(directory)) if is_image_file(f)]
+        output = os.path.join(output_dir, f"{name}.{result_extension(result_format)}")
+        image_sets.append({'name': name, 'images': images, 'output': output, 'format': result_format})
+    return image_sets
+
+def sets_from_manifest(manifest_path, output_dir, result_format=DEFAULT_RESULT_FORMAT):
+    """Read image sets from a JSON or JSON Lines manifest
+
+    A set's format follows its output's extension, and is None when that
+    is not a result format.
+    """
+    base = os.path.dirname(os.path.abspath(manifest_path))
+    with open(manifest_path) as f:
+        text = f.read()
+    try:
+        entries = json.loads(text)
+    except json.JSONDecodeError:
+        entries = [json.loads(line) for line in text.splitlines() if line.strip()]
+    if isinstance(entries, dict):
+        entries = [entries]
+
+    image_sets = []
+    for i, entry in enumerate(entries):
+        name = entry.get('name') or f"set_{i:06d}"
+        images = [os.path.join(base, path) for path in entry['images']]
+        if entry.get('output'):
+            output = os.path.join(base, entry['output'])
+            set_format = result_format_of(output)
+        else:
+            output = os.path.join(output_dir, f"{name}.{result_extension(result_format)}")
+            set_format = result_format
+        image_sets.append({'name': name, 'images': images, 'output': output, 'format': set_format})
+    return image_sets
+
+def fuse_set(name, image_paths, output_path, options, measure_quality=False):
+    """Fuse one set in a worker process; returns (name, success, seconds, quality)
+
+    quality holds the result's quality metrics when measure_quality is set.
+    """
+    start = time.perf_counter()
+    quality = {} if measure_quality else None
+
+    # Write under a temporary name so a killed run never leaves a file that
+    # looks finished
+    os.makedirs(os.path.dirname(os.path.abspath(output_path)), exist_ok=True)
+    partial_path = output_path + '.partial'
+    success = process_fusion(image_paths, partial_path, quality=quality, **options)
+    if success:
+        os.replace(partial_path, output_path)
+    elif os.path.exists(partial_path):
+        os.remove(partial_path)
+
+    return name, success, time.perf_counter() - start, quality
+
+def format_quality(quality):
+    short_names = {'entropy': 'EN', 'spatial_frequency': 'SF', 'average_gradient': 'AG',
+                   'mutual_information': 'MI', 'ssim': 'SSIM'}
+    return ' '.join(f"{short_names.get(name, name)} {value:.4f}" for name, value in quality.items())
+
+def run_batch(image_sets, workers, memory_budget, options, tile_size=None, measure_quality=False):
+    """Fuse image sets on a process pool and print per-set timings
+
+    A set is only started while the estimated peak memory of everything
+    running stays within memory_budget, so several large sets never run
+    at once. A set over budget on its own still runs, but alone. With
+    measure_quality each set's quality metrics are printed too. Sets that
+    cannot be fused (fewer than two images, or an output that is not a
+    result format) count as failed.
+    """
+    todo = deque()
+    skipped = failed = 0
+    for image_set in image_sets:
+        if os.path.exists(image_set['output']):
+            skipped += 1
+        elif len(image_set['images']) < 2:
+            failed += 1
+            print(f"FAIL  {image_set['name']}: need at least 2 images", flush=True)
+        elif image_set.get('format', DEFAULT_RESULT_FORMAT) is None:
+            failed += 1
+            formats = ', '.join(f".{extension}" for _, extension, _ in RESULT_FORMATS.values())
+            print(f"FAIL  {image_set['name']}: output must end in {formats}", flush=True)
+        else:
+            todo.append(image_set)
+
+    completed = 0
+    megapixels = 0.0
+    running = {}
+    in_use = 0
+    start = time.perf_counter()
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        while todo or running:
+            while todo and len(running) < workers:
+                image_set = todo[0]
+                try:
+                    estimate = estimate_fusion_memory(image_set['images'], options['precision'], tile_size,
+                                                      options['wavelet'], options['levels'], options['color'],
+                                                      options['rule'], measure_quality)
+                except Exception as e:
+                    todo.popleft()
+                    failed += 1
+                    print(f"FAIL  {image_set['name']}: cannot read images ({e})", flush=True)
+                    continue
+                if memory_budget and running and in_use + estimate > memory_budget:
+                    break
+
+                todo.popleft()
+                set_options = dict(options, tile_size=tile_size,
+                                   result_format=image_set.get('format', DEFAULT_RESULT_FORMAT))
+                future = executor.submit(fuse_set, image_set['name'], image_set['images'], image_set['output'],
+                                         set_options, measure_quality)
+                running[future] = (image_set, estimate)
+                in_use += estimate
+
+            if not running:
+                continue
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                image_set, estimate = running.pop(future)
+                in_use -= estimate
+                try:
+                    name, success, seconds, quality = future.result()
+                except Exception as e:
+                    name, success, seconds, quality = image_set['name'], False, 0.0, None
+                    logging.error(f"Worker failed on {name}: {str(e)}")
+
+                if success:
+                    completed += 1
+                    set_megapixels = sum(h * w for h, w in map(read_image_size, image_set['images'])) / 1e6
+                    megapixels += set_megapixels
+                    line = f"OK    {name}: {seconds:.2f}s, {set_megapixels:.1f} MP"
+                    if quality:
+                        line += f", {format_quality(quality)}"
+                    print(line, flush=True)
+                else:
+                    failed += 1
+                    print(f"FAIL  {name}", flush=True)
+
+    elapsed = time.perf_counter() - start
+    print(f"\n{completed} fused, {skipped} skipped, {failed} failed in {elapsed:.1f}s")
+    if completed and elapsed > 0:
+        print(f"Throughput: {completed / elapsed:.2f} sets/s, {megapixels / elapsed:.1f} MP/s")
+
+    return failed == 0
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('--input-root', help='directory with one sub-directory per image set')
+    source.add_argument('--manifest', help='JSON or JSON Lines manifest of image sets')
+    parser.add_argument('--output-dir', default='batch_results', help='where fused results are written')
+    parser.add_argument('--format', default=DEFAULT_RESULT_FORMAT, choices=list(RESULT_FORMATS),
+                        help='result format of sets without a manifest output')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--memory-budget-mb', type=int,
+                        help='estimated memory all running sets may use (default: half of RAM)')
+    parser.add_argument('--wavelet', default=DEFAULT_WAVELET, choices=SUPPORTED_WAVELETS)
+    parser.add_argument('--levels', type=int, default=DEFAULT_LEVELS, choices=range(1, MAX_LEVELS + 1))
+    parser.add_argument('--precision', default=DEFAULT_PRECISION, choices=list(FUSION_DTYPES))
+    parser.add_argument('--tile-size', type=int, help='fuse out of core with this tile size')
+    parser.add_argument('--color', action='store_true', help='fuse in color (YCbCr) instead of gray')
+    parser.add_argument('--rule', default=DEFAULT_RULE, choices=list(RULES),
+                        help='detail coefficient rule (see fusion_rules)')
+    parser.add_argument('--quality', action='store_true',
+                        help='print quality metrics of every result (not measured for tiled fusion)')
+    args = parser.parse_args(argv)
+    if args.color and args.tile_size:
+        parser.error('--color does not apply to tiled fusion')
+
+    logging.basicConfig(level=logging.WARNING)
+
+    if args.input_root:
+        image_sets = sets_from_directory(args.input_root, args.output_dir, args.format)
+    else:
+        image_sets = sets_from_manifest(args.manifest, args.output_dir, args.format)
+
+    memory_budget = args.memory_budget_mb * 1024 * 1024 if args.memory_budget_mb else default_memory_budget()
+    options = {'wavelet': args.wavelet, 'levels': args.levels, 'precision': args.precision, 'color': args.color,
+               'rule': args.rule}
+
+    ok = run_batch(image_sets, max(1, args.workers), memory_budget, options, args.tile_size, args.quality)
+    return 0 if ok else 1
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,94 @@
+"""Compare color (YCbCr) fusion with gray fusion
+
+Writes synthetic color JPEGs and fuses them with process_fusion twice, once
+gray and once with color=True, reporting the time of each stage and the
+ratio of the totals. Color fusion transforms only the luma plane and
+decodes and blends chroma at half resolution, so it should stay within
+1.3x the gray time rather than the 3x of fusing every channel. The fusion step alone (nway_dwt_fusion against
+color_dwt_fusion on decoded arrays) is reported too.
+
+    python benchmarks/bench_color.py --size 2048 1536 --images 5 --levels 2
+"""
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fusion import (process_fusion, nway_dwt_fusion, color_dwt_fusion, load_gray_images, load_color_images,
+                    target_size, FUSION_DTYPES)
+from profiling import StageTimer
+from bench_decode import write_images
+
+def best_of(repeat, run):
+    """Best wall time of run() over repeat calls, after one warm-up"""
+    result = run()
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = run()
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+def end_to_end(paths, output, levels, precision, repeat):
+    """Best (seconds, stage timings) of gray and of color process_fusion
+
+    The gray and color runs alternate, so drift in machine load falls on
+    both sides of the ratio alike.
+    """
+    def run(color):
+        timer = StageTimer()
+        start = time.perf_counter()
+        if not process_fusion(paths, output, levels=levels, precision=precision, timer=timer, color=color):
+            raise RuntimeError('fusion failed')
+        return time.perf_counter() - start, timer.stages
+
+    best = {}
+    for attempt in range(repeat + 1):
+        for color in (False, True):
+            result = run(color)
+            # The first round warms up
+            if attempt and (color not in best or result[0] < best[color][0]):
+                best[color] = result
+    return best[False], best[True]
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--size', type=int, nargs=2, default=[2048, 1536], metavar=('WIDTH', 'HEIGHT'))
+    parser.add_argument('--images', type=int, default=5)
+    parser.add_argument('--levels', type=int, default=2)
+    parser.add_argument('--precision', default='float32', choices=list(FUSION_DTYPES))
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp(prefix='bench_color_')
+    try:
+        paths = write_images(directory, args.size[0], args.size[1], args.images, 'jpg')
+        size = target_size(paths)
+        print(f"{args.images} x {args.size[0]}x{args.size[1]} JPEG, {args.levels} levels, {args.precision}")
+
+        gray_images = load_gray_images(paths, size)
+        luma_images, chroma_images = load_color_images(paths, size)
+        gray_fuse, _ = best_of(args.repeat, lambda: nway_dwt_fusion(gray_images, 'db4', args.levels,
+                                                                    args.precision))
+        color_fuse, _ = best_of(args.repeat, lambda: color_dwt_fusion(luma_images, chroma_images, 'db4',
+                                                                      args.levels, args.precision))
+        print(f"fusion step: gray {gray_fuse:.3f}s  color {color_fuse:.3f}s  ratio {color_fuse / gray_fuse:.2f}")
+
+        output = os.path.join(directory, 'fused.png')
+        (gray_total, gray_stages), (color_total, color_stages) = end_to_end(paths, output, args.levels,
+                                                                            args.precision, args.repeat)
+
+        stages = list(dict.fromkeys(list(gray_stages) + list(color_stages)))
+        print(f"{'stage':>10} {'gray (s)':>9} {'color (s)':>9}")
+        for stage in stages:
+            print(f"{stage:>10} {gray_stages.get(stage, 0.0):>9.3f} {color_stages.get(stage, 0.0):>9.3f}")
+        print(f"{'total':>10} {gray_total:>9.3f} {color_total:>9.3f}  ratio {color_total / gray_total:.2f}")
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+if __name__ == '__main__':
+    main()
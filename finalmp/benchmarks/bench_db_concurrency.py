@@ -0,0 +1,173 @@
+"""Load-test SQLite under concurrent uploads, status writes and status polling
+
+Runs the statements the app issues most often, each in its own committed
+transaction as the routes do, from several processes with several
+threads each:
+
+    upload   reserve an image slot with a conditional UPDATE, INSERT the image
+    status   compare-and-set a session's status, as FusionSession.transition
+    poll     read a session's status and count its images, as /status does
+
+once with the engine settings the app used before database.py (rollback
+journal, synchronous=FULL, default pool and 5s lock timeout) and once with
+database.engine_options and its pragmas. Reports throughput, lock errors
+and write latency for each.
+
+    python benchmarks/bench_db_concurrency.py --processes 4 --threads 4 --seconds 10
+"""
+import os
+import sys
+import time
+import random
+import shutil
+import argparse
+import tempfile
+import threading
+import multiprocessing
+from sqlalchemy import create_engine, event, text
+from sqlalchemy.exc import OperationalError
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from database import engine_options, set_sqlite_pragmas
+
+SCHEMA = [
+    """CREATE TABLE fusion_session (id INTEGER PRIMARY KEY, status VARCHAR(50), num_images INTEGER,
+                                    image_slots INTEGER)""",
+    """CREATE TABLE uploaded_image (id INTEGER PRIMARY KEY, fusion_session_id INTEGER NOT NULL,
+                                    filename VARCHAR(200))""",
+    "CREATE INDEX ix_uploaded_image_fusion_session_id ON uploaded_image (fusion_session_id)",
+]
+
+STATUS_FLOW = {'pending': 'processing', 'processing': 'completed', 'completed': 'processing'}
+
+# Share of operations that are uploads and status changes; the rest poll
+MIX = (('upload', 0.35), ('status', 0.15), ('poll', 0.50))
+
+def make_engine(url, tuned):
+    if not tuned:
+        return create_engine(url, pool_recycle=300, pool_pre_ping=True)
+    engine = create_engine(url, **engine_options(url))
+    event.listen(engine, 'connect', set_sqlite_pragmas)
+    return engine
+
+def setup_database(url, sessions):
+    engine = create_engine(url)
+    with engine.begin() as connection:
+        for statement in SCHEMA:
+            connection.execute(text(statement))
+        connection.execute(text("INSERT INTO fusion_session (id, status, num_images, image_slots) "
+                                "VALUES (:id, 'pending', 1000000, 0)"),
+                           [{'id': i} for i in range(1, sessions + 1)])
+    engine.dispose()
+
+def upload(connection, session_id):
+    reserved = connection.execute(text(
+        "UPDATE fusion_session SET image_slots = image_slots + 1 "
+        "WHERE id = :id AND image_slots + 1 <= num_images"), {'id': session_id}).rowcount
+    if reserved:
+        connection.execute(text("INSERT INTO uploaded_image (fusion_session_id, filename) VALUES (:id, :name)"),
+                           {'id': session_id, 'name': f"{random.getrandbits(64):016x}.png"})
+
+def change_status(connection, session_id):
+    status = connection.execute(text("SELECT status FROM fusion_session WHERE id = :id"),
+                                {'id': session_id}).scalar()
+    connection.execute(text("UPDATE fusion_session SET status = :new WHERE id = :id AND status = :old"),
+                       {'id': session_id, 'old': status, 'new': STATUS_FLOW[status]})
+
+def poll(connection, session_id):
+    connection.execute(text("SELECT status FROM fusion_session WHERE id = :id"), {'id': session_id}).scalar()
+    connection.execute(text("SELECT count(id) FROM uploaded_image WHERE fusion_session_id = :id"),
+                       {'id': session_id}).scalar()
+
+OPERATIONS = {'upload': upload, 'status': change_status, 'poll': poll}
+
+def run_worker(url, tuned, threads, seconds, sessions, results):
+    """One server process: threads share an engine and run the mix"""
+    engine = make_engine(url, tuned)
+    names = [name for name, _ in MIX]
+    weights = [weight for _, weight in MIX]
+    counts = {name: 0 for name in names}
+    counts['errors'] = 0
+    latencies = []
+    lock = threading.Lock()
+    deadline = time.perf_counter() + seconds
+
+    def loop():
+        rng = random.Random()
+        local = {name: 0 for name in counts}
+        local_latencies = []
+        while time.perf_counter() < deadline:
+            name = rng.choices(names, weights)[0]
+            start = time.perf_counter()
+            try:
+                with engine.begin() as connection:
+                    OPERATIONS[name](connection, rng.randint(1, sessions))
+            except OperationalError:
+                local['errors'] += 1
+                continue
+            local[name] += 1
+            if name != 'poll':
+                local_latencies.append(time.perf_counter() - start)
+        with lock:
+            for key, value in local.items():
+                counts[key] += value
+            latencies.extend(local_latencies)
+
+    workers = [threading.Thread(target=loop) for _ in range(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    engine.dispose()
+    results.put((counts, latencies))
+
+def run(directory, tuned, processes, threads, seconds, sessions):
+    path = os.path.join(directory, f"{'tuned' if tuned else 'default'}.db")
+    url = f"sqlite:///{path}"
+    setup_database(url, sessions)
+
+    context = multiprocessing.get_context('spawn')
+    results = context.Queue()
+    workers = [context.Process(target=run_worker, args=(url, tuned, threads, seconds, sessions, results))
+               for _ in range(processes)]
+    for worker in workers:
+        worker.start()
+    totals = {}
+    latencies = []
+    for _ in workers:
+        counts, worker_latencies = results.get()
+        for key, value in counts.items():
+            totals[key] = totals.get(key, 0) + value
+        latencies.extend(worker_latencies)
+    for worker in workers:
+        worker.join()
+
+    latencies.sort()
+    p99 = latencies[int(len(latencies) * 0.99)] if latencies else float('nan')
+    writes = totals['upload'] + totals['status']
+    print(f"{'tuned' if tuned else 'default':>8} {(writes + totals['poll']) / seconds:>9.0f} "
+          f"{writes / seconds:>9.0f} {totals['poll'] / seconds:>9.0f} {totals['errors']:>7} {p99 * 1000:>12.1f}",
+          flush=True)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--processes', type=int, default=4)
+    parser.add_argument('--threads', type=int, default=4)
+    parser.add_argument('--seconds', type=float, default=10)
+    parser.add_argument('--sessions', type=int, default=200)
+    parser.add_argument('--dir', help='directory for the test databases (default: a temporary one)')
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp(prefix='bench_db_', dir=args.dir)
+    try:
+        print(f"{args.processes} processes x {args.threads} threads, {args.seconds:g}s each, "
+              f"{args.sessions} sessions")
+        print(f"{'settings':>8} {'ops/s':>9} {'writes/s':>9} {'reads/s':>9} {'errors':>7} {'p99 write ms':>12}")
+        for tuned in (False, True):
+            run(directory, tuned, args.processes, args.threads, args.seconds, args.sessions)
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,104 @@
+"""Compare the legacy RGB decode path with the direct grayscale decoder
+
+Writes synthetic JPEG and PNG files, then times decoding them to gray at a
+smaller target size three ways:
+
+    legacy    load_and_preprocess_image + resize_images_to_same_size
+    gray      load_gray_image, one file after another
+    parallel  load_gray_images on a thread pool
+
+Each method runs in a fresh process so its peak RSS can be reported.
+
+    python benchmarks/bench_decode.py --size 4000 3000 --images 6 --target 2000 1500
+"""
+import os
+import sys
+import time
+import shutil
+import argparse
+import resource
+import tempfile
+import multiprocessing
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from PIL import Image
+
+def write_images(directory, width, height, count, fmt):
+    rng = np.random.default_rng(0)
+    y, x = np.mgrid[0:height, 0:width]
+    paths = []
+    for i in range(count):
+        channels = [127 + 100 * np.sin((x * (i + c + 1) + y) / 97.0) for c in range(3)]
+        rgb = np.clip(np.dstack(channels) + rng.normal(0, 10, (height, width, 3)), 0, 255).astype(np.uint8)
+        path = os.path.join(directory, f"image_{i}.{fmt}")
+        if fmt == 'jpg':
+            Image.fromarray(rgb).save(path, quality=90)
+        else:
+            Image.fromarray(rgb).save(path)
+        paths.append(path)
+    return paths
+
+def peak_rss_kib():
+    """Peak resident set size of this process in KiB
+
+    Reads VmHWM on Linux, because ru_maxrss of a spawned child also counts
+    the parent it was forked from before exec.
+    """
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def run_method(method, paths, size):
+    """Decode with one method; return (seconds, peak RSS growth in MiB)"""
+    from fusion import load_and_preprocess_image, resize_images_to_same_size, load_gray_image, load_gray_images
+    import cv2
+
+    baseline = peak_rss_kib()
+    start = time.perf_counter()
+
+    if method == 'legacy':
+        decoded = [load_and_preprocess_image(path) for path in paths]
+        gray_images = resize_images_to_same_size([gray for gray, _ in decoded])
+        gray_images = [cv2.resize(img, (size[1], size[0])) for img in gray_images]
+    elif method == 'gray':
+        gray_images = [load_gray_image(path, size) for path in paths]
+    else:
+        gray_images = load_gray_images(paths, size)
+
+    seconds = time.perf_counter() - start
+    peak = peak_rss_kib()
+    assert all(img.shape == tuple(size) for img in gray_images)
+    return seconds, (peak - baseline) / 1024
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--size', type=int, nargs=2, default=[4000, 3000], metavar=('WIDTH', 'HEIGHT'))
+    parser.add_argument('--target', type=int, nargs=2, default=[2000, 1500], metavar=('WIDTH', 'HEIGHT'))
+    parser.add_argument('--images', type=int, default=6)
+    args = parser.parse_args()
+
+    size = (args.target[1], args.target[0])
+    context = multiprocessing.get_context('spawn')
+    directory = tempfile.mkdtemp(prefix='bench_decode_')
+    try:
+        print(f"{args.images} x {args.size[0]}x{args.size[1]} -> {args.target[0]}x{args.target[1]}")
+        print(f"{'format':>6} {'method':>9} {'total (s)':>10} {'per image (ms)':>15} {'peak MiB':>9}")
+        for fmt in ('jpg', 'png'):
+            paths = write_images(directory, args.size[0], args.size[1], args.images, fmt)
+            for method in ('legacy', 'gray', 'parallel'):
+                with context.Pool(1) as pool:
+                    seconds, peak = pool.apply(run_method, (method, paths, size))
+                per_image = seconds / args.images * 1000
+                print(f"{fmt:>6} {method:>9} {seconds:>10.3f} {per_image:>15.1f} {peak:>9.1f}")
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,65 @@
+"""Measure how stripe-parallel fusion scales with the number of workers
+
+Fuses synthetic images with nway_dwt_fusion on one core, then with
+parallel_multi_image_dwt_fusion on 1 to N worker processes, and reports
+time, speedup over the serial engine and parallel efficiency. Every
+parallel result is checked against the serial one.
+
+    python benchmarks/bench_parallel.py --size 4096 --images 5 --workers 1 2 4 8 16 32
+"""
+import os
+import sys
+import time
+import argparse
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fusion import nway_dwt_fusion, FUSION_DTYPES
+from parallel_fusion import parallel_multi_image_dwt_fusion
+from bench_precision import synthetic_images
+
+def best_time(func, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--size', type=int, default=4096)
+    parser.add_argument('--images', type=int, default=5)
+    parser.add_argument('--wavelet', default='db4')
+    parser.add_argument('--levels', type=int, default=1)
+    parser.add_argument('--precision', default='float64', choices=list(FUSION_DTYPES))
+    parser.add_argument('--workers', type=int, nargs='+',
+                        default=sorted({1, 2, 4, os.cpu_count() or 1}))
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    images = synthetic_images(args.size, args.images)
+    megapixels = args.size * args.size * args.images / 1e6
+
+    serial, expected = best_time(lambda: nway_dwt_fusion(images, args.wavelet, args.levels, args.precision),
+                                 args.repeat)
+
+    print(f"{args.images} x {args.size}x{args.size}, wavelet {args.wavelet}, {args.levels} levels, "
+          f"{args.precision}, {os.cpu_count()} CPUs")
+    print(f"{'workers':>7} {'time (s)':>9} {'MP/s':>8} {'speedup':>8} {'efficiency':>10} {'equal':>6}")
+    print(f"{'serial':>7} {serial:>9.3f} {megapixels / serial:>8.1f} {1:>8.2f} {'':>10} {'':>6}")
+
+    for workers in args.workers:
+        # Start the pool before timing, as a long-running worker would have
+        parallel_multi_image_dwt_fusion(images, args.wavelet, args.levels, args.precision, workers)
+        seconds, result = best_time(
+            lambda: parallel_multi_image_dwt_fusion(images, args.wavelet, args.levels, args.precision, workers),
+            args.repeat)
+        speedup = serial / seconds
+        equal = result is not None and np.array_equal(result, expected)
+        print(f"{workers:>7} {seconds:>9.3f} {megapixels / seconds:>8.1f} {speedup:>8.2f} "
+              f"{speedup / workers:>10.0%} {str(equal):>6}")
+
+if __name__ == '__main__':
+    main()
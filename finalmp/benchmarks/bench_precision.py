@@ -0,0 +1,72 @@
+"""Compare float64 and float32 fusion across decomposition levels
+
+Fuses synthetic images with nway_dwt_fusion and reports throughput
+(megapixels of input per second) and peak traced memory for every
+combination of precision and level.
+
+    python benchmarks/bench_precision.py --size 2048 --images 5 --levels 1 2 3 4
+"""
+import os
+import sys
+import time
+import argparse
+import tracemalloc
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fusion import nway_dwt_fusion, FUSION_DTYPES
+
+def synthetic_images(size, count, seed=0):
+    """Deterministic test images with smooth structure plus noise"""
+    rng = np.random.default_rng(seed)
+    y, x = np.mgrid[0:size, 0:size] / size
+    images = []
+    for i in range(count):
+        base = 127 + 100 * np.sin(2 * np.pi * (x * (i + 1) + y))
+        images.append(np.clip(base + rng.normal(0, 20, (size, size)), 0, 255).astype(np.uint8))
+    return images
+
+def measure(images, wavelet, levels, precision, repeat):
+    """Return (best seconds, peak bytes) for fusing images"""
+    nway_dwt_fusion(images, wavelet, levels, precision)
+
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        nway_dwt_fusion(images, wavelet, levels, precision)
+        best = min(best, time.perf_counter() - start)
+
+    tracemalloc.start()
+    nway_dwt_fusion(images, wavelet, levels, precision)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return best, peak
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--size', type=int, default=2048)
+    parser.add_argument('--images', type=int, default=5)
+    parser.add_argument('--wavelet', default='db4')
+    parser.add_argument('--levels', type=int, nargs='+', default=[1, 2, 3, 4])
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    images = synthetic_images(args.size, args.images)
+    megapixels = args.size * args.size * args.images / 1e6
+
+    print(f"{args.images} x {args.size}x{args.size}, wavelet {args.wavelet}")
+    print(f"{'levels':>6} {'precision':>9} {'time (s)':>9} {'MP/s':>8} {'peak MiB':>9}")
+    for levels in args.levels:
+        results = {}
+        for precision in FUSION_DTYPES:
+            seconds, peak = measure(images, args.wavelet, levels, precision, args.repeat)
+            results[precision] = (seconds, peak)
+            print(f"{levels:>6} {precision:>9} {seconds:>9.3f} {megapixels / seconds:>8.1f} {peak / 2**20:>9.1f}")
+
+        (t64, m64), (t32, m32) = results['float64'], results['float32']
+        print(f"{'':>6} {'f32/f64':>9} {t32 / t64:>9.2f} {'':>8} {m32 / m64:>9.2f}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,72 @@
+"""Compare the time to a fusion preview with the time to the full result
+
+Writes synthetic images as JPEG and PNG, then times process_fusion against
+process_preview from a reduced-size decode and from precomputed
+coefficients (the path used once uploads have been ingested).
+
+    python benchmarks/bench_preview.py --size 4000 --images 3
+"""
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+import numpy as np
+from PIL import Image
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fusion import process_fusion, process_preview, dwt_coefficients, PREVIEW_MAX_SIDE
+from bench_precision import synthetic_images
+
+def best_time(func, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--size', type=int, default=3000)
+    parser.add_argument('--images', type=int, default=3)
+    parser.add_argument('--wavelet', default='db4')
+    parser.add_argument('--levels', type=int, default=1)
+    parser.add_argument('--max-side', type=int, default=PREVIEW_MAX_SIDE)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    images = synthetic_images(args.size, args.images)
+    directory = tempfile.mkdtemp(prefix='bench_preview_')
+    try:
+        coefficients = []
+        for i, image in enumerate(images):
+            path = os.path.join(directory, f"coefficients_{i}.npy")
+            np.save(path, dwt_coefficients(image, args.wavelet, args.levels))
+            coefficients.append(path)
+
+        print(f"{args.images} x {args.size}x{args.size}, wavelet {args.wavelet}, {args.levels} levels, "
+              f"preview {args.max_side}px")
+        print(f"{'input':>6} {'full (s)':>9} {'decode preview (ms)':>20} {'coefficient preview (ms)':>25}")
+        for extension, image_format in (('jpg', 'JPEG'), ('png', 'PNG')):
+            paths = []
+            for i, image in enumerate(images):
+                path = os.path.join(directory, f"input_{i}.{extension}")
+                Image.fromarray(image).save(path, image_format)
+                paths.append(path)
+
+            output = os.path.join(directory, 'output.png')
+            preview = os.path.join(directory, 'preview.jpg')
+            full = best_time(lambda: process_fusion(paths, output, wavelet=args.wavelet, levels=args.levels), 1)
+            decoded = best_time(lambda: process_preview(paths, preview, None, args.wavelet, args.levels,
+                                                        args.max_side), args.repeat)
+            stored = best_time(lambda: process_preview(paths, preview, coefficients, args.wavelet, args.levels,
+                                                       args.max_side), args.repeat)
+            print(f"{image_format:>6} {full:>9.3f} {decoded * 1000:>20.1f} {stored * 1000:>25.1f}")
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+if __name__ == '__main__':
+    main()
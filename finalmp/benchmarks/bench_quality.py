@@ -0,0 +1,89 @@
+"""Time the quality metrics against the fusion they measure
+
+Fuses synthetic images with nway_dwt_fusion and times quality.fusion_quality
+on the result, with and without the reference metrics. For comparison it
+also times a straightforward NumPy version of the same metrics, which
+builds histograms with np.histogram2d and redoes the fused image's SSIM
+statistics for every source in float64.
+
+    python benchmarks/bench_quality.py --size 2048 --images 10
+"""
+import os
+import sys
+import time
+import argparse
+import numpy as np
+import cv2
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fusion import nway_dwt_fusion
+from quality import fusion_quality, SSIM_WINDOW, SSIM_SIGMA, SSIM_C1, SSIM_C2
+from bench_precision import synthetic_images
+
+def best_time(run, repeat):
+    """Best wall time of run() over repeat calls, and its last result"""
+    best, result = float('inf'), None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = run()
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+def naive_quality(fused, sources):
+    """The same metrics written directly, for comparison"""
+    def entropy(p):
+        p = p[p > 0] / p.sum()
+        return -(p * np.log2(p)).sum()
+
+    def blur(image):
+        return cv2.GaussianBlur(image, (SSIM_WINDOW, SSIM_WINDOW), SSIM_SIGMA, borderType=cv2.BORDER_REFLECT)
+
+    f = fused.astype(np.float64)
+    dx, dy = np.diff(f, axis=1), np.diff(f, axis=0)
+    metrics = {
+        'entropy': entropy(np.histogram(fused, bins=256, range=(0, 256))[0]),
+        'spatial_frequency': np.sqrt(np.mean(dx ** 2) + np.mean(dy ** 2)),
+        'average_gradient': np.mean(np.sqrt((dx[:-1] ** 2 + dy[:, :-1] ** 2) / 2)),
+        'mutual_information': 0.0,
+        'ssim': 0.0
+    }
+    for source in sources:
+        joint = np.histogram2d(source.ravel(), fused.ravel(), bins=256, range=[[0, 256], [0, 256]])[0]
+        metrics['mutual_information'] += entropy(joint.sum(1)) + entropy(joint.sum(0)) - entropy(joint)
+        s = source.astype(np.float64)
+        mu_s, mu_f = blur(s), blur(f)
+        var_s, var_f = blur(s * s) - mu_s ** 2, blur(f * f) - mu_f ** 2
+        cov = blur(s * f) - mu_s * mu_f
+        ssim_map = ((2 * mu_s * mu_f + SSIM_C1) * (2 * cov + SSIM_C2)
+                    / ((mu_s ** 2 + mu_f ** 2 + SSIM_C1) * (var_s + var_f + SSIM_C2)))
+        metrics['ssim'] += ssim_map.mean() / len(sources)
+    return metrics
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--size', type=int, default=2048, help='side of the square test images')
+    parser.add_argument('--images', type=int, default=10)
+    parser.add_argument('--levels', type=int, default=2)
+    parser.add_argument('--precision', default='float32')
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    images = synthetic_images(args.size, args.images)
+    print(f"{args.images} x {args.size}x{args.size}, {args.levels} levels, {args.precision}")
+
+    fusion_seconds, fused = best_time(lambda: nway_dwt_fusion(images, 'db4', args.levels, args.precision),
+                                      args.repeat)
+    no_reference, _ = best_time(lambda: fusion_quality(fused), args.repeat)
+    full, quality = best_time(lambda: fusion_quality(fused, images), args.repeat)
+    naive, naive_metrics = best_time(lambda: naive_quality(fused, images), 1)
+
+    print(f"{'fusion':>24} {fusion_seconds:>8.3f}s")
+    print(f"{'no-reference metrics':>24} {no_reference:>8.3f}s  {no_reference / fusion_seconds:>5.2f}x fusion")
+    print(f"{'all metrics':>24} {full:>8.3f}s  {full / fusion_seconds:>5.2f}x fusion")
+    print(f"{'straightforward NumPy':>24} {naive:>8.3f}s  {naive / fusion_seconds:>5.2f}x fusion")
+    for name, value in quality.items():
+        print(f"{name:>24} {value:>10.4f}  (straightforward {naive_metrics[name]:.4f})")
+
+if __name__ == '__main__':
+    main()
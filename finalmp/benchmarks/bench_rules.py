@@ -0,0 +1,73 @@
+"""Measure the throughput of every registered fusion rule
+
+Decomposes synthetic images once and times fuse_packed_coefficients with
+each rule in fusion_rules.RULES, then the whole nway_dwt_fusion, reporting
+megapixels of input per second. A window sweep times the windowed rules
+on one detail band at growing window sizes; the box filters sum their
+windows by doubling, so the time should grow with the logarithm of the
+window.
+
+    python benchmarks/bench_rules.py --size 2048 --images 5 --levels 2
+"""
+import os
+import sys
+import time
+import argparse
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fusion import (nway_dwt_fusion, dwt_coefficients, coefficient_shapes, fuse_packed_coefficients,
+                    FUSION_DTYPES)
+from fusion_rules import RULES
+from bench_precision import synthetic_images
+
+WINDOWS = [3, 7, 15, 31]
+
+def best_time(run, repeat):
+    """Best wall time of run() over repeat calls, after one warm-up"""
+    run()
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        run()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--size', type=int, default=2048, help='side of the square test images')
+    parser.add_argument('--images', type=int, default=5)
+    parser.add_argument('--levels', type=int, default=2)
+    parser.add_argument('--precision', default='float32', choices=list(FUSION_DTYPES))
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    images = synthetic_images(args.size, args.images)
+    shape = images[0].shape
+    megapixels = args.images * shape[0] * shape[1] / 1e6
+    packed_stack = np.stack([dwt_coefficients(image, 'db4', args.levels, args.precision) for image in images])
+    shapes = coefficient_shapes(shape, 'db4', args.levels)
+    print(f"{args.images} x {shape[1]}x{shape[0]}, {args.levels} levels, {args.precision}")
+
+    print(f"{'rule':>17} {'rules (s)':>10} {'MP/s':>8} {'fusion (s)':>11} {'MP/s':>8}")
+    for name in RULES:
+        rules = best_time(lambda: fuse_packed_coefficients(packed_stack, shapes, name), args.repeat)
+        total = best_time(lambda: nway_dwt_fusion(images, 'db4', args.levels, args.precision, rule=name),
+                          args.repeat)
+        print(f"{name:>17} {rules:>10.3f} {megapixels / rules:>8.1f} {total:>11.3f} {megapixels / total:>8.1f}")
+
+    # The finest horizontal detail band, the largest one
+    offset = shapes[0][0] * shapes[0][1]
+    band_shape = shapes[-1]
+    bands = np.ascontiguousarray(packed_stack[:, offset:offset + band_shape[0] * band_shape[1]])
+    bands = bands.reshape((-1,) + band_shape)
+    windowed = [rule for rule in RULES.values() if rule.windowed]
+    print(f"\nwindow sweep on one {band_shape[1]}x{band_shape[0]} band (s)")
+    print(f"{'rule':>17} " + ' '.join(f"{window:>7}" for window in WINDOWS))
+    for rule in windowed:
+        times = [best_time(lambda: rule.fuse(bands, window), args.repeat) for window in WINDOWS]
+        print(f"{rule.name:>17} " + ' '.join(f"{seconds:>7.4f}" for seconds in times))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,112 @@
+"""Measure web worker cold start: process start to first response served
+
+Times three ways of bringing up a worker, each against a database whose
+schema already exists:
+
+    lazy      a fresh interpreter runs create_app; numpy, OpenCV and
+              PyWavelets stay unloaded until a request needs them
+    eager     as lazy, but the worker imports the imaging stack itself,
+              which is what every worker paid when routes imported fusion
+    forked    a master runs create_app, init_db and preload_imaging once
+              and forks the worker, as gunicorn.conf.py sets up
+
+and the one-off cost of init_db, which no longer runs on import.
+
+    python benchmarks/bench_startup.py --runs 7
+"""
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+import statistics
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+WORKER = r'''
+import sys, time
+sys.path.insert(0, {root!r})
+from app import create_app, preload_imaging
+app = create_app({config!r})
+if {eager!r}:
+    preload_imaging()
+response = app.test_client().get('/login')
+assert response.status_code == 200, response.status_code
+print(int('cv2' in sys.modules), flush=True)
+'''
+
+def app_config(directory):
+    return {
+        'SQLALCHEMY_DATABASE_URI': f"sqlite:///{os.path.join(directory, 'startup.db')}",
+        'UPLOAD_FOLDER': os.path.join(directory, 'uploads'),
+        'RESULT_FOLDER': os.path.join(directory, 'results'),
+        'COEFFICIENT_FOLDER': os.path.join(directory, 'coefficients'),
+    }
+
+def spawn_worker(config, eager):
+    """Seconds from starting a fresh interpreter to its first response"""
+    code = WORKER.format(root=ROOT, config=config, eager=eager)
+    start = time.perf_counter()
+    output = subprocess.run([sys.executable, '-c', code], check=True, capture_output=True, text=True).stdout
+    return time.perf_counter() - start, output.strip() == '1'
+
+def fork_worker(app):
+    """Seconds from forking a preloaded master to the child's first response"""
+    read_end, write_end = os.pipe()
+    start = time.perf_counter()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read_end)
+        from app import db
+        with app.app_context():
+            db.engine.dispose(close=False)
+        status = app.test_client().get('/login').status_code
+        os.write(write_end, str(status).encode())
+        os._exit(0)
+    os.close(write_end)
+    status = os.read(read_end, 16)
+    elapsed = time.perf_counter() - start
+    os.close(read_end)
+    os.waitpid(pid, 0)
+    assert status == b'200', status
+    return elapsed
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--runs', type=int, default=7)
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp(prefix='bench_startup_')
+    try:
+        config = app_config(directory)
+        from app import create_app, init_db, preload_imaging
+
+        master = create_app(config)
+        start = time.perf_counter()
+        init_db(master)
+        schema = time.perf_counter() - start
+        start = time.perf_counter()
+        preload_imaging()
+        imaging = time.perf_counter() - start
+
+        print(f"init_db {schema * 1000:.0f} ms once, preload_imaging {imaging * 1000:.0f} ms once")
+        print(f"{'worker':>8} {'median ms':>10} {'min ms':>8} {'imaging loaded':>15}")
+        results = {}
+        for mode in ('lazy', 'eager', 'forked'):
+            if mode == 'forked':
+                times, loaded = [fork_worker(master) for _ in range(args.runs)], True
+            else:
+                runs = [spawn_worker(config, mode == 'eager') for _ in range(args.runs)]
+                times, loaded = [seconds for seconds, _ in runs], runs[-1][1]
+            results[mode] = statistics.median(times)
+            print(f"{mode:>8} {results[mode] * 1000:>10.0f} {min(times) * 1000:>8.0f} {str(loaded):>15}")
+        print(f"speedup over eager: lazy {results['eager'] / results['lazy']:.1f}x, "
+              f"forked {results['eager'] / results['forked']:.1f}x")
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+if __name__ == '__main__':
+    main()
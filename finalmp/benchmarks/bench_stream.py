@@ -0,0 +1,80 @@
+"""Measure stream fusion throughput and memory against the frame count
+
+Writes a synthetic video, fuses its first N frames for several N with
+stream_fusion.process_stream_fusion, and reports frames per second and
+peak traced memory. Memory should stay flat as N grows. For the smallest
+N the frames are also fused in one batch with nway_dwt_fusion, which
+holds them all, to check the results match.
+
+    python benchmarks/bench_stream.py --size 720 --frames 50 200 800
+"""
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+import tracemalloc
+import numpy as np
+import cv2
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fusion import nway_dwt_fusion
+from stream_fusion import StreamFusion, iter_video_frames, process_stream_fusion
+from bench_precision import synthetic_images
+
+def write_video(path, size, frames, fps=30):
+    """A video whose frames are synthetic scenes with a moving bright spot"""
+    height, width = size, size * 4 // 3 // 2 * 2
+    writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*'MJPG'), fps, (width, height))
+    if not writer.isOpened():
+        raise RuntimeError('OpenCV cannot write MJPG video here')
+    scenes = [cv2.resize(image, (width, height)) for image in synthetic_images(size, 4)]
+    for i in range(frames):
+        frame = scenes[i % len(scenes)].copy()
+        cv2.circle(frame, ((i * 7) % width, height // 2), max(4, height // 20), 255, -1)
+        writer.write(cv2.cvtColor(frame, cv2.COLOR_GRAY2BGR))
+    writer.release()
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--size', type=int, default=480, help='frame height; width is 4:3')
+    parser.add_argument('--frames', type=int, nargs='+', default=[25, 100, 400])
+    parser.add_argument('--wavelet', default='db4')
+    parser.add_argument('--levels', type=int, default=2)
+    parser.add_argument('--precision', default='float32')
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp(prefix='bench_stream_')
+    try:
+        video = os.path.join(directory, 'input.avi')
+        write_video(video, args.size, max(args.frames))
+
+        smallest = min(args.frames)
+        frames = [frame.copy() for frame in iter_video_frames(video, max_frames=smallest)]
+        stream = StreamFusion(frames[0].shape, args.wavelet, args.levels, args.precision)
+        for frame in frames:
+            stream.add(frame)
+        batch = nway_dwt_fusion(frames, args.wavelet, stream.levels, args.precision)
+        difference = np.abs(stream.result().astype(np.int16) - batch).max()
+        del frames, stream, batch
+
+        print(f"{args.size}p frames, wavelet {args.wavelet}, {args.levels} levels, {args.precision}; "
+              f"max difference from nway_dwt_fusion over {smallest} frames: {difference}")
+        print(f"{'frames':>7} {'seconds':>8} {'frames/s':>9} {'peak MB':>8}")
+        output = os.path.join(directory, 'output.png')
+        for count in args.frames:
+            tracemalloc.start()
+            start = time.perf_counter()
+            stats = process_stream_fusion(iter_video_frames(video, max_frames=count), output,
+                                          args.wavelet, args.levels, args.precision)
+            elapsed = time.perf_counter() - start
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            print(f"{stats['frames']:>7} {elapsed:>8.2f} {stats['frames_per_second']:>9.1f} {peak / 1e6:>8.1f}")
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,245 @@
+"""Benchmark the fusion pipeline over a matrix of sizes, counts, wavelets and dtypes
+
+Times each public stage of fusion.py on deterministic synthetic images and
+records peak traced memory alongside:
+
+    load_and_preprocess_image     one image, per size
+    resize_images_to_same_size    per size and count (inputs differ in size)
+    dwt_fusion_two_images         per size and wavelet (float64, one level)
+    multi_image_dwt_fusion        per size, count, wavelet and dtype
+    enhance_contrast              per size
+    process_fusion                per size, count, wavelet and dtype, from files
+
+Results are written as JSON. Pass --baseline with an earlier file to flag
+cases that got slower, or use more memory, by more than --threshold; the
+exit status is 1 when anything regressed.
+
+    python benchmarks/bench_suite.py --preset quick --output before.json
+    python benchmarks/bench_suite.py --preset quick --output after.json --baseline before.json
+
+Time is the best of --repeat runs after a warm-up run. Memory comes from a
+separate tracemalloc run, so tracing does not slow the timed runs; it
+covers NumPy and OpenCV arrays but not PIL's internal decode buffers.
+Cases whose estimated peak is over --max-memory-mb are skipped.
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import tracemalloc
+from datetime import datetime
+import numpy as np
+import pywt
+import cv2
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from PIL import Image
+from fusion import (load_and_preprocess_image, resize_images_to_same_size, dwt_fusion_two_images,
+                    multi_image_dwt_fusion, enhance_contrast, process_fusion, estimate_fusion_memory,
+                    FUSION_DTYPES)
+from bench_precision import synthetic_images
+
+PRESETS = {
+    'quick': {'sizes': [512, 1024], 'counts': [2, 5], 'wavelets': ['db4'], 'precisions': ['float64', 'float32']},
+    'full': {'sizes': [512, 1024, 2048, 4096, 8192], 'counts': [2, 5, 10], 'wavelets': ['db4', 'haar', 'sym8'],
+             'precisions': ['float64', 'float32']},
+}
+
+# Slowdowns smaller than this are treated as noise by the regression check
+NOISE_FLOOR_SECONDS = 0.002
+
+def measure(func, repeat):
+    """Return (best seconds, peak traced bytes) for calling func"""
+    func()
+
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+
+    tracemalloc.start()
+    func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return best, peak
+
+def case_key(case):
+    return '|'.join(str(case.get(field, '')) for field in ('function', 'size', 'count', 'wavelet', 'precision'))
+
+class Suite:
+    def __init__(self, directory, repeat, levels, max_memory):
+        self.directory = directory
+        self.repeat = repeat
+        self.levels = levels
+        self.max_memory = max_memory
+        self.results = []
+        self._images = {}
+        self._paths = {}
+
+    def images(self, size, count):
+        key = (size, count)
+        if key not in self._images:
+            self._images[key] = synthetic_images(size, count)
+        return self._images[key]
+
+    def paths(self, size, count):
+        """PNG files of the synthetic images, written once per size and count"""
+        key = (size, count)
+        if key not in self._paths:
+            paths = []
+            for i, image in enumerate(self.images(size, count)):
+                path = os.path.join(self.directory, f"input_{size}_{count}_{i}.png")
+                Image.fromarray(image).save(path)
+                paths.append(path)
+            self._paths[key] = paths
+        return self._paths[key]
+
+    def run(self, function, func, megapixels, **case):
+        case = dict(function=function, **case)
+        seconds, peak = measure(func, self.repeat)
+        case.update(seconds=round(seconds, 6), peak_bytes=peak, megapixels_per_second=round(megapixels / seconds, 3))
+        self.results.append(case)
+        print(f"{function:>28} {case.get('size', ''):>5} {case.get('count', ''):>3} {case.get('wavelet', ''):>6} "
+              f"{case.get('precision', ''):>8} {seconds:>9.4f} {peak / 2**20:>9.1f}", flush=True)
+
+    def fits(self, size, count, precision='float64'):
+        estimate = estimate_fusion_memory(self.paths(size, count), precision)
+        if self.max_memory and estimate > self.max_memory:
+            print(f"{'skipped':>28} {size:>5} {count:>3} (estimated {estimate / 2**20:.0f} MiB)", flush=True)
+            return False
+        return True
+
+    def run_matrix(self, sizes, counts, wavelets, precisions):
+        for size in sizes:
+            megapixels = size * size / 1e6
+            if not self.fits(size, 2):
+                continue
+
+            path = self.paths(size, 2)[0]
+            self.run('load_and_preprocess_image', lambda: load_and_preprocess_image(path), megapixels, size=size)
+
+            gray = self.images(size, 2)[0]
+            self.run('enhance_contrast', lambda: enhance_contrast(gray), megapixels, size=size)
+
+            first, second = self.images(size, 2)
+            for wavelet in wavelets:
+                self.run('dwt_fusion_two_images', lambda: dwt_fusion_two_images(first, second, wavelet),
+                         2 * megapixels, size=size, count=2, wavelet=wavelet, precision='float64')
+
+            for count in counts:
+                if not self.fits(size, count):
+                    continue
+
+                # Every other image is a little smaller, so there is resizing to do
+                mixed = [image if i % 2 == 0 else image[:size - 16, :size - 16]
+                         for i, image in enumerate(self.images(size, count))]
+                self.run('resize_images_to_same_size', lambda: resize_images_to_same_size(mixed),
+                         count * megapixels, size=size, count=count)
+
+                images = self.images(size, count)
+                paths = self.paths(size, count)
+                output_path = os.path.join(self.directory, 'output.png')
+                for wavelet in wavelets:
+                    for precision in precisions:
+                        self.run('multi_image_dwt_fusion',
+                                 lambda: multi_image_dwt_fusion(images, wavelet, levels=self.levels,
+                                                                precision=precision),
+                                 count * megapixels, size=size, count=count, wavelet=wavelet, precision=precision)
+                        self.run('process_fusion',
+                                 lambda: process_fusion(paths, output_path, wavelet=wavelet, levels=self.levels,
+                                                        precision=precision),
+                                 count * megapixels, size=size, count=count, wavelet=wavelet, precision=precision)
+
+            # Drop this size's images before moving to a larger one
+            self._images.clear()
+
+def environment():
+    return {
+        'timestamp': datetime.utcnow().isoformat(timespec='seconds') + 'Z',
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'machine': platform.machine(),
+        'cpu_count': os.cpu_count(),
+        'numpy': np.__version__,
+        'pywt': pywt.__version__,
+        'opencv': cv2.__version__,
+    }
+
+def compare(baseline, current, threshold):
+    """Return the cases in current that are slower or larger than in baseline
+
+    Time differences under NOISE_FLOOR_SECONDS are ignored, since timer and
+    scheduler jitter alone can exceed any sensible threshold on very fast
+    cases.
+    """
+    previous = {case_key(case): case for case in baseline['results']}
+    regressions = []
+    for case in current['results']:
+        old = previous.get(case_key(case))
+        if old is None:
+            continue
+        for field in ('seconds', 'peak_bytes'):
+            if not old[field] or case[field] <= old[field] * (1 + threshold):
+                continue
+            if field == 'seconds' and case[field] - old[field] < NOISE_FLOOR_SECONDS:
+                continue
+            regressions.append((case_key(case), field, old[field], case[field]))
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--preset', choices=PRESETS, default='quick')
+    parser.add_argument('--sizes', type=int, nargs='+')
+    parser.add_argument('--counts', type=int, nargs='+')
+    parser.add_argument('--wavelets', nargs='+')
+    parser.add_argument('--precisions', nargs='+', choices=list(FUSION_DTYPES))
+    parser.add_argument('--levels', type=int, default=1)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--max-memory-mb', type=int, default=4096)
+    parser.add_argument('--output', help='write results to this JSON file')
+    parser.add_argument('--baseline', help='earlier results to check for regressions')
+    parser.add_argument('--threshold', type=float, default=0.10,
+                        help='relative slowdown or memory growth counted as a regression')
+    args = parser.parse_args()
+
+    matrix = dict(PRESETS[args.preset])
+    for field in ('sizes', 'counts', 'wavelets', 'precisions'):
+        if getattr(args, field):
+            matrix[field] = getattr(args, field)
+
+    directory = tempfile.mkdtemp(prefix='bench_suite_')
+    try:
+        suite = Suite(directory, args.repeat, args.levels, args.max_memory_mb * 1024 * 1024)
+        print(f"{'function':>28} {'size':>5} {'n':>3} {'wavelet':>6} {'dtype':>8} {'time (s)':>9} {'peak MiB':>9}")
+        suite.run_matrix(**matrix)
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+    report = {'environment': environment(), 'matrix': matrix, 'levels': args.levels, 'repeat': args.repeat,
+              'results': suite.results}
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"\nResults written to {args.output}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline.get('levels') != args.levels:
+            print(f"\nWarning: baseline was run with --levels {baseline.get('levels')}, not {args.levels}")
+        regressions = compare(baseline, report, args.threshold)
+        print(f"\n{len(regressions)} regressions beyond {args.threshold:.0%} against {args.baseline}")
+        for key, field, old, new in regressions:
+            print(f"  {key}: {field} {old} -> {new} ({new / old - 1:+.0%})")
+        if regressions:
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
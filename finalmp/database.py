@@ -0,0 +1,83 @@
+import sqlite3
+import logging
+from sqlalchemy import event
+from sqlalchemy.engine import Engine, make_url
+from sqlalchemy.pool import StaticPool
+
+# Seconds a SQLite connection waits for a lock before raising
+# "database is locked"
+SQLITE_BUSY_TIMEOUT = 15
+
+# Connections kept open per process, and how many more may be opened
+# under load; web threads, the job dispatcher and the ingest and preview
+# threads all draw from the same pool
+DB_POOL_SIZE = 10
+DB_MAX_OVERFLOW = 20
+
+# Applied to every new SQLite connection
+SQLITE_PRAGMAS = (
+    # Readers no longer block the writer, nor the writer readers
+    ('journal_mode', 'WAL'),
+    # With WAL, commits are durable against crashes of the app and only
+    # fsync at checkpoints; a power loss can drop the last commits but
+    # never corrupts the database
+    ('synchronous', 'NORMAL'),
+    ('temp_store', 'MEMORY'),
+)
+
+def is_sqlite(uri):
+    return make_url(uri).get_backend_name() == 'sqlite'
+
+def engine_options(uri, busy_timeout=SQLITE_BUSY_TIMEOUT, pool_size=DB_POOL_SIZE, max_overflow=DB_MAX_OVERFLOW):
+    """SQLAlchemy engine options suited to the database at uri
+
+    File-backed SQLite gets a connection pool shared by threads and a busy
+    timeout; in-memory SQLite a single shared connection. Other databases
+    keep the options the app has always used.
+    """
+    url = make_url(uri)
+    if url.get_backend_name() != 'sqlite':
+        return {
+            'pool_recycle': 300,
+            'pool_pre_ping': True,
+            'pool_size': pool_size,
+            'max_overflow': max_overflow,
+        }
+
+    if url.database in (None, '', ':memory:'):
+        return {'poolclass': StaticPool, 'connect_args': {'check_same_thread': False}}
+
+    return {
+        'connect_args': {'timeout': busy_timeout, 'check_same_thread': False},
+        'pool_size': pool_size,
+        'max_overflow': max_overflow,
+    }
+
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    """Tune each new SQLite connection; other drivers are left alone"""
+    if not isinstance(dbapi_connection, sqlite3.Connection):
+        return
+    cursor = dbapi_connection.cursor()
+    try:
+        for name, value in SQLITE_PRAGMAS:
+            cursor.execute(f"PRAGMA {name}={value}")
+    finally:
+        cursor.close()
+
+def init_app(app):
+    """Apply the engine options for the app's database URI
+
+    Must run before the Flask-SQLAlchemy extension creates its engines.
+    Options already present in SQLALCHEMY_ENGINE_OPTIONS win.
+    """
+    uri = app.config['SQLALCHEMY_DATABASE_URI']
+    options = engine_options(uri, app.config.get('SQLITE_BUSY_TIMEOUT', SQLITE_BUSY_TIMEOUT),
+                             app.config.get('DB_POOL_SIZE', DB_POOL_SIZE),
+                             app.config.get('DB_MAX_OVERFLOW', DB_MAX_OVERFLOW))
+    options.update(app.config.get('SQLALCHEMY_ENGINE_OPTIONS', {}))
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = options
+
+    if is_sqlite(uri) and not event.contains(Engine, 'connect', set_sqlite_pragmas):
+        event.listen(Engine, 'connect', set_sqlite_pragmas)
+        logging.info("SQLite connections use WAL with synchronous=NORMAL")
+    return options
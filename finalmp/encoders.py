@@ -0,0 +1,137 @@
+import os
+import logging
+
+# numpy, OpenCV and PIL are imported by the functions that encode, so the
+# web process can name and serve results without loading them
+
+DEFAULT_RESULT_FORMAT = 'png'
+
+# zlib level for PNG results. Fused images are noisy enough that higher
+# levels save very little and cost far more time than level 1.
+DEFAULT_PNG_COMPRESS_LEVEL = 1
+
+# Lossless output encoders: name -> (PIL format, file extension, mimetype)
+RESULT_FORMATS = {
+    'png': ('PNG', 'png', 'image/png'),
+    'webp': ('WEBP', 'webp', 'image/webp'),
+    'tiff': ('TIFF', 'tif', 'image/tiff'),
+}
+
+# WebP cannot store images with a side longer than this
+WEBP_MAX_SIDE = 16383
+
+# Downscaled JPEG copies written next to every result: name -> longest side
+RENDITIONS = {
+    'thumbnail': 256,
+    'display': 1600,
+}
+RENDITION_QUALITY = 85
+
+def result_format_for(size, result_format=DEFAULT_RESULT_FORMAT):
+    """Pick the encoder for a result of size (height, width)
+
+    Results too large for WebP fall back to PNG.
+    """
+    if result_format not in RESULT_FORMATS:
+        logging.warning(f"Unknown result format {result_format}, using {DEFAULT_RESULT_FORMAT}")
+        return DEFAULT_RESULT_FORMAT
+    if result_format == 'webp' and max(size) > WEBP_MAX_SIDE:
+        return 'png'
+    return result_format
+
+def result_encoding(config, size=None):
+    """Encoder settings from the app config, as process_fusion keyword arguments"""
+    result_format = config.get('RESULT_FORMAT', DEFAULT_RESULT_FORMAT)
+    if size is not None:
+        result_format = result_format_for(size, result_format)
+    return {
+        'result_format': result_format,
+        'compress_level': config.get('PNG_COMPRESS_LEVEL', DEFAULT_PNG_COMPRESS_LEVEL)
+    }
+
+def result_extension(result_format=DEFAULT_RESULT_FORMAT):
+    return RESULT_FORMATS[result_format][1]
+
+def result_format_of(filename):
+    """Result format a file name's extension asks for, or None if none does"""
+    extension = filename.rsplit('.', 1)[-1].lower()
+    if extension == 'tiff':
+        extension = 'tif'
+    for result_format, (_, format_extension, _) in RESULT_FORMATS.items():
+        if extension == format_extension:
+            return result_format
+    return None
+
+def result_mimetype(filename):
+    """Mimetype of a result or rendition file, from its extension"""
+    extension = filename.rsplit('.', 1)[-1].lower()
+    for _, format_extension, mimetype in RESULT_FORMATS.values():
+        if extension == format_extension:
+            return mimetype
+    return 'image/jpeg'
+
+def save_result_image(image, path, result_format=DEFAULT_RESULT_FORMAT,
+                      compress_level=DEFAULT_PNG_COMPRESS_LEVEL):
+    """Encode a fused image losslessly
+
+    Gray results are stored as one channel, a third of the data an RGB
+    copy would take to encode and send; color results as RGB.
+    """
+    from PIL import Image
+
+    pil_format = RESULT_FORMATS[result_format][0]
+    if result_format == 'png':
+        options = {'compress_level': compress_level}
+    elif result_format == 'webp':
+        # method 0 is the fastest lossless mode and still smaller than PNG
+        options = {'lossless': True, 'method': 0, 'quality': 0}
+    else:
+        options = {'compression': 'tiff_adobe_deflate'}
+    Image.fromarray(image).save(path, pil_format, **options)
+
+def rendition_filename(result_filename, name):
+    """Name of a downscaled copy of a result, e.g. fusion_x.thumbnail.jpg"""
+    return f"{result_filename.rsplit('.', 1)[0]}.{name}.jpg"
+
+def rendition_filenames(result_filename):
+    return [rendition_filename(result_filename, name) for name in RENDITIONS]
+
+def write_rendition(image, path, max_side):
+    """Save image shrunk to fit max_side as a JPEG"""
+    import numpy as np
+    import cv2
+    from PIL import Image
+
+    height, width = image.shape[:2]
+    scale = min(1.0, max_side / max(height, width))
+    if scale < 1.0:
+        image = cv2.resize(np.asarray(image), (max(1, round(width * scale)), max(1, round(height * scale))),
+                           interpolation=cv2.INTER_AREA)
+    Image.fromarray(image).save(path, 'JPEG', quality=RENDITION_QUALITY)
+
+def write_renditions(image, result_path):
+    """Write every rendition of a freshly fused image next to its result"""
+    folder, result_filename = os.path.split(result_path)
+    for name, max_side in RENDITIONS.items():
+        write_rendition(image, os.path.join(folder, rendition_filename(result_filename, name)), max_side)
+
+def ensure_rendition(result_path, name):
+    """Return the path of a rendition, creating it from the result if missing
+
+    Results written before renditions existed get theirs on first request.
+    Gray results give gray renditions and color results RGB ones.
+    """
+    import numpy as np
+    from PIL import Image
+
+    folder, result_filename = os.path.split(result_path)
+    path = os.path.join(folder, rendition_filename(result_filename, name))
+    if not os.path.exists(path):
+        with Image.open(result_path) as img:
+            mode = 'L' if img.mode == 'L' else 'RGB'
+            img.draft(mode, (RENDITIONS[name], RENDITIONS[name]))
+            image = np.asarray(img if img.mode == mode else img.convert(mode))
+        partial_path = path + '.partial'
+        write_rendition(image, partial_path, RENDITIONS[name])
+        os.replace(partial_path, path)
+    return path
@@ -1,172 +1,740 @@
-import numpy as np
-import cv2
-import pywt
-from PIL import Image
-import logging
-
-def load_and_preprocess_image(image_path):
-    """Load and preprocess image for fusion"""
-    try:
-        # Load image using PIL
-        img = Image.open(image_path)
-        
-        # Convert to RGB if needed
-        if img.mode != 'RGB':
-            img = img.convert('RGB')
-        
-        # Convert to numpy array
-        img_array = np.array(img)
-        
-        # Convert RGB to grayscale for DWT processing
-        if len(img_array.shape) == 3:
-            img_gray = cv2.cvtColor(img_array, cv2.COLOR_RGB2GRAY)
-        else:
-            img_gray = img_array
-        
-        return img_gray, img_array
-    except Exception as e:
-        logging.error(f"Error loading image {image_path}: {str(e)}")
-        return None, None
-
-def resize_images_to_same_size(images):
-    """Resize all images to the same size (minimum dimensions)"""
-    if not images:
-        return []
-    
-    # Find minimum dimensions
-    min_height = min(img.shape[0] for img in images)
-    min_width = min(img.shape[1] for img in images)
-    
-    # Make dimensions even for DWT
-    min_height = min_height - (min_height % 2)
-    min_width = min_width - (min_width % 2)
-    
-    resized_images = []
-    for img in images:
-        resized = cv2.resize(img, (min_width, min_height))
-        resized_images.append(resized)
-    
-    return resized_images
-
-def dwt_fusion_two_images(img1, img2, wavelet='db4'):
-    """Fuse two images using DWT"""
-    try:
-        # Perform DWT on both images
-        coeffs1 = pywt.dwt2(img1, wavelet)
-        coeffs2 = pywt.dwt2(img2, wavelet)
-        
-        # Extract approximation and detail coefficients
-        cA1, (cH1, cV1, cD1) = coeffs1
-        cA2, (cH2, cV2, cD2) = coeffs2
-        
-        # Fusion rules:
-        # For approximation coefficients: average
-        cA_fused = (cA1 + cA2) / 2
-        
-        # For detail coefficients: maximum absolute value
-        cH_fused = np.where(np.abs(cH1) > np.abs(cH2), cH1, cH2)
-        cV_fused = np.where(np.abs(cV1) > np.abs(cV2), cV1, cV2)
-        cD_fused = np.where(np.abs(cD1) > np.abs(cD2), cD1, cD2)
-        
-        # Reconstruct the fused image
-        coeffs_fused = (cA_fused, (cH_fused, cV_fused, cD_fused))
-        fused_image = pywt.idwt2(coeffs_fused, wavelet)
-        
-        # Normalize to 0-255 range
-        fused_image = np.clip(fused_image, 0, 255).astype(np.uint8)
-        
-        return fused_image
-    except Exception as e:
-        logging.error(f"Error in DWT fusion: {str(e)}")
-        return None
-
-def multi_image_dwt_fusion(images, wavelet='db4'):
-    """Fuse multiple images using iterative DWT fusion"""
-    if len(images) < 2:
-        logging.error("Need at least 2 images for fusion")
-        return None
-    
-    # Start with the first image
-    fused = images[0].copy()
-    
-    # Iteratively fuse with remaining images
-    for i in range(1, len(images)):
-        fused = dwt_fusion_two_images(fused, images[i], wavelet)
-        if fused is None:
-            logging.error(f"Fusion failed at image {i}")
-            return None
-    
-    return fused
-
-def enhance_contrast(image, alpha=1.2, beta=10):
-    """Enhance contrast of the fused image"""
-    try:
-        enhanced = cv2.convertScaleAbs(image, alpha=alpha, beta=beta)
-        return enhanced
-    except Exception as e:
-        logging.error(f"Error enhancing contrast: {str(e)}")
-        return image
-
-def process_fusion(image_paths, output_path):
-    """Main function to process multi-image fusion"""
-    try:
-        logging.info(f"Starting fusion process with {len(image_paths)} images")
-        
-        # Load and preprocess images
-        gray_images = []
-        color_images = []
-        
-        for path in image_paths:
-            gray_img, color_img = load_and_preprocess_image(path)
-            if gray_img is None:
-                logging.error(f"Failed to load image: {path}")
-                return False
-            gray_images.append(gray_img)
-            color_images.append(color_img)
-        
-        # Resize images to same size
-        gray_images = resize_images_to_same_size(gray_images)
-        if not gray_images:
-            logging.error("No valid images after resizing")
-            return False
-        
-        logging.info(f"Images resized to: {gray_images[0].shape}")
-        
-        # Perform DWT fusion
-        fused_gray = multi_image_dwt_fusion(gray_images)
-        if fused_gray is None:
-            logging.error("DWT fusion failed")
-            return False
-        
-        # Enhance contrast
-        fused_enhanced = enhance_contrast(fused_gray)
-        
-        # Convert to RGB for saving
-        if len(fused_enhanced.shape) == 2:
-            fused_rgb = cv2.cvtColor(fused_enhanced, cv2.COLOR_GRAY2RGB)
-        else:
-            fused_rgb = fused_enhanced
-        
-        # Save the result
-        result_image = Image.fromarray(fused_rgb)
-        result_image.save(output_path, 'PNG', quality=95)
-        
-        logging.info(f"Fusion completed successfully. Result saved to: {output_path}")
-        return True
-        
-    except Exception as e:
-        logging.error(f"Error in fusion process: {str(e)}")
-        return False
-
-def get_fusion_info():
-    """Return information about the fusion algorithm"""
-    return {
-        'algorithm': 'Discrete Wavelet Transform (DWT) Fusion',
-        'wavelet': 'Daubechies 4 (db4)',
-        'fusion_rules': {
-            'approximation_coefficients': 'Average',
-            'detail_coefficients': 'Maximum absolute value'
-        },
-        'enhancement': 'Contrast enhancement with alpha=1.2, beta=10',
-        'supported_formats': ['JPEG', 'PNG', 'TIFF']
-    }
+import os
+import numpy as np
+import cv2
+import pywt
+from PIL import Image
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from profiling import timed
+from encoders import save_result_image, write_renditions, DEFAULT_RESULT_FORMAT, DEFAULT_PNG_COMPRESS_LEVEL
+from fusion_rules import DEFAULT_RULE, RULES, get_rule
+from fusion_settings import (DEFAULT_WAVELET, DEFAULT_LEVELS, DEFAULT_PRECISION, MAX_LEVELS, SUPPORTED_WAVELETS,
+                             COLOR_MODES, DEFAULT_COLOR_MODE, PREVIEW_MAX_SIDE, DECODE_BYTES_PER_PIXEL, read_image_size, target_size,
+                             estimate_fusion_memory, fusion_parameters)
+
+# Floating point types the transforms can run in, keyed by
+# fusion_settings.PRECISIONS
+FUSION_DTYPES = {
+    'float64': np.float64,
+    'float32': np.float32
+}
+
+# Cb and Cr value of neutral gray
+CHROMA_CENTER = 128
+
+# Added to every chroma weight, so pixels that are gray in every image
+# get the plain average
+CHROMA_WEIGHT_FLOOR = 1.0
+
+def load_and_preprocess_image(image_path):
+    """Load and preprocess image for fusion"""
+    try:
+        # Load image using PIL
+        img = Image.open(image_path)
+        
+        # Convert to RGB if needed
+        if img.mode != 'RGB':
+            img = img.convert('RGB')
+        
+        # Convert to numpy array
+        img_array = np.array(img)
+        
+        # Convert RGB to grayscale for DWT processing
+        if len(img_array.shape) == 3:
+            img_gray = cv2.cvtColor(img_array, cv2.COLOR_RGB2GRAY)
+        else:
+            img_gray = img_array
+        
+        return img_gray, img_array
+    except Exception as e:
+        logging.error(f"Error loading image {image_path}: {str(e)}")
+        return None, None
+
+def resize_images_to_same_size(images):
+    """Resize all images to the same size (minimum dimensions)"""
+    if not images:
+        return []
+    
+    # Find minimum dimensions
+    min_height = min(img.shape[0] for img in images)
+    min_width = min(img.shape[1] for img in images)
+    
+    # Make dimensions even for DWT
+    min_height = min_height - (min_height % 2)
+    min_width = min_width - (min_width % 2)
+    
+    resized_images = []
+    for img in images:
+        resized = cv2.resize(img, (min_width, min_height))
+        resized_images.append(resized)
+    
+    return resized_images
+
+def load_gray_image(image_path, size=None, interpolation=cv2.INTER_LINEAR):
+    """Decode an image straight to a single-channel uint8 array
+
+    When size (height, width) is given the image is resized to it with the
+    given OpenCV interpolation. JPEGs larger than size are decoded with
+    libjpeg DCT scaling (PIL draft mode) at the smallest scale that still
+    covers size, which skips most of the decode work. No RGB copy is made.
+    """
+    try:
+        with Image.open(image_path) as img:
+            if size is not None:
+                img.draft('L', (size[1], size[0]))
+            if img.mode != 'L':
+                img = img.convert('L')
+            gray_img = np.asarray(img)
+        
+        if size is not None:
+            gray_img = cv2.resize(gray_img, (size[1], size[0]), interpolation=interpolation)
+        
+        return gray_img
+    except Exception as e:
+        logging.error(f"Error loading image {image_path}: {str(e)}")
+        return None
+
+def load_gray_images(image_paths, size=None, max_workers=None, interpolation=cv2.INTER_LINEAR):
+    """Decode several images to gray in parallel threads
+
+    PIL and OpenCV release the GIL while decoding and resizing, so the
+    threads run concurrently. Returns None if any image fails to load.
+    """
+    if max_workers is None:
+        max_workers = min(len(image_paths), os.cpu_count() or 1)
+    
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+        gray_images = list(executor.map(lambda path: load_gray_image(path, size, interpolation), image_paths))
+    
+    for path, gray_img in zip(image_paths, gray_images):
+        if gray_img is None:
+            logging.error(f"Failed to load image: {path}")
+            return None
+    
+    return gray_images
+
+def chroma_size(size):
+    """Size (height, width) chroma is fused at: half of size, as JPEG's 4:2:0"""
+    return max(1, size[0] // 2), max(1, size[1] // 2)
+
+def load_color_image(image_path, size, chroma_out):
+    """Decode an image once to its luma plane and half-resolution chroma
+
+    JPEGs are decoded straight to YCbCr (PIL draft mode, with DCT scaling
+    as in load_gray_image). Other images take their luma from the same
+    gray conversion as load_gray_image. The luma is resized to size as
+    load_gray_image does and returned as a contiguous plane, so color and
+    gray fusion of the same inputs agree on it. Cr and Cb, in the channel
+    order of OpenCV's YCrCb, are area-averaged to chroma_size(size) and
+    written into chroma_out.
+    """
+    try:
+        with Image.open(image_path) as img:
+            img.draft('YCbCr', (size[1], size[0]))
+            if img.mode == 'YCbCr':
+                ycbcr_img = np.asarray(img)
+            else:
+                ycbcr_img = np.array(img.convert('RGB').convert('YCbCr'))
+                ycbcr_img[..., 0] = img if img.mode == 'L' else img.convert('L')
+        
+        luma = cv2.resize(cv2.extractChannel(ycbcr_img, 0), (size[1], size[0]), interpolation=cv2.INTER_LINEAR)
+        chroma = cv2.resize(ycbcr_img, (chroma_out.shape[1], chroma_out.shape[0]), interpolation=cv2.INTER_AREA)
+        np.copyto(chroma_out, chroma[..., [2, 1]])
+        return luma
+    except Exception as e:
+        logging.error(f"Error loading image {image_path}: {str(e)}")
+        return None
+
+def load_color_images(image_paths, size, max_workers=None):
+    """Decode several images to luma planes and an (N, h, w, 2) chroma stack
+
+    Each image is decoded once, in parallel threads, see load_color_image.
+    Returns (luma_images, chroma_stack), or None if any image fails to load.
+    """
+    if max_workers is None:
+        max_workers = min(len(image_paths), os.cpu_count() or 1)
+    
+    chroma_stack = np.empty((len(image_paths),) + chroma_size(size) + (2,), dtype=np.uint8)
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+        luma_images = list(executor.map(lambda i: load_color_image(image_paths[i], size, chroma_stack[i]),
+                                        range(len(image_paths))))
+    
+    for path, luma in zip(image_paths, luma_images):
+        if luma is None:
+            logging.error(f"Failed to load image: {path}")
+            return None
+    
+    return luma_images, chroma_stack
+
+def dwt_fusion_two_images(img1, img2, wavelet='db4'):
+    """Fuse two images using DWT"""
+    try:
+        # Perform DWT on both images
+        coeffs1 = pywt.dwt2(img1, wavelet)
+        coeffs2 = pywt.dwt2(img2, wavelet)
+        
+        # Extract approximation and detail coefficients
+        cA1, (cH1, cV1, cD1) = coeffs1
+        cA2, (cH2, cV2, cD2) = coeffs2
+        
+        # Fusion rules:
+        # For approximation coefficients: average
+        cA_fused = (cA1 + cA2) / 2
+        
+        # For detail coefficients: maximum absolute value
+        cH_fused = np.where(np.abs(cH1) > np.abs(cH2), cH1, cH2)
+        cV_fused = np.where(np.abs(cV1) > np.abs(cV2), cV1, cV2)
+        cD_fused = np.where(np.abs(cD1) > np.abs(cD2), cD1, cD2)
+        
+        # Reconstruct the fused image
+        coeffs_fused = (cA_fused, (cH_fused, cV_fused, cD_fused))
+        fused_image = pywt.idwt2(coeffs_fused, wavelet)
+        
+        # Normalize to 0-255 range
+        fused_image = np.clip(fused_image, 0, 255).astype(np.uint8)
+        
+        return fused_image
+    except Exception as e:
+        logging.error(f"Error in DWT fusion: {str(e)}")
+        return None
+
+def coefficient_shapes(image_shape, wavelet='db4', levels=1):
+    """Return the band shapes of a wavedec2 decomposition, coarsest first
+
+    The first entry is the approximation band; each following entry is the
+    shape shared by the three detail bands of one level.
+    """
+    shapes = pywt.wavedecn_shapes(tuple(image_shape), wavelet, level=levels)
+    return [tuple(shapes[0])] + [tuple(level['dd']) for level in shapes[1:]]
+
+def pack_coefficients(coeffs):
+    """Flatten wavedec2 output into one array along the last axis
+
+    Leading axes (such as an image stack axis) are kept. The approximation
+    band comes first, followed by the detail bands from coarse to fine.
+    """
+    cA = coeffs[0]
+    leading = cA.shape[:-2]
+    parts = [cA.reshape(leading + (-1,))]
+    for level in coeffs[1:]:
+        parts.extend(band.reshape(leading + (-1,)) for band in level)
+    return np.concatenate(parts, axis=-1)
+
+def unpack_coefficients(packed, shapes):
+    """Split a packed coefficient vector back into wavedec2 format"""
+    size = shapes[0][0] * shapes[0][1]
+    coeffs = [packed[:size].reshape(shapes[0])]
+    offset = size
+    for shape in shapes[1:]:
+        size = shape[0] * shape[1]
+        bands = []
+        for _ in range(3):
+            bands.append(packed[offset:offset + size].reshape(shape))
+            offset += size
+        coeffs.append(tuple(bands))
+    return coeffs
+
+def fuse_packed_coefficients(packed_stack, shapes, rule=DEFAULT_RULE):
+    """Apply the fusion rules to packed coefficients of N images
+
+    packed_stack has shape (N, K) and the layout coefficient_shapes gives:
+    the approximation band first, then every detail band. The
+    approximation band is averaged over all images; the detail bands are
+    combined by the named rule from fusion_rules. A pixel rule runs over
+    all detail bands in one pass, a windowed rule band by band.
+    """
+    detail_rule = get_rule(rule)
+    approximation_size = shapes[0][0] * shapes[0][1]
+    fused = np.empty(packed_stack.shape[1], dtype=packed_stack.dtype)
+
+    # For approximation coefficients: average over all images
+    fused[:approximation_size] = packed_stack[:, :approximation_size].mean(axis=0)
+
+    if not detail_rule.windowed:
+        fused[approximation_size:] = detail_rule.fuse(packed_stack[:, approximation_size:])
+        return fused
+
+    offset = approximation_size
+    for shape in shapes[1:]:
+        size = shape[0] * shape[1]
+        for _ in range(3):
+            bands = packed_stack[:, offset:offset + size].reshape((-1,) + shape)
+            fused[offset:offset + size] = detail_rule.fuse(bands).ravel()
+            offset += size
+
+    return fused
+
+def effective_levels(image_shape, wavelet='db4', levels=1):
+    """Limit the decomposition depth to what the image size supports"""
+    max_level = pywt.dwt_max_level(min(image_shape), pywt.Wavelet(wavelet).dec_len)
+    return max(1, min(levels, max_level))
+
+def dwt_coefficients(image, wavelet='db4', levels=1, precision='float64'):
+    """Return the wavedec2 coefficients of an image packed into one array
+
+    The packed form can be saved to disk and memory-mapped back as a whole;
+    coefficient_shapes gives the layout needed to unpack it.
+    """
+    image = np.asarray(image, dtype=FUSION_DTYPES[precision])
+    return pack_coefficients(pywt.wavedec2(image, wavelet, level=levels))
+
+def fuse_coefficients(coefficients, image_shape, wavelet='db4', levels=1, timer=None, rule=DEFAULT_RULE):
+    """Fuse per-image packed coefficients with one inverse transform"""
+    try:
+        shapes = coefficient_shapes(image_shape, wavelet, levels)
+        with timed(timer, 'rules'):
+            packed_stack = np.stack(coefficients)
+            fused = fuse_packed_coefficients(packed_stack, shapes, rule)
+            del packed_stack
+
+        with timed(timer, 'idwt'):
+            fused_image = pywt.waverec2(unpack_coefficients(fused, shapes), wavelet)
+            fused_image = fused_image[:image_shape[0], :image_shape[1]]
+
+        # Normalize to 0-255 range
+        fused_image = np.clip(fused_image, 0, 255).astype(np.uint8)
+
+        return fused_image
+    except Exception as e:
+        logging.error(f"Error fusing coefficients: {str(e)}")
+        return None
+
+def nway_dwt_fusion(images, wavelet='db4', levels=1, precision='float64', timer=None, rule=DEFAULT_RULE):
+    """Fuse N images with one forward transform per input and a single inverse
+
+    Every image is decomposed to the given depth, the coefficients are
+    packed into one (N, K) array and the fusion rules are applied to it
+    with fuse_packed_coefficients; rule names the detail rule. precision
+    selects float64 or float32 arithmetic. timer, a profiling.StageTimer,
+    records the dwt, rules and idwt stages.
+    """
+    try:
+        # Decompose every image at once along the last two axes
+        with timed(timer, 'dwt'):
+            stack = np.asarray(np.stack(images), dtype=FUSION_DTYPES[precision])
+            packed_stack = pack_coefficients(pywt.wavedec2(stack, wavelet, level=levels, axes=(-2, -1)))
+            del stack
+
+        image_shape = images[0].shape
+        shapes = coefficient_shapes(image_shape, wavelet, levels)
+        with timed(timer, 'rules'):
+            fused = fuse_packed_coefficients(packed_stack, shapes, rule)
+            del packed_stack
+
+        with timed(timer, 'idwt'):
+            fused_image = pywt.waverec2(unpack_coefficients(fused, shapes), wavelet)
+            fused_image = fused_image[:image_shape[0], :image_shape[1]]
+
+        # Normalize to 0-255 range
+        fused_image = np.clip(fused_image, 0, 255).astype(np.uint8)
+
+        return fused_image
+    except Exception as e:
+        logging.error(f"Error in N-way DWT fusion: {str(e)}")
+        return None
+
+def fuse_chroma(chroma_stack):
+    """Blend an (N, height, width, 2) stack of chroma planes into one
+
+    Each image is weighted at every pixel by its saturation,
+    |Cb - 128| + |Cr - 128|, so the most colorful source dominates and gray
+    sources or regions do not wash the color out; where every image is
+    gray the planes are averaged. The sums are accumulated one image at a
+    time, so the working set does not grow with N. Returns a
+    (height, width, 2) uint8 array.
+    """
+    height, width = chroma_stack.shape[1:3]
+    fused = np.zeros((height, width, 2), dtype=np.float32)
+    total_weight = np.zeros((height, width), dtype=np.float32)
+    for planes in chroma_stack:
+        # uint8 XOR 0x80 read as int8 is the value minus CHROMA_CENTER
+        chroma = (planes ^ CHROMA_CENTER).view(np.int8)
+        saturation = np.abs(chroma).view(np.uint8)
+        weights = np.add(saturation[..., 0], saturation[..., 1], dtype=np.float32)
+        weights += CHROMA_WEIGHT_FLOOR
+        total_weight += weights
+        fused += chroma * weights[..., np.newaxis]
+    
+    fused /= total_weight[..., np.newaxis]
+    fused += CHROMA_CENTER
+    return np.clip(np.rint(fused), 0, 255).astype(np.uint8)
+
+def color_dwt_fusion(luma_images, chroma_stack, wavelet='db4', levels=1, precision='float64', timer=None,
+                     rule=DEFAULT_RULE):
+    """Fuse the luma and chroma of N images
+
+    luma_images are the gray planes nway_dwt_fusion takes, and go through
+    it unchanged, so color and gray fusion of the same inputs agree on the
+    luma; that is one forward transform per image rather than one per
+    channel. chroma_stack, from load_color_images, is blended at its own
+    (half) resolution by fuse_chroma. Returns (luma, chroma) for
+    color_to_rgb, or None.
+    """
+    try:
+        fused_luma = nway_dwt_fusion(luma_images, wavelet, levels, precision, timer, rule)
+        if fused_luma is None:
+            return None
+        
+        with timed(timer, 'chroma'):
+            fused_chroma = fuse_chroma(chroma_stack)
+        
+        return fused_luma, fused_chroma
+    except Exception as e:
+        logging.error(f"Error in color DWT fusion: {str(e)}")
+        return None
+
+def color_to_rgb(luma, chroma):
+    """Convert a luma plane and its Cr, Cb planes to RGB
+
+    Chroma is scaled up to the luma size and the planes are merged in
+    OpenCV's YCrCb order, so one conversion makes the RGB image.
+    """
+    height, width = luma.shape
+    if chroma.shape[:2] != (height, width):
+        chroma = cv2.resize(chroma, (width, height), interpolation=cv2.INTER_LINEAR)
+    return cv2.cvtColor(cv2.merge([luma, chroma[..., 0], chroma[..., 1]]), cv2.COLOR_YCrCb2RGB)
+
+def pairwise_dwt_fusion(images, wavelet='db4'):
+    """Fuse multiple images using iterative DWT fusion"""
+    # Start with the first image
+    fused = images[0].copy()
+    
+    # Iteratively fuse with remaining images
+    for i in range(1, len(images)):
+        fused = dwt_fusion_two_images(fused, images[i], wavelet)
+        if fused is None:
+            logging.error(f"Fusion failed at image {i}")
+            return None
+    
+    return fused
+
+def multi_image_dwt_fusion(images, wavelet='db4', pairwise=False, levels=1, precision='float64', timer=None,
+                           rule=DEFAULT_RULE):
+    """Fuse multiple images using DWT
+
+    By default every image is decomposed once and the rules are applied
+    across all of them together. Set pairwise=True to use the original
+    iterative folding instead; it is single-level float64 with the
+    max_abs rule only. The two paths produce the same result for two
+    images. For more than two they differ, because folding gives later
+    images a larger share of the approximation average and requantizes to
+    uint8 after every step.
+    """
+    if len(images) < 2:
+        logging.error("Need at least 2 images for fusion")
+        return None
+    
+    if pairwise:
+        return pairwise_dwt_fusion(images, wavelet)
+    
+    return nway_dwt_fusion(images, wavelet, levels, precision, timer, rule)
+
+def enhance_contrast(image, alpha=1.2, beta=10):
+    """Enhance contrast of the fused image"""
+    try:
+        enhanced = cv2.convertScaleAbs(image, alpha=alpha, beta=beta)
+        return enhanced
+    except Exception as e:
+        logging.error(f"Error enhancing contrast: {str(e)}")
+        return image
+
+def report_progress(progress, stage, percent):
+    """Forward a stage update to an optional progress callback"""
+    if progress is not None:
+        progress(stage, percent)
+
+def load_coefficients(image_paths, coefficient_paths, size, wavelet='db4', levels=1, precision='float64'):
+    """Load precomputed DWT coefficients, decomposing images that have none
+
+    coefficient_paths lines up with image_paths. Stored coefficients are
+    memory-mapped; None entries are decoded, resized to the common target
+    size and decomposed here.
+    """
+    coefficients = []
+    
+    for image_path, coefficient_path in zip(image_paths, coefficient_paths):
+        if coefficient_path is not None:
+            coefficients.append(np.load(coefficient_path, mmap_mode='r'))
+            continue
+        
+        gray_img = load_gray_image(image_path, size)
+        if gray_img is None:
+            logging.error(f"Failed to load image: {image_path}")
+            return None
+        coefficients.append(dwt_coefficients(gray_img, wavelet, levels, precision))
+    
+    if len({c.shape for c in coefficients}) != 1:
+        logging.error("Precomputed coefficients do not match the target size")
+        return None
+    
+    return coefficients
+
+def process_fusion(image_paths, output_path, tile_size=None, progress=None, coefficients=None,
+                   wavelet=DEFAULT_WAVELET, levels=DEFAULT_LEVELS, precision=DEFAULT_PRECISION, timer=None,
+                   workers=None, result_format=DEFAULT_RESULT_FORMAT, compress_level=DEFAULT_PNG_COMPRESS_LEVEL,
+                   renditions=False, state=None, color=False, rule=DEFAULT_RULE, quality=None):
+    """Main function to process multi-image fusion
+
+    wavelet, levels and precision select the transform; levels is capped at
+    the depth the image size supports. When tile_size is given the images
+    are fused out of core, tile by tile, with tiled_fusion.process_tiled_fusion.
+    coefficients optionally lists a precomputed .npy coefficient file (or
+    None) for each image, so those images skip decoding and the forward DWT.
+    progress, if given, is called as progress(stage, percent) when each
+    stage starts. timer, a profiling.StageTimer, collects the wall time of
+    each stage and the number of input pixels fused. With workers > 1 the
+    transform of decoded images is split into stripes fused on that many
+    processes by parallel_fusion; the result is the same. rule names the
+    detail rule (see fusion_rules). The result is saved as a
+    single-channel image, unless color is set, in result_format ('png',
+    'webp' or 'tiff', see encoders.py); renditions=True also writes the
+    downscaled JPEG copies the web app serves in place of the full result. state
+    optionally names a stream_fusion.StreamFusion file that has already
+    fused exactly these images, as incremental.py keeps; then only the
+    inverse DWT remains. color=True fuses in YCbCr with color_dwt_fusion
+    and saves an RGB result; it always decodes the images, and does not
+    apply to tiled fusion, which is gray only. quality, if given, is a dict
+    filled with the quality metrics of the fused image before contrast
+    enhancement (see measure_quality); tiled fusion leaves it empty.
+    """
+    if tile_size:
+        from tiled_fusion import process_tiled_fusion
+        return process_tiled_fusion(image_paths, output_path, wavelet=wavelet, tile_size=tile_size,
+                                    progress=progress, levels=levels, precision=precision, timer=timer,
+                                    result_format=result_format, compress_level=compress_level,
+                                    renditions=renditions, rule=rule)
+    
+    try:
+        logging.info(f"Starting fusion process with {len(image_paths)} images")
+        report_progress(progress, 'loading', 5)
+        
+        fused_chroma = None
+        sources = None
+        if color:
+            # Decode once to luma planes and half-resolution chroma; only
+            # luma is transformed
+            size = target_size(image_paths)
+            with timed(timer, 'decode'):
+                color_images = load_color_images(image_paths, size)
+            if color_images is None:
+                return False
+            gray_images, chroma_images = color_images
+            del color_images
+            
+            report_progress(progress, 'fusing', 40)
+            levels = effective_levels(size, wavelet, levels)
+            fused_color = color_dwt_fusion(gray_images, chroma_images, wavelet, levels, precision, timer, rule)
+            if fused_color is None:
+                logging.error("DWT fusion failed")
+                return False
+            fused_gray, fused_chroma = fused_color
+            sources = gray_images
+            del chroma_images
+        elif state:
+            # Finish the running fusion kept while the images were uploaded
+            from stream_fusion import StreamFusion
+            with timed(timer, 'load'):
+                fusion, _ = StreamFusion.load(state)
+            size = fusion.shape
+            
+            report_progress(progress, 'fusing', 40)
+            fused_gray = fusion.result(timer)
+            if fused_gray is None:
+                logging.error("DWT fusion failed")
+                return False
+        elif coefficients and any(path is not None for path in coefficients):
+            # Fuse from precomputed coefficients
+            size = target_size(image_paths)
+            levels = effective_levels(size, wavelet, levels)
+            with timed(timer, 'load'):
+                coefficient_arrays = load_coefficients(image_paths, coefficients, size, wavelet, levels, precision)
+            if coefficient_arrays is None:
+                return False
+            
+            report_progress(progress, 'fusing', 40)
+            fused_gray = fuse_coefficients(coefficient_arrays, size, wavelet, levels, timer, rule)
+            if fused_gray is None:
+                logging.error("DWT fusion failed")
+                return False
+        else:
+            # Decode straight to gray at the common size, in parallel
+            size = target_size(image_paths)
+            with timed(timer, 'decode'):
+                gray_images = load_gray_images(image_paths, size)
+            if gray_images is None:
+                return False
+            
+            logging.info(f"Images resized to: {size}")
+            
+            # Perform DWT fusion
+            report_progress(progress, 'fusing', 40)
+            levels = effective_levels(gray_images[0].shape, wavelet, levels)
+            if workers and workers > 1:
+                from parallel_fusion import parallel_multi_image_dwt_fusion
+                with timed(timer, 'fuse'):
+                    fused_gray = parallel_multi_image_dwt_fusion(gray_images, wavelet, levels, precision, workers,
+                                                                 rule)
+            else:
+                fused_gray = multi_image_dwt_fusion(gray_images, wavelet, levels=levels, precision=precision,
+                                                    timer=timer, rule=rule)
+            if fused_gray is None:
+                logging.error("DWT fusion failed")
+                return False
+            sources = gray_images
+        
+        # The metrics are computed on a thread while the result is enhanced
+        # and encoded; they read the fused image before enhancement
+        quality_future = None
+        if quality is not None:
+            executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='fusion-quality')
+            quality_future = executor.submit(measure_quality, fused_gray, sources, image_paths, size)
+            executor.shutdown(wait=False)
+        del sources
+        
+        # Enhance contrast
+        report_progress(progress, 'enhancing', 80)
+        with timed(timer, 'enhance'):
+            fused_enhanced = enhance_contrast(fused_gray)
+            if fused_chroma is not None:
+                fused_enhanced = color_to_rgb(fused_enhanced, fused_chroma)
+        
+        # Save the result
+        report_progress(progress, 'saving', 90)
+        with timed(timer, 'encode'):
+            save_result_image(fused_enhanced, output_path, result_format, compress_level)
+        if renditions:
+            with timed(timer, 'renditions'):
+                write_renditions(fused_enhanced, output_path)
+        
+        # Only the time the metrics add after the result is saved
+        if quality_future is not None:
+            with timed(timer, 'quality'):
+                try:
+                    quality.update(quality_future.result())
+                except Exception as e:
+                    logging.error(f"Error measuring fusion quality: {str(e)}")
+        
+        if timer is not None:
+            timer.input_pixels = len(image_paths) * size[0] * size[1]
+        
+        logging.info(f"Fusion completed successfully. Result saved to: {output_path}")
+        return True
+        
+    except Exception as e:
+        logging.error(f"Error in fusion process: {str(e)}")
+        return False
+
+def measure_quality(fused, sources=None, image_paths=None, size=None):
+    """Quality metrics of a fused image, see quality.fusion_quality
+
+    sources are the gray (or luma) inputs at the fused size. Fusions that
+    never decoded them, from a running state or precomputed coefficients,
+    pass image_paths instead and the sources are decoded here.
+    """
+    from quality import fusion_quality
+
+    if sources is None and image_paths is not None:
+        sources = load_gray_images(image_paths, size)
+    return fusion_quality(fused, sources)
+
+def preview_size(size, max_side=PREVIEW_MAX_SIDE):
+    """Scale (height, width) down to fit max_side, keeping it even for the DWT"""
+    scale = min(1.0, max_side / max(size))
+    height = max(2, int(size[0] * scale) // 2 * 2)
+    width = max(2, int(size[1] * scale) // 2 * 2)
+    return height, width
+
+def fuse_approximation_bands(coefficients, image_shape, size, wavelet='db4', levels=1):
+    """Fuse only the coarsest band of packed coefficients into a small image
+
+    The approximation band is the first part of each packed array, so only
+    that much of a memory-mapped file is read. The bands are averaged as
+    the full fusion does, brought back to pixel scale (each level of the
+    transform doubles it), trimmed of the border the transform adds and
+    resized to size.
+    """
+    shapes = coefficient_shapes(image_shape, wavelet, levels)
+    band_height, band_width = shapes[0]
+    approximation_size = band_height * band_width
+
+    total = np.zeros(approximation_size, dtype=np.float32)
+    for packed in coefficients:
+        total += packed[:approximation_size]
+    band = (total / (len(coefficients) * 2 ** levels)).reshape(shapes[0])
+
+    height = -(-image_shape[0] // 2 ** levels)
+    width = -(-image_shape[1] // 2 ** levels)
+    top = max(0, (band_height - height) // 2)
+    left = max(0, (band_width - width) // 2)
+    band = band[top:top + height, left:left + width]
+
+    band = cv2.resize(band, (size[1], size[0]), interpolation=cv2.INTER_AREA)
+    return np.clip(band, 0, 255).astype(np.uint8)
+
+def process_preview(image_paths, output_path, coefficients=None, wavelet=DEFAULT_WAVELET, levels=DEFAULT_LEVELS,
+                    max_side=PREVIEW_MAX_SIDE, max_workers=None, timer=None, rule=DEFAULT_RULE):
+    """Render a quick, low-resolution version of the fused result as JPEG
+
+    When every image has precomputed coefficients the preview is fused from
+    their approximation bands alone. Otherwise the images are decoded at
+    the preview size (JPEGs with DCT scaling, so only a fraction of the
+    data is decoded) and fused there in float32. Either way it costs a
+    small fraction of process_fusion, so it can be shown while the full
+    resolution result is still being computed.
+    """
+    try:
+        size = target_size(image_paths)
+        small = preview_size(size, max_side)
+
+        if coefficients and all(path is not None for path in coefficients):
+            levels = effective_levels(size, wavelet, levels)
+            with timed(timer, 'load'):
+                coefficient_arrays = [np.load(path, mmap_mode='r') for path in coefficients]
+            with timed(timer, 'fuse'):
+                fused_gray = fuse_approximation_bands(coefficient_arrays, size, small, wavelet, levels)
+        else:
+            with timed(timer, 'decode'):
+                gray_images = load_gray_images(image_paths, small, max_workers, cv2.INTER_AREA)
+            if gray_images is None:
+                return False
+            with timed(timer, 'fuse'):
+                fused_gray = nway_dwt_fusion(gray_images, wavelet, effective_levels(small, wavelet, levels),
+                                             'float32', rule=rule)
+            if fused_gray is None:
+                return False
+
+        with timed(timer, 'enhance'):
+            fused_enhanced = enhance_contrast(fused_gray)
+
+        with timed(timer, 'encode'):
+            Image.fromarray(fused_enhanced).save(output_path, 'JPEG', quality=85)
+
+        return True
+    except Exception as e:
+        logging.error(f"Error rendering fusion preview: {str(e)}")
+        return False
+
+def get_fusion_info(wavelet=DEFAULT_WAVELET, levels=DEFAULT_LEVELS, precision=DEFAULT_PRECISION,
+                    color_mode=DEFAULT_COLOR_MODE, rule=DEFAULT_RULE):
+    """Return information about the fusion algorithm
+
+    The rules are described from the fusion_rules registry, so a newly
+    registered rule is listed without changes here.
+    """
+    fusion_rules = {
+        'approximation_coefficients': 'Average',
+        'detail_coefficients': get_rule(rule).description,
+        'available_detail_rules': {name: detail_rule.description for name, detail_rule in RULES.items()}
+    }
+    if color_mode == 'color':
+        fusion_rules['chroma'] = 'Saturation-weighted average at half resolution'
+    return {
+        'algorithm': 'Discrete Wavelet Transform (DWT) Fusion',
+        'wavelet': f"{pywt.Wavelet(wavelet).family_name} ({wavelet})",
+        'decomposition_levels': levels,
+        'precision': precision,
+        'color_mode': 'Color (DWT on luma, YCbCr)' if color_mode == 'color' else 'Grayscale',
+        'fusion_rules': fusion_rules,
+        'enhancement': 'Contrast enhancement with alpha=1.2, beta=10',
+        'supported_formats': ['JPEG', 'PNG', 'TIFF']
+    }
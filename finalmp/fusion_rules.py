@@ -0,0 +1,222 @@
+"""Fusion rules for the wavelet detail coefficients
+
+A rule decides how the detail coefficients of N images are combined; the
+approximation band is always averaged. Rules are registered by name with
+register_rule and chosen per fusion session. Each is built from an
+activity measure, which scores every coefficient of every image, and a
+combination:
+
+    select     take the coefficient of the image with the highest activity
+    weighted   average the coefficients, weighted by their activity
+
+optionally followed by consistency verification of the selection, which
+replaces each choice by the majority choice around it. Kernels work on a
+stack of the same band from N images, shape (N, height, width), in a few
+numpy passes. Windowed measures sum their windows from integral images,
+exactly in fixed point, so the sums do not depend on where the stack was
+cropped from, so a coefficient scores the same in a tile, a stripe or the
+whole image and tiled and striped fusion stay identical to untiled fusion.
+
+numpy and OpenCV are only imported when a rule runs, so the web process
+can list and validate rules without loading them.
+"""
+
+DEFAULT_RULE = 'max_abs'
+
+# Side of the majority window used by consistency verification
+VERIFY_WINDOW = 3
+
+# box_mean sums in fixed point with this many fraction bits, far finer
+# than any difference in activity that matters for 8-bit images
+BOX_FRACTION_BITS = 16
+
+# Bits per limb box_mean splits fixed-point values into: a float64
+# integral image of such limbs is exact for planes of up to 2**27 values
+BOX_LIMB_BITS = 26
+
+# Registered rules by name, in the order they are offered
+RULES = {}
+
+def window_sums(integral, window):
+    """Sum every window x window square of an image from its integral image
+
+    integral is cv2.integral of the image, one row and column larger; the
+    result is window - 1 rows and columns smaller than the image.
+    """
+    sums = integral[window:, window:] - integral[:-window, window:]
+    sums -= integral[window:, :-window]
+    sums += integral[:-window, :-window]
+    return sums
+
+def box_mean(planes, window, out=None):
+    """Mean over the window x window neighbourhood of every plane of a stack
+
+    Edges are mirrored. Values are rounded to fixed point, in units of
+    2**-BOX_FRACTION_BITS, and summed exactly: each is split into limbs of
+    BOX_LIMB_BITS, whose float64 integral images only hold integers small
+    enough to add without rounding, and the limb sums are put back together
+    in int64. Exact sums do not depend on where the stack was cropped from,
+    so a coefficient gets the same mean in a tile or stripe as in the whole
+    image, and tied activities are broken the same way. Only the limbs the
+    values reach are summed, usually one or two.
+    """
+    import cv2
+    import numpy as np
+
+    height, width = planes.shape[1:]
+    reach = window // 2
+    fixed = np.pad(planes, ((0, 0), (reach, reach), (reach, reach)), mode='symmetric').astype(np.float64)
+    fixed = np.rint(np.ldexp(fixed, BOX_FRACTION_BITS, out=fixed), out=fixed)
+
+    total = np.zeros((len(planes), height, width), dtype=np.int64)
+    shift = 0
+    while True:
+        high = np.floor(np.ldexp(fixed, -BOX_LIMB_BITS))
+        fixed -= np.ldexp(high, BOX_LIMB_BITS)
+        for limb, plane_total in zip(fixed, total):
+            sums = window_sums(cv2.integral(limb, sdepth=cv2.CV_64F), window)
+            plane_total += sums[:height, :width].astype(np.int64) << shift
+        if not high.any():
+            break
+        fixed, shift = high, shift + BOX_LIMB_BITS
+    del fixed, high
+
+    mean = np.ldexp(total, -BOX_FRACTION_BITS)
+    mean /= window * window
+    if out is None:
+        return mean.astype(planes.dtype)
+    np.copyto(out, mean, casting='same_kind')
+    return out
+
+def abs_activity(bands, window=1, out=None):
+    """Magnitude of each coefficient"""
+    import numpy as np
+
+    return np.abs(bands, out=out)
+
+def local_energy(bands, window=3, out=None):
+    """Mean squared coefficient over a window around each coefficient"""
+    import numpy as np
+
+    out = np.square(bands, out=out)
+    return box_mean(out, window, out)
+
+def local_variance(bands, window=3, out=None):
+    """Variance of the coefficients in a window around each coefficient"""
+    import numpy as np
+
+    mean = box_mean(bands, window)
+    out = local_energy(bands, window, out)
+    out -= np.square(mean, out=mean)
+    return np.maximum(out, 0, out=out)
+
+def select_winner(activity):
+    """Index of the image with the highest activity at every position
+
+    Ties go to the later image, as the original two-image rule did.
+    """
+    return len(activity) - 1 - activity[::-1].argmax(axis=0)
+
+def take_winner(bands, winner):
+    """Pick each coefficient from the image winner names"""
+    import numpy as np
+
+    return np.take_along_axis(bands, winner[np.newaxis], axis=0)[0]
+
+def verify_consistency(winner, count, window=VERIFY_WINDOW):
+    """Replace every choice of image by the majority choice around it
+
+    A coefficient whose neighbours mostly come from another image is
+    taken from that image too, which removes isolated choices that show
+    up as speckle. Votes are counted with box_mean, one plane per image.
+    """
+    import numpy as np
+
+    votes = np.empty((count,) + winner.shape, dtype=np.float32)
+    for i in range(count):
+        np.equal(winner, i, out=votes[i], casting='unsafe')
+    return select_winner(box_mean(votes, window, votes))
+
+def weighted_average(bands, activity):
+    """Average the coefficients weighted by their activity
+
+    Where every image has zero activity the coefficients are all zero too,
+    and so is the result.
+    """
+    import numpy as np
+
+    total = activity.sum(axis=0)
+    fused = np.einsum('n...,n...->...', activity, bands)
+    return np.divide(fused, total, out=fused, where=total > 0)
+
+class FusionRule:
+    """A named rule for fusing detail coefficients, see the module docstring"""
+
+    def __init__(self, name, label, activity, combine='select', window=1, verify=False):
+        if combine not in ('select', 'weighted'):
+            raise ValueError(f"Unknown combination: {combine}")
+        self.name = name
+        self.label = label
+        self.activity = activity
+        self.combine = combine
+        self.window = window
+        self.verify = verify
+
+    @property
+    def windowed(self):
+        """Whether a coefficient's result depends on its neighbours"""
+        return self.window > 1 or self.verify
+
+    @property
+    def streamable(self):
+        """Whether images can be folded in one at a time, see stream_fusion"""
+        return not self.verify
+
+    def reach(self, window=None):
+        """Coefficients of context the rule reads on each side"""
+        reach = (window or self.window) // 2
+        if self.verify:
+            reach += VERIFY_WINDOW // 2
+        return reach
+
+    @property
+    def description(self):
+        details = []
+        if self.window > 1:
+            details.append(f"{self.window}x{self.window} window")
+        if self.verify:
+            details.append(f"{VERIFY_WINDOW}x{VERIFY_WINDOW} majority vote")
+        return f"{self.label} ({', '.join(details)})" if details else self.label
+
+    def fuse(self, bands, window=None):
+        """Fuse an (N, ...) stack of one detail band into a single band
+
+        Windowed rules need (N, height, width) stacks; pixel rules take
+        any shape, such as every detail band packed together.
+        """
+        activity = self.activity(bands, window or self.window)
+        if self.combine == 'weighted':
+            return weighted_average(bands, activity)
+        winner = select_winner(activity)
+        del activity
+        if self.verify:
+            winner = verify_consistency(winner, len(bands))
+        return take_winner(bands, winner)
+
+def register_rule(rule):
+    """Add a rule to RULES, replacing any rule of the same name"""
+    RULES[rule.name] = rule
+    return rule
+
+def get_rule(name=None):
+    """Return the registered rule called name, or the default rule"""
+    try:
+        return RULES[name or DEFAULT_RULE]
+    except KeyError:
+        raise ValueError(f"Unknown fusion rule: {name}") from None
+
+register_rule(FusionRule('max_abs', 'Maximum absolute value', abs_activity))
+register_rule(FusionRule('local_energy', 'Maximum local energy', local_energy, window=3))
+register_rule(FusionRule('local_variance', 'Maximum local variance', local_variance, window=3))
+register_rule(FusionRule('weighted_average', 'Local energy weighted average', local_energy, 'weighted', window=3))
+register_rule(FusionRule('consistency', 'Consistency-verified local energy', local_energy, window=3, verify=True))
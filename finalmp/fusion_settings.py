@@ -0,0 +1,213 @@
+import os
+from encoders import DEFAULT_RESULT_FORMAT, DEFAULT_PNG_COMPRESS_LEVEL
+from fusion_rules import DEFAULT_RULE, get_rule
+
+# Fusion settings, and the header-only sizing, tiling and memory planning
+# the web process needs to validate and queue a fusion. Nothing here
+# imports numpy, OpenCV or PyWavelets, so serving requests does not load
+# the imaging stack.
+
+DEFAULT_WAVELET = 'db4'
+DEFAULT_LEVELS = 1
+DEFAULT_PRECISION = 'float64'
+MAX_LEVELS = 6
+
+# Wavelets offered for fusion sessions
+SUPPORTED_WAVELETS = ['db4', 'haar', 'db2', 'db8', 'sym4', 'sym8', 'coif2', 'bior4.4']
+
+# Floating point types the transforms can run in (see fusion.FUSION_DTYPES)
+# and their size in bytes
+PRECISIONS = {
+    'float64': 8,
+    'float32': 4
+}
+
+# Output of a fusion session: gray, or color fused in YCbCr
+COLOR_MODES = ['gray', 'color']
+DEFAULT_COLOR_MODE = 'gray'
+
+# Decomposition filter length of each supported wavelet, as
+# pywt.Wavelet(name).dec_len, so tiles can be planned without PyWavelets
+WAVELET_FILTER_LENGTHS = {
+    'db4': 8, 'haar': 2, 'db2': 4, 'db8': 16, 'sym4': 8, 'sym8': 16, 'coif2': 12, 'bior4.4': 10
+}
+
+# Working memory of decoding one source image (RGB buffer plus gray copy)
+DECODE_BYTES_PER_PIXEL = 4
+
+# Source rows tiled fusion resizes at once when it spills a TIFF input
+# strip by strip (see tiled_fusion.spill_gray_image)
+SPILL_BAND_ROWS = 128
+
+# Working memory of blending one half-resolution chroma pixel: the float32
+# sums and weights, plus the temporaries of the image being added
+CHROMA_BYTES_PER_PIXEL = 32
+
+# Longest side of the quick preview shown before the full result is ready
+PREVIEW_MAX_SIDE = 512
+
+# Working memory of the quality metrics per result pixel: the float32
+# SSIM statistics of the result and of one source at a time
+QUALITY_BYTES_PER_PIXEL = 40
+
+# Quality metrics of a fusion result (see quality.py), in display order,
+# with their labels
+QUALITY_METRICS = {
+    'entropy': 'Entropy (bits)',
+    'spatial_frequency': 'Spatial frequency',
+    'average_gradient': 'Average gradient',
+    'mutual_information': 'Mutual information (bits, sum over inputs)',
+    'ssim': 'SSIM (mean over inputs)'
+}
+
+def read_image_size(image_path):
+    """Read (height, width) from the image header without decoding pixels"""
+    from PIL import Image
+
+    with Image.open(image_path) as img:
+        width, height = img.size
+    return height, width
+
+def tiff_strip_rows(img):
+    """Rows per strip, or per row of tiles, of a TIFF opened with PIL
+
+    None when the image cannot be decoded strip by strip: it is not a TIFF,
+    or it stores each colour plane separately.
+    """
+    if img.format != 'TIFF' or img.tag_v2.get(284, 1) != 1:
+        return None
+    height = img.size[1]
+    if 322 in img.tag_v2:
+        return img.tag_v2[323]
+    return min(img.tag_v2.get(278, height), height)
+
+def read_spill_rows(image_path):
+    """Source rows tiled fusion holds decoded at once to spill an image
+
+    TIFFs are decoded a strip at a time, keeping the strips one band of
+    SPILL_BAND_ROWS rows spans; other formats are decoded whole.
+    """
+    from PIL import Image
+
+    with Image.open(image_path) as img:
+        height = img.size[1]
+        strip_rows = tiff_strip_rows(img)
+    if strip_rows is None:
+        return height
+    return min(height, SPILL_BAND_ROWS + 2 * strip_rows)
+
+def target_size(image_paths):
+    """Compute the common even size used by resize_images_to_same_size"""
+    sizes = [read_image_size(path) for path in image_paths]
+    min_height = min(size[0] for size in sizes)
+    min_width = min(size[1] for size in sizes)
+    return min_height - (min_height % 2), min_width - (min_width % 2)
+
+def needs_tiling(image_paths, min_pixels):
+    """Check whether any input is large enough to be fused out of core"""
+    if not min_pixels:
+        return False
+    for path in image_paths:
+        height, width = read_image_size(path)
+        if height * width >= min_pixels:
+            return True
+    return False
+
+def filter_length(wavelet='db4'):
+    """Length of a wavelet's decomposition filters"""
+    if wavelet in WAVELET_FILTER_LENGTHS:
+        return WAVELET_FILTER_LENGTHS[wavelet]
+    import pywt
+    return pywt.Wavelet(wavelet).dec_len
+
+def tile_halo(wavelet='db4', levels=1, rule=DEFAULT_RULE):
+    """Return the number of border pixels a tile must read on each side
+
+    Each decomposition level widens the support of a coefficient by the
+    filter length times that level's stride, once for the forward and once
+    for the inverse transform. A halo of 2 * filter_len * (2**levels - 1)
+    covers that, which keeps the tile interior identical to the untiled
+    result. Windowed rules read their neighbours' coefficients as well,
+    which adds their reach at the stride of the coarsest level. The halo
+    is a multiple of 2**levels so tiles stay aligned to the dyadic grid of
+    every level.
+    """
+    filter_len = filter_length(wavelet)
+    step = 2 ** levels
+    halo = 2 * filter_len * (step - 1) + get_rule(rule).reach() * step
+    return -(-halo // step) * step
+
+def estimate_fusion_memory(image_paths, precision=DEFAULT_PRECISION, tile_size=None, wavelet=DEFAULT_WAVELET,
+                           levels=DEFAULT_LEVELS, color=False, rule=DEFAULT_RULE, quality=False):
+    """Estimate the peak bytes process_fusion needs, from image headers only
+
+    The transform and rules hold about three float coefficient copies per
+    input pixel plus the float output; the gray inputs and the decode
+    buffer of the largest source come on top. Tiled fusion only holds one
+    halo-padded tile of coefficients at a time, with a wider halo for
+    windowed rules, and decodes TIFF sources a few strips at a time while
+    spilling them (see read_spill_rows); other formats are decoded whole,
+    so their decode buffer counts in full. Color fusion keeps the luma of every input and decodes
+    and blends chroma at a quarter of the pixels. Windowed rules work band
+    by band, so their activity never outgrows what the pixel rules hold.
+    Quality metrics run once the coefficients are freed, so only the
+    larger of the two counts; tiled fusion does not measure quality.
+    """
+    sizes = [read_image_size(path) for path in image_paths]
+    height, width = target_size(image_paths)
+    itemsize = PRECISIONS[precision]
+    count = len(image_paths)
+
+    pixels = height * width
+    inputs = count * pixels
+    if tile_size:
+        span = tile_size + 2 * tile_halo(wavelet, levels, rule)
+        pixels = min(pixels, span * span)
+        inputs = 0
+    elif color:
+        # Luma inputs, half-resolution chroma of every input, the blending
+        # working set and the RGB output
+        inputs = count * pixels * (1 + 2 / 4) + pixels * (CHROMA_BYTES_PER_PIXEL / 4 + 3)
+
+    coefficients = count * pixels * 3.5 * itemsize
+    if quality and not tile_size:
+        coefficients = max(coefficients, pixels * QUALITY_BYTES_PER_PIXEL)
+    output = pixels * (2 * itemsize + 8)
+    if tile_size:
+        decode_pixels = max(read_spill_rows(path) * w for path, (h, w) in zip(image_paths, sizes))
+    else:
+        decode_pixels = max(h * w for h, w in sizes)
+    decode = decode_pixels * DECODE_BYTES_PER_PIXEL
+
+    return int(coefficients + output + inputs + decode)
+
+def default_memory_budget():
+    """Half of physical memory, or None where it cannot be determined"""
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') // 2
+    except (ValueError, OSError, AttributeError):
+        return None
+
+def fusion_parameters(tiled=False, wavelet=DEFAULT_WAVELET, levels=DEFAULT_LEVELS, precision=DEFAULT_PRECISION,
+                      result_format=DEFAULT_RESULT_FORMAT, compress_level=DEFAULT_PNG_COMPRESS_LEVEL, color=False,
+                      rule=DEFAULT_RULE):
+    """Return every setting that determines the bytes of a fusion result
+
+    Used to key the result cache, so anything that changes the output must
+    be listed here. Tiled fusion is gray only, so color is ignored for it.
+    """
+    color = color and not tiled
+    return {
+        'engine': 'nway_tiled' if tiled else 'nway',
+        'decoder': 'gray_chroma420' if color else 'gray',
+        'wavelet': wavelet,
+        'levels': levels,
+        'precision': precision,
+        'approximation_rule': 'mean',
+        'detail_rule': rule,
+        'chroma_rule': 'saturation_weighted_half' if color else None,
+        'contrast_alpha': 1.2,
+        'contrast_beta': 10,
+        'output': f"{'rgb' if color else 'gray'}_{result_format}",
+        'compress_level': compress_level if result_format == 'png' else None
+    }
@@ -0,0 +1,24 @@
+import gc
+
+# gunicorn main:app picks this file up from the working directory
+bind = "0.0.0.0:5000"
+
+# Import the app, create the schema and load the imaging libraries once in
+# the master; workers are forked from it and share all of that copy-on-write
+# instead of each paying for it as it starts
+preload_app = True
+
+def when_ready(server):
+    from app import preload_imaging
+    preload_imaging()
+    # Move everything loaded so far out of the collector's reach, so
+    # collections in the workers do not write to (and copy) shared pages
+    gc.freeze()
+
+def post_fork(server, worker):
+    # Drop the pooled connections init_db opened in the master; each
+    # worker opens its own
+    from app import db
+    from main import app
+    with app.app_context():
+        db.engine.dispose(close=False)
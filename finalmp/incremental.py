@@ -0,0 +1,224 @@
+import os
+import time
+import uuid
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from flask import current_app
+from fusion_settings import target_size, needs_tiling, PREVIEW_MAX_SIDE
+from fusion_rules import get_rule
+from metrics import FUSION_INCREMENTAL_SECONDS
+from session_locks import SessionLocks
+
+def state_path(filename, config):
+    return os.path.join(config['COEFFICIENT_FOLDER'], filename)
+
+def read_state_info(path):
+    """Read what a state file covers without loading its coefficients"""
+    import numpy as np
+
+    with np.load(path) as data:
+        return {
+            'image_ids': [int(i) for i in data['image_ids']],
+            'shape': tuple(int(n) for n in data['shape']),
+            'wavelet': str(data['wavelet']),
+            'levels': int(data['levels']),
+            'precision': str(data['precision']),
+            'rule': str(data['rule']) if 'rule' in data.files else 'max_abs'
+        }
+
+def current_state_path(fusion_session, config, size, wavelet='db4', levels=1, precision='float64'):
+    """Path of the session's state if it covers exactly its images, else None
+
+    Such a state already holds the fused coefficients, so the full result
+    needs only the inverse transform.
+    """
+    from fusion import effective_levels
+
+    if not fusion_session.fusion_state_filename:
+        return None
+    path = state_path(fusion_session.fusion_state_filename, config)
+    try:
+        info = read_state_info(path)
+    except (OSError, KeyError, ValueError):
+        return None
+    if (info['image_ids'] == [image.id for image in fusion_session.images]
+            and info['shape'] == tuple(size) and info['wavelet'] == wavelet
+            and info['levels'] == effective_levels(size, wavelet, levels) and info['precision'] == precision
+            and info['rule'] == fusion_session.rule):
+        return path
+    return None
+
+class IncrementalFusionWorker:
+    """Keep a running fusion of each session's uploads, and its preview
+
+    Every session's fusion state (see stream_fusion.StreamFusion) is kept
+    on disk. When an image arrives it is folded into the state with one
+    forward transform, or none if its coefficients were precomputed, and
+    the preview is rendered from the state with one inverse transform, so
+    each upload costs the same however many came before. A state that no
+    longer fits the session, because an image was removed, a smaller one
+    changed the target size, or the settings changed, is rebuilt from all
+    images. Updates for the same session are serialized. Sessions whose
+    rule cannot fold images one at a time keep no state.
+    """
+
+    def __init__(self, app, max_workers):
+        self.app = app
+        self.max_workers = max_workers
+        self._lock = threading.Lock()
+        self._session_locks = SessionLocks()
+        self._executor = None
+        self._pid = None
+
+    def schedule(self, session_id):
+        with self._lock:
+            if self._pid != os.getpid():
+                self._pid = os.getpid()
+                self._session_locks = SessionLocks()
+                self._executor = ThreadPoolExecutor(max_workers=self.max_workers,
+                                                    thread_name_prefix='fusion-incremental')
+        self._executor.submit(self._update_session, session_id)
+
+    def _update_session(self, session_id):
+        with self._session_locks.hold(session_id), self.app.app_context():
+            try:
+                self._update(session_id)
+            except Exception as e:
+                logging.error(f"Error updating incremental fusion for session {session_id}: {str(e)}")
+            finally:
+                from app import db
+                db.session.remove()
+
+    def _update(self, session_id):
+        from app import db
+        from models import FusionSession
+        from stream_fusion import StreamFusion
+
+        config = self.app.config
+        fusion_session = db.session.get(FusionSession, session_id)
+        if fusion_session is None:
+            return
+
+        images = list(fusion_session.images)
+        image_paths = [os.path.join(config['UPLOAD_FOLDER'], image.filename) for image in images]
+
+        if not images:
+            if self._replace_state(fusion_session, None) and fusion_session.preview_filename:
+                from previews import replace_preview
+                replace_preview(fusion_session, None, config)
+            return
+
+        # Very large inputs are fused tile by tile and keep no state, nor do
+        # rules that need every image at once
+        if (needs_tiling(image_paths, config.get('TILED_FUSION_MIN_PIXELS'))
+                or not get_rule(fusion_session.rule).streamable):
+            self._replace_state(fusion_session, None)
+            return
+
+        start = time.perf_counter()
+        size = target_size(image_paths)
+        options = fusion_session.fusion_options()
+
+        fusion, image_ids = None, []
+        if fusion_session.fusion_state_filename:
+            try:
+                fusion, arrays = StreamFusion.load(state_path(fusion_session.fusion_state_filename, config))
+                image_ids = [int(i) for i in arrays['image_ids']]
+            except (OSError, KeyError, ValueError) as e:
+                logging.warning(f"Rebuilding unreadable fusion state of session {session_id}: {str(e)}")
+                fusion = None
+
+        current_ids = [image.id for image in images]
+        if (fusion is None or not fusion.matches(size, rule=fusion_session.rule, **options)
+                or image_ids != current_ids[:len(image_ids)]):
+            fusion = StreamFusion(size, options['wavelet'], options['levels'], options['precision'],
+                                  fusion_session.rule)
+            image_ids = []
+
+        added = [(image, path) for image, path in zip(images, image_paths) if image.id not in image_ids]
+        if not added:
+            return
+        for image, image_path in added:
+            if not self._fold_image(fusion, image, image_path, size, options):
+                logging.error(f"Failed to add {image_path} to the fusion of session {session_id}")
+                return
+            image_ids.append(image.id)
+
+        filename = f"state_{session_id}_{uuid.uuid4().hex}.npz"
+        fusion.save(state_path(filename, config), image_ids=image_ids, precision=options['precision'])
+        if not self._replace_state(fusion_session, filename):
+            return
+
+        # A single image has nothing to fuse yet
+        if fusion.frames >= 2:
+            self._render_preview(fusion_session, fusion)
+        elif fusion_session.preview_filename:
+            from previews import replace_preview
+            replace_preview(fusion_session, None, config)
+        seconds = time.perf_counter() - start
+        FUSION_INCREMENTAL_SECONDS.observe(seconds)
+        logging.info(f"Fusion state of session {session_id} now covers {fusion.frames} images "
+                     f"({len(added)} added in {seconds * 1000:.0f} ms)")
+
+    def _fold_image(self, fusion, image, image_path, size, options):
+        """Fold one image into the state, from its stored coefficients if current"""
+        import numpy as np
+        from fusion import load_gray_image
+        from ingest import coefficients_valid
+
+        folder = self.app.config['COEFFICIENT_FOLDER']
+        if coefficients_valid(image, size, folder, options['wavelet'], fusion.levels, options['precision']):
+            fusion.add_coefficients(np.load(os.path.join(folder, image.coeffs_filename), mmap_mode='r'))
+            return True
+        gray_img = load_gray_image(image_path, size)
+        if gray_img is None:
+            return False
+        fusion.add(gray_img)
+        return True
+
+    def _replace_state(self, fusion_session, filename):
+        """Point the session at a new state file and delete the old one"""
+        from app import db
+
+        config = self.app.config
+        previous = fusion_session.fusion_state_filename
+        if previous == filename:
+            return True
+        fusion_session.fusion_state_filename = filename
+        try:
+            db.session.commit()
+        except Exception:
+            # The session was deleted while the state was updated
+            db.session.rollback()
+            if filename:
+                os.remove(state_path(filename, config))
+            return False
+        if previous and os.path.exists(state_path(previous, config)):
+            os.remove(state_path(previous, config))
+        return True
+
+    def _render_preview(self, fusion_session, fusion):
+        from fusion import enhance_contrast
+        from encoders import write_rendition
+        from previews import preview_path, replace_preview
+
+        config = self.app.config
+        filename = f"preview_{fusion_session.id}_{uuid.uuid4().hex}.jpg"
+        fused = enhance_contrast(fusion.result())
+        write_rendition(fused, preview_path(filename, config), config.get('PREVIEW_MAX_SIDE', PREVIEW_MAX_SIDE))
+        replace_preview(fusion_session, filename, config)
+
+def schedule_incremental(session_id):
+    """Queue an incremental fusion update for a session, if enabled"""
+    worker = current_app.extensions.get('fusion_incremental')
+    if worker is not None:
+        worker.schedule(session_id)
+
+def init_app(app):
+    """Attach the incremental fusion worker to the app"""
+    if not app.config.get('INCREMENTAL_FUSION'):
+        return None
+    worker = IncrementalFusionWorker(app, app.config.get('INCREMENTAL_WORKERS', 1))
+    app.extensions['fusion_incremental'] = worker
+    return worker
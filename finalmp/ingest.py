@@ -0,0 +1,161 @@
+import os
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from flask import current_app
+from fusion_settings import read_image_size, target_size
+from session_locks import SessionLocks
+
+def coefficient_filename(image, size, wavelet='db4', levels=1, precision='float64'):
+    """Name of the coefficient file for an image at a given target size"""
+    stem = image.filename.rsplit('.', 1)[0]
+    return f"{stem}_{wavelet}_l{levels}_{precision}_{size[0]}x{size[1]}.npy"
+
+def coefficients_valid(image, size, folder, wavelet='db4', levels=1, precision='float64'):
+    """Check that an image has stored coefficients for this size and transform"""
+    return (image.coeffs_filename is not None
+            and image.coeffs_wavelet == wavelet
+            and image.coeffs_levels == levels
+            and image.coeffs_precision == precision
+            and (image.coeffs_height, image.coeffs_width) == tuple(size)
+            and os.path.exists(os.path.join(folder, image.coeffs_filename)))
+
+def coefficient_paths(images, config, size, wavelet='db4', levels=1, precision='float64'):
+    """List the usable coefficient file for each image, or None
+
+    Coefficients computed for a different target size, for example before
+    a smaller image was added to the session, or for different transform
+    settings are ignored. levels is capped the same way process_fusion
+    caps it.
+    """
+    from fusion import effective_levels
+
+    folder = config['COEFFICIENT_FOLDER']
+    levels = effective_levels(size, wavelet, levels)
+    return [os.path.join(folder, image.coeffs_filename)
+            if coefficients_valid(image, size, folder, wavelet, levels, precision) else None
+            for image in images]
+
+def compute_coefficients(image_path, size, output_path, wavelet='db4', levels=1, precision='float64'):
+    """Decode an image, resize it to the target size and save its DWT"""
+    import numpy as np
+    from fusion import load_gray_image, dwt_coefficients
+
+    gray_img = load_gray_image(image_path, size)
+    if gray_img is None:
+        return False
+
+    np.save(output_path, dwt_coefficients(gray_img, wavelet, levels, precision))
+    return True
+
+class IngestWorker:
+    """Precompute wavelet coefficients for uploaded images in the background
+
+    Each task brings a whole session up to date: it works out the target
+    size from the images uploaded so far and (re)computes the coefficients
+    of every image that has none for that size. Tasks for the same session
+    are serialized, so later uploads pick up whatever earlier tasks left.
+    """
+
+    def __init__(self, app, max_workers):
+        self.app = app
+        self.max_workers = max_workers
+        self._lock = threading.Lock()
+        self._session_locks = SessionLocks()
+        self._executor = None
+        self._pid = None
+
+    def schedule(self, session_id):
+        with self._lock:
+            if self._pid != os.getpid():
+                self._pid = os.getpid()
+                self._session_locks = SessionLocks()
+                self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='fusion-ingest')
+        self._executor.submit(self._ingest_session, session_id)
+
+    def _ingest_session(self, session_id):
+        with self._session_locks.hold(session_id), self.app.app_context():
+            try:
+                self._ingest(session_id)
+            except Exception as e:
+                logging.error(f"Error precomputing coefficients for session {session_id}: {str(e)}")
+            finally:
+                # Fold the uploads into the running fusion from the
+                # coefficients just stored
+                from incremental import schedule_incremental
+                schedule_incremental(session_id)
+                from app import db
+                db.session.remove()
+
+    def _ingest(self, session_id):
+        from app import db
+        from models import FusionSession
+        from fusion import effective_levels
+
+        config = self.app.config
+        fusion_session = db.session.get(FusionSession, session_id)
+        if fusion_session is None or len(fusion_session.images) < 2:
+            return
+
+        images = list(fusion_session.images)
+        image_paths = [os.path.join(config['UPLOAD_FOLDER'], image.filename) for image in images]
+
+        # Very large inputs are fused tile by tile and never use stored coefficients
+        min_pixels = config.get('TILED_FUSION_MIN_PIXELS')
+        if min_pixels and any(h * w >= min_pixels for h, w in map(read_image_size, image_paths)):
+            return
+
+        size = target_size(image_paths)
+        folder = config['COEFFICIENT_FOLDER']
+        options = fusion_session.fusion_options()
+        wavelet, precision = options['wavelet'], options['precision']
+        levels = effective_levels(size, wavelet, options['levels'])
+
+        for image, image_path in zip(images, image_paths):
+            if coefficients_valid(image, size, folder, wavelet, levels, precision):
+                continue
+
+            filename = coefficient_filename(image, size, wavelet, levels, precision)
+            if not compute_coefficients(image_path, size, os.path.join(folder, filename), wavelet, levels, precision):
+                logging.error(f"Failed to precompute coefficients for {image_path}")
+                continue
+
+            if image.coeffs_filename and image.coeffs_filename != filename:
+                remove_coefficients(image, config)
+            image.coeffs_filename = filename
+            image.coeffs_wavelet = wavelet
+            image.coeffs_levels = levels
+            image.coeffs_precision = precision
+            image.coeffs_height, image.coeffs_width = size
+            db.session.commit()
+
+        logging.info(f"Coefficients for session {session_id} ready at {size}")
+
+def remove_coefficients(image, config):
+    """Delete the stored coefficient file of an image, if any"""
+    if not image.coeffs_filename:
+        return
+    path = os.path.join(config['COEFFICIENT_FOLDER'], image.coeffs_filename)
+    if os.path.exists(path):
+        os.remove(path)
+
+def schedule_ingest(session_id):
+    """Queue coefficient precomputation for a session, if enabled
+
+    The incremental fusion update follows the precomputation, or is queued
+    directly when precomputation is off.
+    """
+    worker = current_app.extensions.get('fusion_ingest')
+    if worker is not None:
+        worker.schedule(session_id)
+    else:
+        from incremental import schedule_incremental
+        schedule_incremental(session_id)
+
+def init_app(app):
+    """Attach the coefficient precomputation worker to the app"""
+    if not app.config.get('PRECOMPUTE_COEFFICIENTS'):
+        return None
+    worker = IngestWorker(app, app.config.get('INGEST_WORKERS', 2))
+    app.extensions['fusion_ingest'] = worker
+    return worker
@@ -0,0 +1,452 @@
+import os
+import json
+import time
+import uuid
+import queue
+import logging
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from datetime import datetime, timedelta
+from fusion_settings import target_size, default_memory_budget
+from encoders import result_encoding, result_extension
+from profiling import StageTimer
+from metrics import observe_fusion_run
+
+# Seconds between dispatcher passes over the job table
+JOB_POLL_INTERVAL = 0.5
+
+# A running job whose heartbeat is older than this is assumed to have lost
+# its worker (for example after a restart) and is queued again
+JOB_LEASE_SECONDS = 300
+
+# Give up on a job after it has been started this many times
+MAX_JOB_ATTEMPTS = 3
+
+# Stages shown while a queued job waits for running jobs to free memory,
+# or for the number of running jobs to drop below the limit
+WAITING_FOR_MEMORY = 'waiting for memory'
+WAITING_FOR_WORKER = 'waiting for a worker'
+
+# Set in each pool worker by _init_worker
+_progress_queue = None
+
+def _init_worker(progress_queue):
+    global _progress_queue
+    _progress_queue = progress_queue
+    # Load the imaging stack as the worker starts rather than in its first job
+    import fusion
+    import quality
+
+def run_fusion_job(job_id, image_paths, result_path, tile_size, coefficients=None, options=None, workers=None,
+                   measure_quality=False):
+    """Run one fusion job inside a pool worker
+
+    workers > 1 fuses the job on that many stripe processes of its own.
+    Returns (success, profile, quality) where profile is the StageTimer
+    summary and quality the result's quality metrics, if measured.
+    """
+    from fusion import process_fusion
+
+    def progress(stage, percent):
+        _progress_queue.put((job_id, stage, percent))
+
+    timer = StageTimer()
+    quality = {} if measure_quality else None
+    success = process_fusion(image_paths, result_path, tile_size=tile_size, progress=progress,
+                             coefficients=coefficients, timer=timer, workers=workers, quality=quality,
+                             **(options or {}))
+    return success, timer.as_dict(), quality or None
+
+def memory_budget(config):
+    """Estimated working memory all running fusion jobs may hold together
+
+    FUSION_MEMORY_BUDGET in bytes, by default half of physical memory.
+    Shared by every process using the database. None means no limit.
+    """
+    return config.get('FUSION_MEMORY_BUDGET') or default_memory_budget()
+
+def max_running_jobs(config):
+    """Fusion jobs that may run at once, together, in every process
+
+    FUSION_MAX_RUNNING_JOBS, by default FUSION_WORKERS. Every web process
+    has a pool of FUSION_WORKERS, so without a shared limit a forking
+    server would run FUSION_WORKERS jobs per worker process.
+    """
+    return config.get('FUSION_MAX_RUNNING_JOBS') or config.get('FUSION_WORKERS') or os.cpu_count() or 1
+
+def memory_reserved(statuses=('running',)):
+    """Sum of the memory estimates of jobs in statuses, in every process"""
+    from app import db
+    from models import FusionJob
+
+    return db.session.query(db.func.coalesce(db.func.sum(FusionJob.estimated_memory_bytes), 0)) \
+        .filter(FusionJob.status.in_(statuses)).scalar()
+
+def enqueue_fusion_job(fusion_session, tile_size=None, cache_key=None, estimated_memory=None):
+    """Queue a fusion job for a session, reusing its previous job row
+
+    Returns the job, or None if the session already has an active job or
+    another request started it first. The caller commits the database
+    session.
+    """
+    from app import db
+    from models import FusionJob, FusionSession
+
+    job = fusion_session.job
+    if job is not None and job.status in ('queued', 'running'):
+        return None
+    if not FusionSession.transition(fusion_session.id, 'processing'):
+        return None
+
+    if job is None:
+        job = FusionJob(fusion_session_id=fusion_session.id)
+        db.session.add(job)
+
+    job.status = 'queued'
+    job.stage = 'queued'
+    job.progress = 0
+    job.result_filename = None
+    job.tile_size = tile_size
+    job.cache_key = cache_key
+    job.estimated_memory_bytes = estimated_memory
+    job.attempts = 0
+    job.error = None
+    job.created_at = datetime.utcnow()
+    job.started_at = None
+    job.heartbeat_at = None
+    job.finished_at = None
+    job.duration_seconds = None
+    job.input_pixels = None
+    job.peak_memory_bytes = None
+    job.used_memory_bytes = None
+    job.stage_timings = None
+    return job
+
+class JobDispatcher:
+    """Feed queued fusion jobs from the database to a bounded process pool
+
+    Every web process runs one dispatcher thread. Jobs are claimed with a
+    conditional update, so several processes can share one job table without
+    running a job twice, and the same update holds the jobs running in all
+    processes to max_running_jobs and the memory budget. Workers report
+    progress through a queue and only the dispatcher thread writes to the
+    database.
+    """
+
+    def __init__(self, app, max_workers):
+        self.app = app
+        self.max_workers = max_workers
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+        self._executor = None
+        self._progress_queue = None
+        self._futures = {}
+
+    def start(self):
+        """Start the dispatcher thread once per process"""
+        with self._lock:
+            if self._pid == os.getpid() and self._thread.is_alive():
+                return
+            self._pid = os.getpid()
+            self._futures = {}
+            self._start_executor()
+            self._thread = threading.Thread(target=self._run, name='fusion-job-dispatcher', daemon=True)
+            self._thread.start()
+            logging.info(f"Fusion job dispatcher started with {self.max_workers} workers")
+
+    def _start_executor(self):
+        # Spawned workers do not inherit the dispatcher thread or open
+        # database connections from the web process
+        context = multiprocessing.get_context('spawn')
+        self._progress_queue = context.Queue()
+        self._executor = ProcessPoolExecutor(max_workers=self.max_workers, mp_context=context,
+                                             initializer=_init_worker, initargs=(self._progress_queue,))
+
+    def _run(self):
+        while True:
+            try:
+                with self.app.app_context():
+                    self._tick()
+            except Exception as e:
+                logging.error(f"Error in fusion job dispatcher: {str(e)}")
+            time.sleep(JOB_POLL_INTERVAL)
+
+    def _tick(self):
+        from app import db
+        from models import FusionJob
+
+        self._record_progress()
+        self._collect_finished()
+        self._requeue_stale()
+
+        budget = memory_budget(self.app.config)
+        limit = max_running_jobs(self.app.config)
+        while len(self._futures) < self.max_workers:
+            job = FusionJob.query.filter_by(status='queued').order_by(FusionJob.created_at).first()
+            if job is None:
+                break
+            if self._claim(job, budget, limit):
+                db.session.commit()
+                self._submit(job)
+            else:
+                db.session.refresh(job)
+                if job.status == 'queued':
+                    # No worker or not enough memory free; jobs start in
+                    # order, so later ones wait too rather than overtaking
+                    # it indefinitely
+                    running = FusionJob.query.filter_by(status='running').count()
+                    stage = WAITING_FOR_WORKER if running >= limit else WAITING_FOR_MEMORY
+                    if job.stage != stage:
+                        job.stage = stage
+                        db.session.commit()
+                    break
+            db.session.commit()
+
+    def _record_progress(self):
+        from app import db
+        from models import FusionJob
+
+        updates = {}
+        while True:
+            try:
+                job_id, stage, percent = self._progress_queue.get_nowait()
+            except queue.Empty:
+                break
+            updates[job_id] = (stage, percent)
+
+        now = datetime.utcnow()
+        for job_id in self._futures:
+            values = {'heartbeat_at': now}
+            if job_id in updates:
+                values['stage'], values['progress'] = updates[job_id]
+            FusionJob.query.filter_by(id=job_id, status='running').update(values)
+        db.session.commit()
+
+    def _collect_finished(self):
+        from app import db
+        from models import FusionJob
+
+        for job_id, future in list(self._futures.items()):
+            if not future.done():
+                continue
+            del self._futures[job_id]
+
+            error = None
+            profile = None
+            quality = None
+            try:
+                success, profile, quality = future.result()
+            except BrokenProcessPool:
+                # A worker died, e.g. killed by the OOM killer; the pool is
+                # unusable, so start a fresh one for the remaining jobs
+                success, error = False, 'Worker process terminated'
+                self._restart_executor()
+            except Exception as e:
+                success, error = False, str(e)
+
+            job = db.session.get(FusionJob, job_id)
+            if job is None:
+                continue
+            if profile is not None:
+                job.duration_seconds = profile['total_seconds']
+                job.input_pixels = profile['input_pixels']
+                job.peak_memory_bytes = profile['peak_memory_bytes']
+                job.used_memory_bytes = profile['peak_memory_bytes'] - profile['base_memory_bytes']
+                job.stage_timings = json.dumps(profile['stages'])
+                if job.estimated_memory_bytes and job.used_memory_bytes > job.estimated_memory_bytes:
+                    logging.warning(f"Fusion job {job_id} used {job.used_memory_bytes >> 20} MiB, "
+                                    f"estimated {job.estimated_memory_bytes >> 20} MiB")
+            self._finish(job, success, error, quality)
+            db.session.commit()
+            observe_fusion_run(profile, job.status, job.estimated_memory_bytes)
+
+    def _restart_executor(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+        self._start_executor()
+
+    def _finish(self, job, success, error=None, quality=None):
+        from models import FusionJob, FusionSession
+        from result_cache import store_result, release_result, evict_results
+
+        now = datetime.utcnow()
+        status = 'completed' if success else 'failed'
+
+        # Only a job still running may be finished; it may have been requeued
+        # by another process after losing its lease, or deleted with its
+        # session, in which case this run's output is dropped
+        finished = FusionJob.query.filter_by(id=job.id, status='running').update({
+            'status': status,
+            'stage': status,
+            'finished_at': now,
+        })
+        if finished != 1:
+            if success:
+                release_result(job.result_filename)
+            return
+
+        fusion_session = job.fusion_session
+        if not success:
+            job.error = (error or 'Fusion processing failed')[:500]
+            FusionSession.transition(fusion_session.id, 'failed')
+            return
+
+        quality_metrics = json.dumps(quality) if quality else None
+        if job.cache_key:
+            result_path = os.path.join(self.app.config['RESULT_FOLDER'], job.result_filename)
+            job.result_filename = store_result(job.cache_key, result_path, quality_metrics)
+        job.progress = 100
+        previous_result = fusion_session.result_filename
+        if FusionSession.transition(fusion_session.id, 'completed', result_filename=job.result_filename,
+                                    completed_at=now, quality_metrics=quality_metrics):
+            if previous_result != job.result_filename:
+                release_result(previous_result)
+        else:
+            release_result(job.result_filename)
+        evict_results()
+
+    def _requeue_stale(self):
+        from app import db
+        from models import FusionJob
+
+        cutoff = datetime.utcnow() - timedelta(seconds=self.app.config.get('JOB_LEASE_SECONDS', JOB_LEASE_SECONDS))
+        stale = FusionJob.query.filter(FusionJob.status == 'running',
+                                       db.or_(FusionJob.heartbeat_at == None,  # noqa: E711
+                                              FusionJob.heartbeat_at < cutoff)).all()
+        for job in stale:
+            if job.id in self._futures:
+                continue
+            if job.attempts >= MAX_JOB_ATTEMPTS:
+                logging.error(f"Fusion job {job.id} failed after {job.attempts} attempts")
+                self._finish(job, False, 'Too many attempts')
+            else:
+                # Unless its worker sent a heartbeat since it was read
+                requeued = FusionJob.query.filter_by(id=job.id, status='running', heartbeat_at=job.heartbeat_at) \
+                    .update({'status': 'queued', 'stage': 'queued', 'progress': 0})
+                if requeued:
+                    logging.info(f"Requeueing stale fusion job {job.id}")
+        db.session.commit()
+
+    def _claim(self, job, budget=None, limit=None):
+        from app import db
+        from models import FusionJob
+
+        query = FusionJob.query.filter_by(id=job.id, status='queued')
+        running = db.aliased(FusionJob)
+        if limit:
+            # Both checks are made by the statement that claims the job, so
+            # two dispatchers cannot both take the last free slot
+            count = db.select(db.func.count(running.id)).where(running.status == 'running').scalar_subquery()
+            query = query.filter(count < limit)
+        if budget and job.estimated_memory_bytes:
+            # Start the job only if it fits in the budget next to the jobs
+            # running in every process, or if nothing runs at all
+            reserved = db.select(db.func.coalesce(db.func.sum(running.estimated_memory_bytes), 0)) \
+                .where(running.status == 'running').scalar_subquery()
+            idle = ~db.select(running.id).where(running.status == 'running').exists()
+            query = query.filter(db.or_(reserved + job.estimated_memory_bytes <= budget, idle))
+
+        now = datetime.utcnow()
+        claimed = query.update({
+            'status': 'running',
+            'stage': 'starting',
+            'attempts': FusionJob.attempts + 1,
+            'started_at': now,
+            'heartbeat_at': now,
+        })
+        return claimed == 1
+
+    def _submit(self, job):
+        """Start a claimed job, or fail it if it cannot be started
+
+        Preparing the job opens the uploads, which may have been deleted
+        since it was queued; such a job is failed at once instead of
+        staying running until its lease runs out.
+        """
+        from app import db
+
+        try:
+            self._start_job(job)
+        except Exception as e:
+            logging.error(f"Error starting fusion job {job.id}: {str(e)}")
+            db.session.rollback()
+            self._fail_unstarted(job.id, str(e))
+
+    def _fail_unstarted(self, job_id, error):
+        from app import db
+        from models import FusionJob, FusionSession
+
+        job = db.session.get(FusionJob, job_id)
+        if job is None:
+            return
+        failed = FusionJob.query.filter(FusionJob.id == job_id, FusionJob.status.in_(['queued', 'running'])) \
+            .update({'status': 'failed', 'stage': 'failed', 'finished_at': datetime.utcnow(),
+                     'error': (error or 'Fusion could not be started')[:500]}, synchronize_session=False)
+        if failed:
+            FusionSession.transition(job.fusion_session_id, 'failed')
+        db.session.commit()
+        if failed:
+            observe_fusion_run(None, 'failed')
+
+    def _start_job(self, job):
+        from app import db
+
+        config = self.app.config
+        fusion_session = job.fusion_session
+        image_paths = [os.path.join(config['UPLOAD_FOLDER'], img.filename) for img in fusion_session.images]
+        size = target_size(image_paths)
+        encoding = result_encoding(config, size)
+
+        result_filename = f"fusion_{fusion_session.id}_{uuid.uuid4().hex}.{result_extension(encoding['result_format'])}"
+        job.result_filename = result_filename
+        result_path = os.path.join(config['RESULT_FOLDER'], result_filename)
+
+        # Finish the running fusion kept during the uploads if it covers
+        # exactly these images; otherwise use coefficients precomputed at
+        # upload time where they are current, unless the job is to be split
+        # across stripe workers, which start from decoded pixels. Both hold
+        # gray coefficients, so color fusions decode the images again.
+        options = fusion_session.fusion_options()
+        stripe_workers = config.get('FUSION_STRIPE_WORKERS', 1)
+        color = fusion_session.color and not job.tile_size
+        coefficients = None
+        state = None
+        if not job.tile_size and not color and config.get('INCREMENTAL_FUSION'):
+            from incremental import current_state_path
+            state = current_state_path(fusion_session, config, size, **options)
+        if (state is None and not job.tile_size and not color and stripe_workers <= 1
+                and config.get('PRECOMPUTE_COEFFICIENTS')):
+            from ingest import coefficient_paths
+            coefficients = coefficient_paths(fusion_session.images, config, size, **options)
+        options.update(encoding, renditions=True, state=state, color=color, rule=fusion_session.rule)
+
+        try:
+            future = self._executor.submit(run_fusion_job, job.id, image_paths, result_path, job.tile_size,
+                                           coefficients, options, stripe_workers,
+                                           config.get('QUALITY_METRICS', False))
+        except Exception as e:
+            logging.error(f"Error submitting fusion job {job.id}: {str(e)}")
+            self._restart_executor()
+            job.status = 'queued'
+            db.session.commit()
+            return
+        self._futures[job.id] = future
+
+def init_app(app):
+    """Attach a fusion job dispatcher to the app
+
+    The dispatcher is started lazily by the first request each process
+    serves, so forking servers get one dispatcher per worker process;
+    together they run at most max_running_jobs jobs.
+    """
+    app.config.setdefault('FUSION_WORKERS', os.cpu_count() or 1)
+    dispatcher = JobDispatcher(app, app.config['FUSION_WORKERS'])
+    app.extensions['fusion_jobs'] = dispatcher
+
+    @app.before_request
+    def start_job_dispatcher():
+        dispatcher.start()
+
+    return dispatcher
@@ -1,5 +1,15 @@
-from app import app
-import routes
+import os
+import logging
+from app import create_app, init_db
+
+logging.basicConfig(level=os.environ.get("LOG_LEVEL", "DEBUG"))
+
+app = create_app()
+
+# Create the folders and tables on start, unless the deployment runs
+# `flask --app main init-db` itself
+if os.environ.get("INIT_DB_ON_START", "1") == "1":
+    init_db(app)
 
 if __name__ == "__main__":
     app.run(host="0.0.0.0", port=5000, debug=True)
@@ -0,0 +1,212 @@
+import time
+import bisect
+import threading
+from flask import request, g
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+STAGE_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+MEMORY_BUCKETS = tuple(2 ** n * 1024 * 1024 for n in range(4, 15))  # 16 MiB to 16 GiB
+RATIO_BUCKETS = (0.25, 0.5, 0.75, 1.0, 1.25, 1.5, 2.0, 4.0)
+
+# Requests to these endpoints are not timed
+UNTIMED_ENDPOINTS = {'static', 'metrics_endpoint'}
+
+def _escape(value):
+    return str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+def _label_text(labelnames, labelvalues, extra=()):
+    pairs = list(zip(labelnames, labelvalues)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+def _number(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values = {}
+        if not self.labelnames:
+            self._values[()] = self._initial()
+
+    def _initial(self):
+        return 0
+
+    def _key(self, labels):
+        return tuple(labels.get(name, '') for name in self.labelnames)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.extend(self._samples(key, value))
+        return lines
+
+    def _samples(self, key, value):
+        return [f"{self.name}{_label_text(self.labelnames, key)} {_number(value)}"]
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        super().__init__(name, documentation, labelnames)
+
+    def _initial(self):
+        return [[0] * (len(self.buckets) + 1), 0.0, 0]
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = self._initial()
+            state[0][index] += 1
+            state[1] += value
+            state[2] += 1
+
+    def _samples(self, key, value):
+        counts, total, count = value
+        lines = []
+        cumulative = 0
+        for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+            cumulative += bucket_count
+            labels = _label_text(self.labelnames, key, [('le', _number(bound))])
+            lines.append(f"{self.name}_bucket{labels} {cumulative}")
+        labels = _label_text(self.labelnames, key)
+        lines.append(f"{self.name}_sum{labels} {_number(total)}")
+        lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+class Registry:
+    """In-process metrics in the Prometheus text exposition format
+
+    Every web process keeps its own values, the way a multi-process
+    server is normally scraped per worker.
+    """
+
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+REGISTRY = Registry()
+
+REQUEST_LATENCY = REGISTRY.register(Histogram(
+    'http_request_duration_seconds', 'Time spent handling HTTP requests', ['endpoint', 'method']))
+REQUESTS = REGISTRY.register(Counter(
+    'http_requests_total', 'HTTP requests handled', ['endpoint', 'method', 'status']))
+
+FUSION_JOBS = REGISTRY.register(Counter(
+    'fusion_jobs_total', 'Fusion jobs finished by this process', ['status']))
+FUSION_CACHE_HITS = REGISTRY.register(Counter(
+    'fusion_cache_hits_total', 'Fusion requests answered from the result cache'))
+FUSION_STAGE_SECONDS = REGISTRY.register(Histogram(
+    'fusion_stage_duration_seconds', 'Wall time of each fusion pipeline stage', ['stage'], STAGE_BUCKETS))
+FUSION_JOB_SECONDS = REGISTRY.register(Histogram(
+    'fusion_job_duration_seconds', 'Wall time of a whole fusion run in its worker', [], STAGE_BUCKETS))
+FUSION_PEAK_MEMORY = REGISTRY.register(Histogram(
+    'fusion_peak_memory_bytes', 'Peak resident memory of the worker during a fusion run', [], MEMORY_BUCKETS))
+FUSION_INPUT_PIXELS = REGISTRY.register(Counter(
+    'fusion_input_pixels_total', 'Input pixels fused, summed over all images'))
+FUSION_PREVIEW_SECONDS = REGISTRY.register(Histogram(
+    'fusion_preview_duration_seconds', 'Time from queueing a fusion to its preview being ready', [],
+    STAGE_BUCKETS))
+FUSION_INCREMENTAL_SECONDS = REGISTRY.register(Histogram(
+    'fusion_incremental_update_seconds', 'Time to fold new uploads into a session\'s running fusion and preview',
+    [], STAGE_BUCKETS))
+FUSION_QUEUE_DEPTH = REGISTRY.register(Gauge(
+    'fusion_queue_depth', 'Fusion jobs waiting or running', ['status']))
+FUSION_MEMORY_RESERVED = REGISTRY.register(Gauge(
+    'fusion_memory_reserved_bytes', 'Estimated working memory of running fusion jobs'))
+FUSION_MEMORY_BUDGET = REGISTRY.register(Gauge(
+    'fusion_memory_budget_bytes', 'Estimated working memory running fusion jobs may hold together'))
+FUSION_MEMORY_ESTIMATE_RATIO = REGISTRY.register(Histogram(
+    'fusion_memory_estimate_ratio', 'Memory a fusion run used divided by its admission estimate', [],
+    RATIO_BUCKETS))
+FUSION_ADMISSIONS = REGISTRY.register(Counter(
+    'fusion_admissions_total', 'Fusion requests by admission decision', ['decision']))
+
+STORAGE_BYTES = REGISTRY.register(Gauge(
+    'storage_bytes', 'Bytes of referenced files in each storage folder, as of the last sweep', ['folder']))
+STORAGE_FILES = REGISTRY.register(Gauge(
+    'storage_files', 'Referenced files in each storage folder, as of the last sweep', ['folder']))
+STORAGE_DISK_FREE_BYTES = REGISTRY.register(Gauge(
+    'storage_disk_free_bytes', 'Free space on the disk holding each storage folder', ['folder']))
+STORAGE_PENDING_DELETIONS = REGISTRY.register(Gauge(
+    'storage_pending_deletions', 'Files queued for deletion by the storage manager'))
+STORAGE_DELETED_FILES = REGISTRY.register(Counter(
+    'storage_deleted_files_total', 'Files deleted by the storage manager', ['reason']))
+STORAGE_DELETED_BYTES = REGISTRY.register(Counter(
+    'storage_deleted_bytes_total', 'Bytes freed by the storage manager', ['reason']))
+STORAGE_EXPIRED_SESSIONS = REGISTRY.register(Counter(
+    'storage_expired_sessions_total', 'Idle sessions deleted after their TTL', ['status']))
+STORAGE_SWEEP_SECONDS = REGISTRY.register(Histogram(
+    'storage_sweep_duration_seconds', 'Wall time of a storage sweep', [], STAGE_BUCKETS))
+
+def observe_fusion_run(profile, status, estimated_memory=None):
+    """Record the outcome and StageTimer profile of one fusion job"""
+    FUSION_JOBS.inc(status=status)
+    if not profile:
+        return
+    for stage, seconds in profile['stages'].items():
+        FUSION_STAGE_SECONDS.observe(seconds, stage=stage)
+    FUSION_JOB_SECONDS.observe(profile['total_seconds'])
+    FUSION_PEAK_MEMORY.observe(profile['peak_memory_bytes'])
+    FUSION_INPUT_PIXELS.inc(profile['input_pixels'])
+    if estimated_memory:
+        used = profile['peak_memory_bytes'] - profile.get('base_memory_bytes', 0)
+        FUSION_MEMORY_ESTIMATE_RATIO.observe(used / estimated_memory)
+
+def init_app(app):
+    """Time every request the app handles"""
+
+    @app.before_request
+    def start_request_timer():
+        g.request_started = time.perf_counter()
+
+    @app.after_request
+    def record_request_latency(response):
+        started = g.pop('request_started', None)
+        endpoint = request.endpoint
+        if started is not None and endpoint not in UNTIMED_ENDPOINTS:
+            endpoint = endpoint or 'unmatched'
+            REQUEST_LATENCY.observe(time.perf_counter() - started, endpoint=endpoint, method=request.method)
+            REQUESTS.inc(endpoint=endpoint, method=request.method, status=response.status_code)
+        return response
+
+    return REGISTRY
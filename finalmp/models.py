@@ -1,3 +1,4 @@
+import json
 from datetime import datetime
 from flask_sqlalchemy import SQLAlchemy
 from flask_login import UserMixin
@@ -23,7 +24,19 @@ class User(UserMixin, db.Model):
     def __repr__(self):
         return f'<User {self.username}>'
 
+# Statuses a fusion session may move to, by its current status. A finished
+# or failed session can be fused again, or completed from the result cache.
+SESSION_TRANSITIONS = {
+    'pending': ('processing', 'completed'),
+    'processing': ('completed', 'failed'),
+    'completed': ('processing', 'completed'),
+    'failed': ('processing', 'completed'),
+}
+
 class FusionSession(db.Model):
+    # The dashboard lists a user's sessions newest first, a page at a time
+    __table_args__ = (db.Index('ix_fusion_session_user_created', 'user_id', 'created_at'),)
+    
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     session_name = db.Column(db.String(200), nullable=False)
@@ -33,19 +46,148 @@ class FusionSession(db.Model):
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     completed_at = db.Column(db.DateTime)
     
+    # Low-resolution preview rendered while the fusion runs; see previews.py
+    preview_filename = db.Column(db.String(200))
+    
+    # Running fusion of the images uploaded so far; see incremental.py
+    fusion_state_filename = db.Column(db.String(200))
+    
+    # Wavelet transform settings used for this session
+    wavelet = db.Column(db.String(20), default='db4')
+    levels = db.Column(db.Integer, default=1)
+    precision = db.Column(db.String(10), default='float64')  # float64, float32
+    
+    # gray, or color fused in YCbCr; see fusion.color_dwt_fusion
+    color_mode = db.Column(db.String(10), default='gray')
+    
+    # Rule combining the detail coefficients; see fusion_rules.py
+    fusion_rule = db.Column(db.String(30), default='max_abs')
+    
+    # Quality metrics of the current result; see quality.py
+    quality_metrics = db.Column(db.Text)  # JSON object of metric name to value
+    
+    # Uploaded images plus unfinished chunked uploads; see uploads.reserve_image_slots
+    image_slots = db.Column(db.Integer, default=0)
+    
     # Relationship with uploaded images
     images = db.relationship('UploadedImage', backref='fusion_session', lazy=True, cascade='all, delete-orphan')
     
+    # Background job that runs the fusion for this session
+    job = db.relationship('FusionJob', backref='fusion_session', uselist=False, cascade='all, delete-orphan')
+    
+    # Chunked uploads still in progress
+    uploads = db.relationship('ChunkedUpload', backref='fusion_session', lazy=True, cascade='all, delete-orphan')
+    
+    def fusion_options(self):
+        """Transform settings as process_fusion keyword arguments"""
+        return {
+            'wavelet': self.wavelet or 'db4',
+            'levels': self.levels or 1,
+            'precision': self.precision or 'float64'
+        }
+    
+    @property
+    def color(self):
+        """Whether the result is fused in color rather than gray"""
+        return self.color_mode == 'color'
+    
+    @property
+    def rule(self):
+        """Name of the detail coefficient rule, as process_fusion takes it"""
+        return self.fusion_rule or 'max_abs'
+    
+    def quality_dict(self):
+        return json.loads(self.quality_metrics) if self.quality_metrics else {}
+    
+    @classmethod
+    def transition(cls, session_id, status, **values):
+        """Atomically move a session to status, if SESSION_TRANSITIONS allows it
+
+        A compare-and-set update on the current status, so of two requests
+        racing to start the same fusion only one succeeds. values are set
+        in the same update. Returns True if this caller made the change;
+        the caller commits.
+        """
+        allowed_from = [current for current, targets in SESSION_TRANSITIONS.items() if status in targets]
+        values['status'] = status
+        updated = cls.query.filter(cls.id == session_id, cls.status.in_(allowed_from)).update(values)
+        return updated == 1
+    
     def __repr__(self):
         return f'<FusionSession {self.session_name}>'
 
 class UploadedImage(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    fusion_session_id = db.Column(db.Integer, db.ForeignKey('fusion_session.id'), nullable=False)
+    fusion_session_id = db.Column(db.Integer, db.ForeignKey('fusion_session.id'), nullable=False, index=True)
     filename = db.Column(db.String(200), nullable=False)
     original_filename = db.Column(db.String(200), nullable=False)
     file_size = db.Column(db.Integer)
+    content_hash = db.Column(db.String(64))
     uploaded_at = db.Column(db.DateTime, default=datetime.utcnow)
     
+    # Precomputed wavelet coefficients and the target size they were made for
+    coeffs_filename = db.Column(db.String(200))
+    coeffs_wavelet = db.Column(db.String(20))
+    coeffs_levels = db.Column(db.Integer)
+    coeffs_precision = db.Column(db.String(10))
+    coeffs_height = db.Column(db.Integer)
+    coeffs_width = db.Column(db.Integer)
+    
     def __repr__(self):
         return f'<UploadedImage {self.original_filename}>'
+
+class ChunkedUpload(db.Model):
+    id = db.Column(db.String(32), primary_key=True)
+    fusion_session_id = db.Column(db.Integer, db.ForeignKey('fusion_session.id'), nullable=False)
+    filename = db.Column(db.String(200), nullable=False)  # final name in the upload folder
+    original_filename = db.Column(db.String(200), nullable=False)
+    total_size = db.Column(db.BigInteger, nullable=False)
+    received_bytes = db.Column(db.BigInteger, default=0)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    def __repr__(self):
+        return f'<ChunkedUpload {self.original_filename} {self.received_bytes}/{self.total_size}>'
+
+class FusionJob(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    fusion_session_id = db.Column(db.Integer, db.ForeignKey('fusion_session.id'), unique=True, nullable=False)
+    status = db.Column(db.String(50), default='queued')  # queued, running, completed, failed
+    stage = db.Column(db.String(50), default='queued')
+    progress = db.Column(db.Integer, default=0)
+    result_filename = db.Column(db.String(200))
+    tile_size = db.Column(db.Integer)
+    cache_key = db.Column(db.String(64))
+    estimated_memory_bytes = db.Column(db.BigInteger)  # peak working memory from the image headers
+    attempts = db.Column(db.Integer, default=0)
+    error = db.Column(db.String(500))
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    started_at = db.Column(db.DateTime)
+    heartbeat_at = db.Column(db.DateTime)
+    finished_at = db.Column(db.DateTime)
+    
+    # Profile of the last run, reported by the worker
+    duration_seconds = db.Column(db.Float)
+    input_pixels = db.Column(db.BigInteger)
+    peak_memory_bytes = db.Column(db.BigInteger)
+    used_memory_bytes = db.Column(db.BigInteger)  # peak above the worker's size at start, vs the estimate
+    stage_timings = db.Column(db.Text)  # JSON object of stage name to seconds
+    
+    def stage_timing_dict(self):
+        return json.loads(self.stage_timings) if self.stage_timings else {}
+    
+    def __repr__(self):
+        return f'<FusionJob {self.id} {self.status}>'
+
+class ResultCacheEntry(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    cache_key = db.Column(db.String(64), unique=True, nullable=False)
+    filename = db.Column(db.String(200), nullable=False)
+    size_bytes = db.Column(db.Integer, default=0)
+    ref_count = db.Column(db.Integer, default=0)  # sessions whose result is this file
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    last_used_at = db.Column(db.DateTime, default=datetime.utcnow)
+    quality_metrics = db.Column(db.Text)  # JSON, copied to the sessions that hit the entry
+    
+    def __repr__(self):
+        return f'<ResultCacheEntry {self.cache_key[:12]} refs={self.ref_count}>'
@@ -0,0 +1,122 @@
+import os
+import logging
+import threading
+import multiprocessing
+import multiprocessing.util
+from multiprocessing import shared_memory
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import numpy as np
+from fusion import nway_dwt_fusion
+from tiled_fusion import tile_halo, fuse_tile
+from fusion_rules import DEFAULT_RULE
+
+# Stripes thinner than this spend most of their work on the halo
+MIN_STRIPE_ROWS = 64
+
+_executor = None
+_executor_workers = None
+_executor_lock = threading.Lock()
+
+def _shared_array(block, shape):
+    # Views must be gone before the block is closed, so they are only
+    # ever created as temporaries
+    return np.ndarray(shape, dtype=np.uint8, buffer=block.buf)
+
+def _fuse_stripe(sources_name, output_name, shape, bounds, wavelet, levels, precision, rule):
+    """Fuse one stripe of images held in shared memory, in a worker process
+
+    Workers are spawned by the process that owns the blocks and share its
+    resource tracker, so attaching here does not hand over ownership.
+    """
+    sources_block = shared_memory.SharedMemory(name=sources_name)
+    output_block = shared_memory.SharedMemory(name=output_name)
+    try:
+        return fuse_tile(_shared_array(sources_block, shape), _shared_array(output_block, shape[1:]), bounds,
+                         tile_halo(wavelet, levels, rule), wavelet, levels, precision, rule=rule)
+    finally:
+        sources_block.close()
+        output_block.close()
+
+def _get_executor(workers):
+    """Return the process pool for stripe fusion, started on first use"""
+    global _executor, _executor_workers
+    with _executor_lock:
+        if _executor is None or _executor_workers != workers:
+            if _executor is not None:
+                _executor.shutdown(wait=False)
+            _executor = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'))
+            _executor_workers = workers
+            # A process started by multiprocessing joins its children before
+            # atexit handlers run, so the pool must be shut down earlier than
+            # ProcessPoolExecutor would do it itself, and before the queue
+            # finalizers (priority 10) stop it from reaching its workers
+            multiprocessing.util.Finalize(_executor, _executor.shutdown, exitpriority=100)
+        return _executor
+
+def _reset_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is not None:
+            _executor.shutdown(wait=False, cancel_futures=True)
+        _executor = None
+
+def split_stripes(height, width, count, levels=1):
+    """Split an image into at most count full-width stripes
+
+    Stripe boundaries are multiples of 2**levels, as fuse_tile requires.
+    """
+    step = 2 ** levels
+    rows = max(-(-height // count), MIN_STRIPE_ROWS)
+    rows = -(-rows // step) * step
+    return [(y0, min(y0 + rows, height), 0, width) for y0 in range(0, height, rows)]
+
+def parallel_multi_image_dwt_fusion(images, wavelet='db4', levels=1, precision='float64', workers=None,
+                                    rule=DEFAULT_RULE):
+    """Fuse N equally sized images with several worker processes
+
+    The inputs are copied once into a shared memory stack and the image is
+    split into one halo-padded stripe per worker. Workers read their stripe
+    straight from the shared stack and write its interior into a shared
+    output, so no pixel data is pickled. The result is identical to
+    nway_dwt_fusion on the whole images for every fusion rule, windowed
+    ones included, see fusion_rules.box_mean.
+    """
+    if len(images) < 2:
+        logging.error("Need at least 2 images for fusion")
+        return None
+
+    workers = workers or os.cpu_count() or 1
+    height, width = images[0].shape
+    stripes = split_stripes(height, width, workers, levels)
+    if len(stripes) < 2:
+        return nway_dwt_fusion(images, wavelet, levels, precision, rule=rule)
+
+    shape = (len(images), height, width)
+    sources_block = shared_memory.SharedMemory(create=True, size=int(np.prod(shape)))
+    output_block = shared_memory.SharedMemory(create=True, size=height * width)
+    try:
+        _shared_array(sources_block, shape)[:] = images
+
+        executor = _get_executor(workers)
+        futures = [executor.submit(_fuse_stripe, sources_block.name, output_block.name, shape, bounds,
+                                   wavelet, levels, precision, rule)
+                   for bounds in stripes]
+        try:
+            if not all(future.result() for future in futures):
+                return None
+        except BrokenProcessPool:
+            logging.error("A stripe fusion worker died")
+            _reset_executor()
+            return None
+
+        # Copy the result out so the shared blocks can be released
+        return _shared_array(output_block, (height, width)).copy()
+    except Exception as e:
+        logging.error(f"Error in parallel DWT fusion: {str(e)}")
+        return None
+    finally:
+        sources_block.close()
+        sources_block.unlink()
+        output_block.close()
+        output_block.unlink()
@@ -0,0 +1,125 @@
+import os
+import time
+import uuid
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from flask import current_app
+from fusion_settings import target_size, PREVIEW_MAX_SIDE
+from profiling import StageTimer
+from metrics import FUSION_PREVIEW_SECONDS
+from session_locks import SessionLocks
+
+def preview_path(filename, config):
+    return os.path.join(config['RESULT_FOLDER'], filename)
+
+def replace_preview(fusion_session, filename, config):
+    """Point the session at a freshly written preview and delete the old one"""
+    from app import db
+
+    previous = fusion_session.preview_filename
+    fusion_session.preview_filename = filename
+    try:
+        db.session.commit()
+    except Exception:
+        # The session was deleted while the preview rendered
+        if filename:
+            os.remove(preview_path(filename, config))
+        raise
+    if previous and previous != filename and os.path.exists(preview_path(previous, config)):
+        os.remove(preview_path(previous, config))
+
+class PreviewWorker:
+    """Render low-resolution previews of queued fusions in the web process
+
+    A preview takes milliseconds, so it is rendered on a small thread pool
+    rather than waiting behind full-resolution jobs for a fusion worker.
+    Renders for the same session are serialized.
+    """
+
+    def __init__(self, app, max_workers):
+        self.app = app
+        self.max_workers = max_workers
+        self._lock = threading.Lock()
+        self._session_locks = SessionLocks()
+        self._executor = None
+        self._pid = None
+
+    def schedule(self, session_id):
+        with self._lock:
+            if self._pid != os.getpid():
+                self._pid = os.getpid()
+                self._session_locks = SessionLocks()
+                self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='fusion-preview')
+        self._executor.submit(self._preview_session, session_id, time.perf_counter())
+
+    def _preview_session(self, session_id, queued):
+        with self._session_locks.hold(session_id), self.app.app_context():
+            try:
+                self._render(session_id, queued)
+            except Exception as e:
+                logging.error(f"Error rendering preview for session {session_id}: {str(e)}")
+            finally:
+                from app import db
+                db.session.remove()
+
+    def _render(self, session_id, queued):
+        from app import db
+        from models import FusionSession
+        from fusion import process_preview
+
+        config = self.app.config
+        fusion_session = db.session.get(FusionSession, session_id)
+        if fusion_session is None or len(fusion_session.images) < 2:
+            return
+
+        images = list(fusion_session.images)
+        image_paths = [os.path.join(config['UPLOAD_FOLDER'], image.filename) for image in images]
+        options = fusion_session.fusion_options()
+
+        # The incremental fusion already rendered a preview of these very images
+        if fusion_session.preview_filename and config.get('INCREMENTAL_FUSION'):
+            from incremental import current_state_path
+            if current_state_path(fusion_session, config, target_size(image_paths), **options):
+                return
+
+        # Sessions large enough to be tiled are decoded one image at a time;
+        # the others use the coefficients precomputed at upload time if any
+        coefficients = None
+        max_workers = None
+        job = fusion_session.job
+        if job is not None and job.tile_size:
+            max_workers = 1
+        elif config.get('PRECOMPUTE_COEFFICIENTS'):
+            from ingest import coefficient_paths
+            coefficients = coefficient_paths(images, config, target_size(image_paths), **options)
+
+        filename = f"preview_{session_id}_{uuid.uuid4().hex}.jpg"
+        timer = StageTimer()
+        if not process_preview(image_paths, preview_path(filename, config), coefficients,
+                               options['wavelet'], options['levels'],
+                               config.get('PREVIEW_MAX_SIDE', PREVIEW_MAX_SIDE), max_workers, timer,
+                               fusion_session.rule):
+            logging.error(f"Failed to render preview for session {session_id}")
+            return
+
+        replace_preview(fusion_session, filename, config)
+
+        seconds = time.perf_counter() - queued
+        FUSION_PREVIEW_SECONDS.observe(seconds)
+        logging.info(f"Preview for session {session_id} ready in {seconds * 1000:.0f} ms "
+                     f"({'coefficients' if 'load' in timer.stages else 'decode'})")
+
+def schedule_preview(session_id):
+    """Queue a preview render for a session, if enabled"""
+    worker = current_app.extensions.get('fusion_previews')
+    if worker is not None:
+        worker.schedule(session_id)
+
+def init_app(app):
+    """Attach the preview renderer to the app"""
+    if not app.config.get('FUSION_PREVIEWS'):
+        return None
+    worker = PreviewWorker(app, app.config.get('PREVIEW_WORKERS', 2))
+    app.extensions['fusion_previews'] = worker
+    return worker
@@ -0,0 +1,75 @@
+import time
+import resource
+from contextlib import contextmanager, nullcontext
+
+class StageTimer:
+    """Record wall time per pipeline stage, plus input size and peak memory
+
+    Cheap enough to leave on: each stage costs two perf_counter calls, and
+    peak memory is the kernel's resident high-water mark, read once when
+    the run finishes. base memory is the resident size when the run
+    started, so peak minus base is what the run itself needed. Stages
+    entered more than once accumulate.
+    """
+
+    def __init__(self):
+        self.stages = {}
+        self.input_pixels = 0
+        self._start = time.perf_counter()
+        reset_peak_rss()
+        self.base_memory_bytes = rss_bytes()
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stages[name] = self.stages.get(name, 0.0) + time.perf_counter() - start
+
+    def as_dict(self):
+        return {
+            'stages': {name: round(seconds, 6) for name, seconds in self.stages.items()},
+            'total_seconds': round(time.perf_counter() - self._start, 6),
+            'input_pixels': self.input_pixels,
+            'peak_memory_bytes': peak_rss_bytes(),
+            'base_memory_bytes': self.base_memory_bytes
+        }
+
+def timed(timer, name):
+    """Time a block as stage name if a timer is given"""
+    if timer is None:
+        return nullcontext()
+    return timer.stage(name)
+
+def reset_peak_rss():
+    """Reset this process's peak RSS so the next reading covers one run
+
+    Only possible on Linux; elsewhere the peak covers the process lifetime.
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+def _proc_status_bytes(field):
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith(field):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+def peak_rss_bytes():
+    """Peak resident set size of this process in bytes"""
+    peak = _proc_status_bytes('VmHWM:')
+    if peak is None:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    return peak
+
+def rss_bytes():
+    """Current resident set size of this process in bytes, or 0 if unknown"""
+    return _proc_status_bytes('VmRSS:') or 0
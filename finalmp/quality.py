@@ -0,0 +1,138 @@
+"""Objective quality metrics of a fused image
+
+No-reference metrics describe the fused image alone: entropy, spatial
+frequency and average gradient, higher meaning more information and
+sharper detail. Reference metrics compare it with every source: mutual
+information, summed over the sources, and SSIM, averaged over them.
+
+Every metric is a few whole-array passes: histograms come from
+cv2.calcHist, differences from array slicing, and the SSIM statistics
+from separable Gaussian filters. The fused image's own statistics are
+computed once and shared by all sources. Images are 8-bit gray, or the
+luma of color fusions.
+"""
+import numpy as np
+import cv2
+from fusion_settings import QUALITY_METRICS
+
+# Gaussian window of Wang et al., with the usual constants for 8-bit data
+SSIM_WINDOW = 11
+SSIM_SIGMA = 1.5
+SSIM_C1 = (0.01 * 255) ** 2
+SSIM_C2 = (0.03 * 255) ** 2
+
+def histogram_entropy(histogram):
+    """Shannon entropy in bits of a histogram of any shape"""
+    p = histogram[histogram > 0].astype(np.float64) / histogram.sum(dtype=np.float64)
+    return float(-(p * np.log2(p)).sum())
+
+def gray_histogram(image):
+    return cv2.calcHist([np.ascontiguousarray(image)], [0], None, [256], [0, 256]).ravel()
+
+def entropy(image):
+    return histogram_entropy(gray_histogram(image))
+
+def gradients(image):
+    """Forward differences along rows and columns as float32"""
+    image = image.astype(np.float32)
+    return image[:, 1:] - image[:, :-1], image[1:, :] - image[:-1, :]
+
+def spatial_frequency(image, dx=None, dy=None):
+    """Root of the summed mean squared row and column differences"""
+    if dx is None:
+        dx, dy = gradients(image)
+    row = np.square(dx).mean(dtype=np.float64)
+    column = np.square(dy).mean(dtype=np.float64)
+    return float(np.sqrt(row + column))
+
+def average_gradient(image, dx=None, dy=None):
+    """Mean of sqrt((dx^2 + dy^2) / 2) over the pixels with both differences"""
+    if dx is None:
+        dx, dy = gradients(image)
+    dx, dy = dx[:-1, :], dy[:, :-1]
+    magnitude = np.square(dx)
+    magnitude += np.square(dy)
+    magnitude *= 0.5
+    return float(np.sqrt(magnitude, out=magnitude).mean(dtype=np.float64))
+
+def mutual_information(source, fused, fused_entropy=None):
+    """Mutual information in bits, from the joint 256x256 histogram
+
+    I(A; F) = H(A) + H(F) - H(A, F).
+    """
+    joint = cv2.calcHist([np.ascontiguousarray(source), np.ascontiguousarray(fused)], [0, 1], None,
+                         [256, 256], [0, 256, 0, 256])
+    if fused_entropy is None:
+        fused_entropy = histogram_entropy(joint.sum(axis=0))
+    return histogram_entropy(joint.sum(axis=1)) + fused_entropy - histogram_entropy(joint)
+
+def _blur(image):
+    return cv2.GaussianBlur(image, (SSIM_WINDOW, SSIM_WINDOW), SSIM_SIGMA, borderType=cv2.BORDER_REFLECT)
+
+class SSIMReference:
+    """Local statistics of one image, reused to compare it with many others
+
+    The terms of the SSIM formula that depend on this image alone are kept
+    too, so each comparison costs three filters and a few in-place passes.
+    """
+
+    def __init__(self, image):
+        self.image = image.astype(np.float32)
+        self.mean = _blur(self.image)
+        square_mean = np.square(self.mean)
+        self.luminance = square_mean + SSIM_C1
+        self.contrast = _blur(np.square(self.image)) - square_mean + SSIM_C2
+        self.double_mean = 2 * self.mean
+
+    def ssim(self, other):
+        """Mean SSIM between the reference and another image of its size"""
+        other = other.astype(np.float32)
+        mean = _blur(other)
+        covariance = _blur(np.multiply(other, self.image))
+        contrast = _blur(np.square(other, out=other))
+        del other
+
+        # Denominator: (mean^2 + mean_ref^2 + C1) * (var + var_ref + C2)
+        denominator = np.square(mean)
+        contrast -= denominator
+        contrast += self.contrast
+        denominator += self.luminance
+        denominator *= contrast
+
+        # Numerator: (2 mean mean_ref + C1) * (2 cov + C2)
+        numerator = np.multiply(mean, self.double_mean, out=contrast)
+        numerator += SSIM_C1
+        np.multiply(mean, self.mean, out=mean)
+        covariance -= mean
+        covariance *= 2
+        covariance += SSIM_C2
+        numerator *= covariance
+
+        numerator /= denominator
+        return float(numerator.mean(dtype=np.float64))
+
+def ssim(a, b):
+    return SSIMReference(a).ssim(b)
+
+def fusion_quality(fused, sources=None):
+    """Return QUALITY_METRICS of a fused image, as a dict of floats
+
+    sources are the inputs at the fused size; without them only the
+    no-reference metrics are computed.
+    """
+    dx, dy = gradients(fused)
+    metrics = {
+        'entropy': entropy(fused),
+        'spatial_frequency': spatial_frequency(fused, dx, dy),
+        'average_gradient': average_gradient(fused, dx, dy)
+    }
+    del dx, dy
+
+    if sources is not None and len(sources):
+        fused_entropy = metrics['entropy']
+        reference = SSIMReference(fused)
+        metrics['mutual_information'] = sum(mutual_information(source, fused, fused_entropy)
+                                            for source in sources)
+        metrics['ssim'] = sum(reference.ssim(source) for source in sources) / len(sources)
+
+    return {name: round(metrics[name], 6) for name in QUALITY_METRICS if name in metrics}
@@ -0,0 +1,153 @@
+import os
+import json
+import hashlib
+import logging
+from datetime import datetime
+from flask import current_app
+from app import db
+from models import ResultCacheEntry
+from encoders import rendition_filenames
+
+HASH_CHUNK_SIZE = 1024 * 1024
+
+def file_content_hash(path):
+    """Return the SHA-256 hex digest of a file, read in chunks"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def image_content_hash(image):
+    """Return the content hash of an UploadedImage, computing it if missing"""
+    if not image.content_hash:
+        path = os.path.join(current_app.config['UPLOAD_FOLDER'], image.filename)
+        image.content_hash = file_content_hash(path)
+    return image.content_hash
+
+def fusion_cache_key(images, parameters):
+    """Build the cache key for fusing images with the given parameters
+
+    The input hashes are sorted because the fusion rules do not depend on
+    the order of the images.
+    """
+    payload = json.dumps({
+        'inputs': sorted(image_content_hash(image) for image in images),
+        'parameters': parameters
+    }, sort_keys=True)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+def result_filename_for_key(cache_key, extension='png'):
+    return f"fusion_{cache_key}.{extension}"
+
+def _result_path(filename):
+    return os.path.join(current_app.config['RESULT_FOLDER'], filename)
+
+def _result_files(filename):
+    """A result file followed by its renditions"""
+    return [filename] + rendition_filenames(filename)
+
+def _remove_result_files(filename):
+    for name in _result_files(filename):
+        path = _result_path(name)
+        if os.path.exists(path):
+            os.remove(path)
+
+def lookup_result(cache_key):
+    """Return the cache entry for a key, or None if it is missing or stale"""
+    entry = ResultCacheEntry.query.filter_by(cache_key=cache_key).first()
+    if entry is None:
+        return None
+
+    if not os.path.exists(_result_path(entry.filename)):
+        logging.warning(f"Dropping cache entry {cache_key} with missing file")
+        db.session.delete(entry)
+        db.session.flush()
+        return None
+
+    return entry
+
+def acquire_result(entry):
+    """Add a session reference to a cache entry and mark it recently used"""
+    ResultCacheEntry.query.filter_by(id=entry.id).update({
+        'ref_count': ResultCacheEntry.ref_count + 1,
+        'last_used_at': datetime.utcnow()
+    })
+    return entry.filename
+
+def store_result(cache_key, path, quality_metrics=None):
+    """Move a freshly computed result into the cache and reference it
+
+    Renditions written next to the result move with it, and the result's
+    quality metrics (JSON) are kept with the entry for later hits. If
+    another job stored the same key first, the new files are discarded in
+    favour of the existing ones. Returns the cached filename.
+    """
+    entry = lookup_result(cache_key)
+    if entry is not None:
+        _remove_result_files(os.path.basename(path))
+        return acquire_result(entry)
+
+    filename = result_filename_for_key(cache_key, path.rsplit('.', 1)[-1])
+    size_bytes = 0
+    for source, target in zip(_result_files(os.path.basename(path)), _result_files(filename)):
+        if os.path.exists(_result_path(source)):
+            os.replace(_result_path(source), _result_path(target))
+            size_bytes += os.path.getsize(_result_path(target))
+    entry = ResultCacheEntry(
+        cache_key=cache_key,
+        filename=filename,
+        size_bytes=size_bytes,
+        ref_count=0,
+        quality_metrics=quality_metrics
+    )
+    db.session.add(entry)
+    db.session.flush()
+    return acquire_result(entry)
+
+def release_result(filename):
+    """Drop one session reference to a result file
+
+    Cached files stay on disk after their last reference goes, so a re-run
+    of the same inputs is still a hit, until evict_results removes them.
+    Results that were never cached are deleted straight away.
+    """
+    if not filename:
+        return
+
+    entry = ResultCacheEntry.query.filter_by(filename=filename).first()
+    if entry is None:
+        _remove_result_files(filename)
+        return
+
+    ResultCacheEntry.query.filter(ResultCacheEntry.id == entry.id, ResultCacheEntry.ref_count > 0).update({
+        'ref_count': ResultCacheEntry.ref_count - 1
+    })
+
+def evict_results(max_bytes=None):
+    """Evict unreferenced cache entries, least recently used first
+
+    Entries still referenced by a session are never evicted, so the cache
+    can exceed its bound while every entry is in use.
+    """
+    if max_bytes is None:
+        max_bytes = current_app.config['RESULT_CACHE_MAX_BYTES']
+
+    total = db.session.query(db.func.coalesce(db.func.sum(ResultCacheEntry.size_bytes), 0)).scalar()
+    if total <= max_bytes:
+        return 0
+
+    evicted = 0
+    candidates = ResultCacheEntry.query.filter(ResultCacheEntry.ref_count <= 0) \
+        .order_by(ResultCacheEntry.last_used_at).all()
+    for entry in candidates:
+        if total <= max_bytes:
+            break
+        _remove_result_files(entry.filename)
+        total -= entry.size_bytes or 0
+        db.session.delete(entry)
+        evicted += 1
+
+    if evicted:
+        logging.info(f"Evicted {evicted} cached results")
+    return evicted
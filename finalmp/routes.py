@@ -1,25 +1,51 @@
 import os
 import uuid
 from datetime import datetime
-from flask import render_template, request, redirect, url_for, flash, jsonify, send_file, current_app
+from flask import render_template, request, redirect, url_for, flash, jsonify, send_file, current_app, Response, abort
 from flask_login import login_user, logout_user, login_required, current_user
 from werkzeug.utils import secure_filename
-from app import app, db
-from models import User, FusionSession, UploadedImage
-from fusion import process_fusion
+from app import db
+from models import User, FusionSession, UploadedImage, FusionJob, ChunkedUpload
+from fusion_settings import (fusion_parameters, target_size, needs_tiling, estimate_fusion_memory, SUPPORTED_WAVELETS,
+                             MAX_LEVELS, PRECISIONS, COLOR_MODES, QUALITY_METRICS)
+from fusion_rules import RULES, get_rule
+from encoders import result_encoding, result_mimetype, ensure_rendition, RENDITIONS
+from jobs import enqueue_fusion_job, memory_budget, memory_reserved
+from ingest import schedule_ingest
+from previews import schedule_preview, preview_path
+from result_cache import file_content_hash, fusion_cache_key, lookup_result, acquire_result, release_result
+from uploads import (UploadError, UPLOAD_CHUNK_SIZE, reserve_image_slots, release_image_slots, create_uploads,
+                     append_chunk, finalize_upload, abort_upload)
+from storage import remove_session, schedule_deletion, image_files, quota_exceeded, storage_usage
+import metrics
 import logging
 
+# Views recorded by @route and added to an app by init_app, keeping the
+# plain endpoint names templates and metrics labels use
+_views = []
+
+def route(rule, **options):
+    def decorator(view):
+        _views.append((rule, view, options))
+        return view
+    return decorator
+
+def init_app(app):
+    """Register every view on an app made by create_app"""
+    for rule, view, options in _views:
+        app.add_url_rule(rule, view_func=view, **options)
+
 def allowed_file(filename):
     return '.' in filename and \
            filename.rsplit('.', 1)[1].lower() in current_app.config['ALLOWED_EXTENSIONS']
 
-@app.route('/')
+@route('/')
 def index():
     if current_user.is_authenticated:
         return redirect(url_for('dashboard'))
     return render_template('index.html')
 
-@app.route('/register', methods=['GET', 'POST'])
+@route('/register', methods=['GET', 'POST'])
 def register():
     if current_user.is_authenticated:
         return redirect(url_for('dashboard'))
@@ -63,7 +89,7 @@ def register():
     
     return render_template('register.html')
 
-@app.route('/login', methods=['GET', 'POST'])
+@route('/login', methods=['GET', 'POST'])
 def login():
     if current_user.is_authenticated:
         return redirect(url_for('dashboard'))
@@ -84,48 +110,121 @@ def login():
     
     return render_template('login.html')
 
-@app.route('/logout')
+@route('/logout')
 @login_required
 def logout():
     logout_user()
     flash('Logged out successfully!', 'success')
     return redirect(url_for('index'))
 
-@app.route('/dashboard')
+@route('/dashboard')
 @login_required
 def dashboard():
-    fusion_sessions = FusionSession.query.filter_by(user_id=current_user.id).order_by(FusionSession.created_at.desc()).all()
-    return render_template('dashboard.html', fusion_sessions=fusion_sessions)
+    page_size = current_app.config.get('DASHBOARD_PAGE_SIZE', 20)
+    after = request.args.get('after', type=int)
+    before = request.args.get('before', type=int)
+    
+    # Image counts come from an aggregate per listed row, not from loading images
+    image_count = db.select(db.func.count(UploadedImage.id)) \
+        .where(UploadedImage.fusion_session_id == FusionSession.id) \
+        .correlate(FusionSession).scalar_subquery()
+    query = db.session.query(FusionSession, image_count.label('image_count')) \
+        .filter(FusionSession.user_id == current_user.id)
+    
+    # Keyset pagination on (created_at, id): a page starts next to the session
+    # named by after (older) or before (newer), so each page costs the same
+    # however long the history is
+    anchor = None
+    if after or before:
+        anchor = db.session.query(FusionSession.created_at, FusionSession.id) \
+            .filter_by(id=after or before, user_id=current_user.id).first()
+    
+    if anchor is not None and before:
+        query = query.filter(FusionSession.created_at >= anchor.created_at,
+                             db.or_(FusionSession.created_at > anchor.created_at, FusionSession.id > anchor.id)) \
+            .order_by(FusionSession.created_at, FusionSession.id)
+    else:
+        if anchor is not None:
+            query = query.filter(FusionSession.created_at <= anchor.created_at,
+                                 db.or_(FusionSession.created_at < anchor.created_at, FusionSession.id < anchor.id))
+        query = query.order_by(FusionSession.created_at.desc(), FusionSession.id.desc())
+    
+    rows = query.limit(page_size + 1).all()
+    has_more = len(rows) > page_size
+    rows = rows[:page_size]
+    if anchor is not None and before:
+        rows.reverse()
+        has_newer, has_older = has_more, True
+    else:
+        has_newer, has_older = anchor is not None, has_more
+    
+    status_counts = dict(db.session.query(FusionSession.status, db.func.count(FusionSession.id))
+                         .filter(FusionSession.user_id == current_user.id)
+                         .group_by(FusionSession.status).all())
+    
+    return render_template('dashboard.html', fusion_sessions=rows, status_counts=status_counts,
+                           total_sessions=sum(status_counts.values()), storage=storage_usage(current_user.id),
+                           newer_cursor=rows[0][0].id if rows and has_newer else None,
+                           older_cursor=rows[-1][0].id if rows and has_older else None)
 
-@app.route('/fusion', methods=['GET', 'POST'])
+@route('/fusion', methods=['GET', 'POST'])
 @login_required
 def fusion():
     if request.method == 'POST':
         session_name = request.form['session_name']
-        num_images = int(request.form['num_images'])
+        num_images = form_int('num_images')
+        wavelet = request.form.get('wavelet', 'db4')
+        levels = form_int('levels', 1)
+        precision = request.form.get('precision', 'float64')
+        color_mode = request.form.get('color_mode', 'gray')
+        fusion_rule = request.form.get('fusion_rule', 'max_abs')
         
         if not session_name:
             flash('Session name is required.', 'error')
-            return render_template('fusion.html')
+            return render_fusion_form(), 400
         
-        if num_images < 2 or num_images > 10:
+        if num_images is None or num_images < 2 or num_images > 10:
             flash('Number of images must be between 2 and 10.', 'error')
-            return render_template('fusion.html')
+            return render_fusion_form(), 400
+        
+        if (wavelet not in SUPPORTED_WAVELETS or levels is None or levels < 1 or levels > MAX_LEVELS
+                or precision not in PRECISIONS or color_mode not in COLOR_MODES or fusion_rule not in RULES):
+            flash('Invalid wavelet settings.', 'error')
+            return render_fusion_form(), 400
         
         # Create fusion session
         fusion_session = FusionSession(
             user_id=current_user.id,
             session_name=session_name,
-            num_images=num_images
+            num_images=num_images,
+            wavelet=wavelet,
+            levels=levels,
+            precision=precision,
+            color_mode=color_mode,
+            fusion_rule=fusion_rule
         )
         db.session.add(fusion_session)
         db.session.commit()
         
         return redirect(url_for('upload_images', session_id=fusion_session.id))
     
-    return render_template('fusion.html')
+    return render_fusion_form()
 
-@app.route('/upload/<int:session_id>')
+def form_int(name, default=None):
+    """An integer form field: default when it is missing, None when it is not a number"""
+    value = request.form.get(name)
+    if value is None:
+        return default
+    try:
+        return int(value)
+    except ValueError:
+        return None
+
+def render_fusion_form():
+    return render_template('fusion.html', wavelets=SUPPORTED_WAVELETS, max_levels=MAX_LEVELS,
+                           rules=list(RULES.values()))
+
+@route('/upload/<int:session_id>')
 @login_required
 def upload_images(session_id):
     fusion_session = FusionSession.query.get_or_404(session_id)
@@ -137,7 +236,7 @@ def upload_images(session_id):
     
     return render_template('upload.html', fusion_session=fusion_session)
 
-@app.route('/upload_file/<int:session_id>', methods=['POST'])
+@route('/upload_file/<int:session_id>', methods=['POST'])
 @login_required
 def upload_file(session_id):
     fusion_session = FusionSession.query.get_or_404(session_id)
@@ -154,10 +253,11 @@ def upload_file(session_id):
         return jsonify({'error': 'No file selected'}), 400
     
     if file and allowed_file(file.filename):
-        # Check if we already have enough images
-        current_count = len(fusion_session.images)
-        if current_count >= fusion_session.num_images:
+        # Claim a slot first, so parallel uploads cannot overfill the session
+        if not reserve_image_slots(fusion_session):
+            db.session.rollback()
             return jsonify({'error': 'Maximum number of images reached'}), 400
+        db.session.commit()
         
         # Generate unique filename
         filename = str(uuid.uuid4()) + '.' + file.filename.rsplit('.', 1)[1].lower()
@@ -167,31 +267,172 @@ def upload_file(session_id):
             file.save(filepath)
             file_size = os.path.getsize(filepath)
             
+            # The size is only known once saved, so the quota is checked here
+            usage = quota_exceeded(current_user.id, file_size)
+            if usage:
+                schedule_deletion([filepath], 'rejected')
+                release_image_slots(session_id)
+                db.session.commit()
+                return jsonify({'error': 'Storage quota exceeded', **usage}), 413
+            
             # Save to database
             uploaded_image = UploadedImage(
                 fusion_session_id=session_id,
                 filename=filename,
                 original_filename=file.filename,
-                file_size=file_size
+                file_size=file_size,
+                content_hash=file_content_hash(filepath)
             )
             db.session.add(uploaded_image)
             db.session.commit()
             
+            # Start decoding and decomposing while the user keeps uploading
+            schedule_ingest(session_id)
+            
             return jsonify({
                 'success': True,
                 'filename': filename,
                 'original_filename': file.filename,
-                'current_count': current_count + 1,
+                'current_count': UploadedImage.query.filter_by(fusion_session_id=session_id).count(),
                 'total_needed': fusion_session.num_images
             })
         
         except Exception as e:
             logging.error(f"Error uploading file: {str(e)}")
+            db.session.rollback()
+            release_image_slots(session_id)
+            db.session.commit()
+            schedule_deletion([filepath], 'rejected')
             return jsonify({'error': 'Error uploading file'}), 500
     
     return jsonify({'error': 'Invalid file type'}), 400
 
-@app.route('/process_fusion/<int:session_id>', methods=['POST'])
+def chunked_upload_state(upload):
+    return {
+        'upload_id': upload.id,
+        'original_filename': upload.original_filename,
+        'total_size': upload.total_size,
+        'received_bytes': upload.received_bytes,
+        'chunk_url': url_for('upload_chunk', upload_id=upload.id),
+        'status_url': url_for('upload_status', upload_id=upload.id),
+        'finalize_url': url_for('upload_finalize', upload_id=upload.id),
+        'abort_url': url_for('upload_abort', upload_id=upload.id)
+    }
+
+def get_chunked_upload(upload_id):
+    """Load a chunked upload of the current user, or abort with 404"""
+    upload = ChunkedUpload.query.get_or_404(upload_id)
+    if upload.fusion_session.user_id != current_user.id:
+        abort(404)
+    return upload
+
+@route('/upload_init/<int:session_id>', methods=['POST'])
+@login_required
+def upload_init(session_id):
+    fusion_session = FusionSession.query.get_or_404(session_id)
+    
+    # Check if user owns this session
+    if fusion_session.user_id != current_user.id:
+        return jsonify({'error': 'Unauthorized access'}), 403
+    
+    files = (request.get_json(silent=True) or {}).get('files')
+    if not files or not isinstance(files, list):
+        return jsonify({'error': 'No file selected'}), 400
+    
+    try:
+        uploads = create_uploads(fusion_session, files)
+        db.session.commit()
+    except UploadError as e:
+        db.session.rollback()
+        return jsonify({'error': str(e), **e.details}), e.status
+    
+    return jsonify({
+        'success': True,
+        'chunk_size': UPLOAD_CHUNK_SIZE,
+        'uploads': [chunked_upload_state(upload) for upload in uploads]
+    })
+
+@route('/upload_chunk/<upload_id>', methods=['PUT'])
+@login_required
+def upload_chunk(upload_id):
+    upload = get_chunked_upload(upload_id)
+    offset = request.args.get('offset', type=int)
+    if offset is None:
+        return jsonify({'error': 'Missing offset'}), 400
+    
+    try:
+        received = append_chunk(upload, offset, request.stream)
+        db.session.commit()
+    except UploadError as e:
+        db.session.rollback()
+        return jsonify({'error': str(e), **e.details}), e.status
+    
+    return jsonify({'success': True, 'received_bytes': received, 'total_size': upload.total_size})
+
+@route('/upload_status/<upload_id>')
+@login_required
+def upload_status(upload_id):
+    return jsonify(chunked_upload_state(get_chunked_upload(upload_id)))
+
+@route('/upload_finalize/<upload_id>', methods=['POST'])
+@login_required
+def upload_finalize(upload_id):
+    upload = get_chunked_upload(upload_id)
+    fusion_session = upload.fusion_session
+    
+    try:
+        image = finalize_upload(upload)
+        db.session.commit()
+    except UploadError as e:
+        db.session.rollback()
+        return jsonify({'error': str(e), **e.details}), e.status
+    
+    schedule_ingest(fusion_session.id)
+    
+    return jsonify({
+        'success': True,
+        'filename': image.filename,
+        'original_filename': image.original_filename,
+        'current_count': UploadedImage.query.filter_by(fusion_session_id=fusion_session.id).count(),
+        'total_needed': fusion_session.num_images
+    })
+
+@route('/upload_abort/<upload_id>', methods=['POST'])
+@login_required
+def upload_abort(upload_id):
+    abort_upload(get_chunked_upload(upload_id))
+    db.session.commit()
+    return jsonify({'success': True})
+
+@route('/remove_image/<int:image_id>', methods=['POST'])
+@login_required
+def remove_image(image_id):
+    image = UploadedImage.query.get_or_404(image_id)
+    fusion_session = image.fusion_session
+    
+    # Check if user owns this session
+    if fusion_session.user_id != current_user.id:
+        return jsonify({'error': 'Unauthorized access'}), 403
+    
+    if fusion_session.job is not None and fusion_session.job.status in ('queued', 'running'):
+        return jsonify({'error': 'Fusion is already in progress'}), 409
+    
+    paths = image_files(image, current_app.config)
+    db.session.delete(image)
+    release_image_slots(fusion_session.id)
+    db.session.commit()
+    schedule_deletion(paths, 'removed')
+    
+    # The running fusion no longer matches the images and is rebuilt
+    schedule_ingest(fusion_session.id)
+    
+    return jsonify({
+        'success': True,
+        'current_count': UploadedImage.query.filter_by(fusion_session_id=fusion_session.id).count(),
+        'total_needed': fusion_session.num_images
+    })
+
+@route('/process_fusion/<int:session_id>', methods=['POST'])
 @login_required
 def process_fusion_route(session_id):
     fusion_session = FusionSession.query.get_or_404(session_id)
@@ -205,41 +446,150 @@ def process_fusion_route(session_id):
         return jsonify({'error': 'Not enough images uploaded'}), 400
     
     try:
-        # Update status to processing
-        fusion_session.status = 'processing'
-        db.session.commit()
-        
-        # Process fusion
         image_paths = [os.path.join(current_app.config['UPLOAD_FOLDER'], img.filename) 
                       for img in fusion_session.images]
         
-        result_filename = f"fusion_{session_id}_{uuid.uuid4().hex}.png"
-        result_path = os.path.join(current_app.config['RESULT_FOLDER'], result_filename)
+        tile_size = None
+        if needs_tiling(image_paths, current_app.config['TILED_FUSION_MIN_PIXELS']):
+            tile_size = current_app.config['FUSION_TILE_SIZE']
         
-        success = process_fusion(image_paths, result_path)
+        if fusion_session.job is not None and fusion_session.job.status in ('queued', 'running'):
+            return jsonify({'error': 'Fusion is already in progress'}), 409
         
-        if success:
-            fusion_session.status = 'completed'
-            fusion_session.result_filename = result_filename
-            fusion_session.completed_at = datetime.utcnow()
+        # Admission control: estimate the peak memory from the image headers;
+        # a fusion over the memory budget is tiled, and refused if even
+        # that does not fit
+        options = fusion_session.fusion_options()
+        budget = memory_budget(current_app.config)
+        quality = current_app.config.get('QUALITY_METRICS', False)
+        estimate = estimate_fusion_memory(image_paths, options['precision'], tile_size,
+                                          options['wavelet'], options['levels'], fusion_session.color,
+                                          fusion_session.rule, quality)
+        if budget and estimate > budget and tile_size is None:
+            tile_size = current_app.config['FUSION_TILE_SIZE']
+            estimate = estimate_fusion_memory(image_paths, options['precision'], tile_size,
+                                              options['wavelet'], options['levels'], fusion_session.color,
+                                              fusion_session.rule, quality)
+        if budget and estimate > budget:
+            metrics.FUSION_ADMISSIONS.inc(decision='too_large')
+            return jsonify({
+                'success': False,
+                'admission': 'too_large',
+                'error': f"These images are too large to fuse: about {estimate >> 20} MB of memory is needed "
+                         f"and at most {budget >> 20} MB is available",
+                'estimated_memory_bytes': estimate,
+                'memory_budget_bytes': budget
+            }), 413
+        
+        # Reuse a stored result for the same inputs and parameters
+        parameters = fusion_parameters(tiled=tile_size is not None, color=fusion_session.color,
+                                       rule=fusion_session.rule, **options,
+                                       **result_encoding(current_app.config, target_size(image_paths)))
+        cache_key = fusion_cache_key(fusion_session.images, parameters)
+        entry = lookup_result(cache_key)
+        if entry is not None:
+            previous_result = fusion_session.result_filename
+            if not FusionSession.transition(session_id, 'completed', result_filename=entry.filename,
+                                            completed_at=datetime.utcnow(),
+                                            quality_metrics=entry.quality_metrics):
+                db.session.rollback()
+                return jsonify({'error': 'Fusion is already in progress'}), 409
+            if previous_result != entry.filename:
+                release_result(previous_result)
+                acquire_result(entry)
             db.session.commit()
+            metrics.FUSION_CACHE_HITS.inc()
+            if not fusion_session.preview_filename:
+                schedule_preview(session_id)
             
             return jsonify({
                 'success': True,
+                'cached': True,
+                'status': fusion_session.status,
+                'status_url': url_for('fusion_status', session_id=session_id),
                 'result_url': url_for('view_result', session_id=session_id)
             })
-        else:
-            fusion_session.status = 'failed'
-            db.session.commit()
-            return jsonify({'error': 'Fusion processing failed'}), 500
+        
+        # Queue the fusion for a background worker; it starts once the
+        # jobs ahead of it leave enough of the memory budget
+        reserved = memory_reserved(('queued', 'running'))
+        job = enqueue_fusion_job(fusion_session, tile_size=tile_size, cache_key=cache_key, estimated_memory=estimate)
+        if job is None:
+            return jsonify({'error': 'Fusion is already in progress'}), 409
+        db.session.commit()
+        admission = 'queued' if budget and reserved and reserved + estimate > budget else 'admitted'
+        metrics.FUSION_ADMISSIONS.inc(decision=admission)
+        
+        # Show a low-resolution result while the full one is computed
+        schedule_preview(session_id)
+        
+        return jsonify({
+            'success': True,
+            'admission': admission,
+            'estimated_memory_bytes': estimate,
+            'status': fusion_session.status,
+            'status_url': url_for('fusion_status', session_id=session_id),
+            'result_url': url_for('view_result', session_id=session_id)
+        }), 202
     
     except Exception as e:
-        logging.error(f"Error processing fusion: {str(e)}")
-        fusion_session.status = 'failed'
-        db.session.commit()
+        logging.error(f"Error queueing fusion: {str(e)}")
+        db.session.rollback()
         return jsonify({'error': 'Error processing fusion'}), 500
 
-@app.route('/result/<int:session_id>')
+@route('/status/<int:session_id>')
+@login_required
+def fusion_status(session_id):
+    fusion_session = FusionSession.query.get_or_404(session_id)
+    
+    # Check if user owns this session
+    if fusion_session.user_id != current_user.id:
+        return jsonify({'error': 'Unauthorized access'}), 403
+    
+    response = {
+        'status': fusion_session.status,
+        'stage': fusion_session.status,
+        'progress': 100 if fusion_session.status == 'completed' else 0
+    }
+    
+    job = fusion_session.job
+    if job is not None:
+        response['job_status'] = job.status
+        response['stage'] = job.stage
+        response['progress'] = job.progress
+        if job.status == 'failed':
+            response['error'] = job.error
+        if job.stage_timings:
+            response['timings'] = job.stage_timing_dict()
+        if job.estimated_memory_bytes:
+            response['estimated_memory_bytes'] = job.estimated_memory_bytes
+        if job.used_memory_bytes:
+            response['used_memory_bytes'] = job.used_memory_bytes
+    
+    if fusion_session.preview_filename:
+        response['preview_url'] = url_for('fusion_preview', session_id=session_id,
+                                          v=fusion_session.preview_filename)
+    
+    # The result page can show the preview until the full result is done
+    if fusion_session.status == 'completed' or fusion_session.preview_filename:
+        response['result_url'] = url_for('view_result', session_id=session_id)
+    
+    return jsonify(response)
+
+@route('/metrics')
+def metrics_endpoint():
+    # Queue depth is shared by all processes, so it is read at scrape time
+    counts = dict(db.session.query(FusionJob.status, db.func.count(FusionJob.id))
+                  .filter(FusionJob.status.in_(['queued', 'running']))
+                  .group_by(FusionJob.status).all())
+    for status in ('queued', 'running'):
+        metrics.FUSION_QUEUE_DEPTH.set(counts.get(status, 0), status=status)
+    metrics.FUSION_MEMORY_RESERVED.set(memory_reserved())
+    metrics.FUSION_MEMORY_BUDGET.set(memory_budget(current_app.config) or 0)
+    
+    return Response(metrics.REGISTRY.render(), content_type=metrics.CONTENT_TYPE)
+
+@route('/result/<int:session_id>')
 @login_required
 def view_result(session_id):
     fusion_session = FusionSession.query.get_or_404(session_id)
@@ -249,13 +599,78 @@ def view_result(session_id):
         flash('Unauthorized access.', 'error')
         return redirect(url_for('dashboard'))
     
-    if fusion_session.status != 'completed':
+    # A running fusion is shown as its preview until it completes
+    refining = fusion_session.status == 'processing' and fusion_session.preview_filename
+    if fusion_session.status != 'completed' and not refining:
         flash('Fusion not completed yet.', 'error')
         return redirect(url_for('dashboard'))
     
-    return render_template('result.html', fusion_session=fusion_session)
+    quality = fusion_session.quality_dict()
+    quality = [(label, quality[name]) for name, label in QUALITY_METRICS.items() if name in quality]
+    return render_template('result.html', fusion_session=fusion_session, detail_rule=get_rule(fusion_session.rule),
+                           quality=quality)
+
+def send_result_file(path, mimetype, versioned=False, **kwargs):
+    """Send a result file with validators, conditional GET and Range support
+
+    Result files are never rewritten in place, so a URL that names the
+    current file (versioned) may be cached for good; other URLs must be
+    revalidated, which their ETag makes cheap.
+    """
+    response = send_file(os.path.abspath(path), mimetype=mimetype, conditional=True, etag=True,
+                         max_age=31536000 if versioned else 0, **kwargs)
+    response.cache_control.public = False
+    response.cache_control.private = True
+    if versioned:
+        response.cache_control.immutable = True
+    else:
+        response.cache_control.no_cache = True
+    return response
+
+@route('/results/<int:session_id>', defaults={'rendition': 'full'})
+@route('/results/<int:session_id>/<rendition>')
+@login_required
+def result_file(session_id, rendition):
+    fusion_session = FusionSession.query.get_or_404(session_id)
+    
+    # Check if user owns this session
+    if fusion_session.user_id != current_user.id:
+        abort(403)
+    
+    if rendition != 'full' and rendition not in RENDITIONS:
+        abort(404)
+    if fusion_session.status != 'completed' or not fusion_session.result_filename:
+        abort(404)
+    
+    path = os.path.join(current_app.config['RESULT_FOLDER'], fusion_session.result_filename)
+    if not os.path.exists(path):
+        abort(404)
+    if rendition != 'full':
+        path = ensure_rendition(path, rendition)
+    
+    # Links carry the result file name, so a new result gets a new URL
+    return send_result_file(path, result_mimetype(path), request.args.get('v') == fusion_session.result_filename)
 
-@app.route('/download/<int:session_id>')
+@route('/preview/<int:session_id>')
+@login_required
+def fusion_preview(session_id):
+    fusion_session = FusionSession.query.get_or_404(session_id)
+    
+    # Check if user owns this session
+    if fusion_session.user_id != current_user.id:
+        abort(403)
+    
+    if not fusion_session.preview_filename:
+        abort(404)
+    
+    path = preview_path(fusion_session.preview_filename, current_app.config)
+    if not os.path.exists(path):
+        abort(404)
+    
+    # Preview URLs carry the file name, so a new preview gets a new URL
+    return send_result_file(path, 'image/jpeg', request.args.get('v') == fusion_session.preview_filename)
+
+@route('/download/<int:session_id>')
 @login_required
 def download_result(session_id):
     fusion_session = FusionSession.query.get_or_404(session_id)
@@ -275,18 +690,19 @@ def download_result(session_id):
         flash('Result file not found.', 'error')
         return redirect(url_for('dashboard'))
     
-    return send_file(result_path, as_attachment=True, 
-                    download_name=f"{fusion_session.session_name}_fused.png")
+    extension = fusion_session.result_filename.rsplit('.', 1)[-1]
+    return send_result_file(result_path, result_mimetype(result_path), as_attachment=True,
+                            download_name=f"{fusion_session.session_name}_fused.{extension}")
 
-@app.route('/about')
+@route('/about')
 def about():
     return render_template('about.html')
 
-@app.route('/services')
+@route('/services')
 def services():
     return render_template('services.html')
 
-@app.route('/delete_session/<int:session_id>', methods=['POST'])
+@route('/delete_session/<int:session_id>', methods=['POST'])
 @login_required
 def delete_session(session_id):
     fusion_session = FusionSession.query.get_or_404(session_id)
@@ -297,21 +713,12 @@ def delete_session(session_id):
         return redirect(url_for('dashboard'))
     
     try:
-        # Delete uploaded files
-        for image in fusion_session.images:
-            file_path = os.path.join(current_app.config['UPLOAD_FOLDER'], image.filename)
-            if os.path.exists(file_path):
-                os.remove(file_path)
-        
-        # Delete result file
-        if fusion_session.result_filename:
-            result_path = os.path.join(current_app.config['RESULT_FOLDER'], fusion_session.result_filename)
-            if os.path.exists(result_path):
-                os.remove(result_path)
-        
-        # Delete from database
-        db.session.delete(fusion_session)
+        # Files are deleted in the background once the rows are gone; the
+        # result is released, as shared cached results stay for other
+        # sessions until the storage sweep evicts them
+        paths = remove_session(fusion_session)
         db.session.commit()
+        schedule_deletion(paths)
         
         flash('Session deleted successfully.', 'success')
     except Exception as e:
@@ -0,0 +1,33 @@
+import threading
+from contextlib import contextmanager
+
+class SessionLocks:
+    """One lock per fusion session, serializing the background work on it
+
+    A session's lock exists only while a task holds or waits for it, so
+    the table does not grow with every session ever seen. Locks cannot be
+    weakly referenced, hence the count of users rather than a
+    WeakValueDictionary.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._locks = {}  # session id -> [lock, tasks holding or waiting for it]
+
+    @contextmanager
+    def hold(self, session_id):
+        with self._lock:
+            entry = self._locks.setdefault(session_id, [threading.Lock(), 0])
+            entry[1] += 1
+        try:
+            with entry[0]:
+                yield
+        finally:
+            with self._lock:
+                entry[1] -= 1
+                if not entry[1]:
+                    del self._locks[session_id]
+
+    def __len__(self):
+        with self._lock:
+            return len(self._locks)
@@ -74,7 +74,7 @@ function handleFileSelect(e) {
 
 function processFiles(files) {
     const allowedTypes = ['image/jpeg', 'image/png', 'image/tiff'];
-    const maxSize = 16 * 1024 * 1024; // 16MB
+    const maxSize = window.maxUploadFileSize || 1024 * 1024 * 1024;
     
     Array.from(files).forEach(file => {
         if (!allowedTypes.includes(file.type)) {
@@ -83,7 +83,7 @@ function processFiles(files) {
         }
         
         if (file.size > maxSize) {
-            showAlert('File too large: ' + file.name + ' (max 16MB)', 'error');
+            showAlert('File too large: ' + file.name + ' (max ' + formatFileSize(maxSize) + ')', 'error');
             return;
         }
         
@@ -91,48 +91,132 @@ function processFiles(files) {
     });
 }
 
-function uploadFile(file) {
-    const formData = new FormData();
-    formData.append('file', file);
-    
-    // Get session ID from global variable or window
-    const sessionId = window.fusionSessionId || fusionSessionId;
+// Chunked, resumable uploads
 
-    // Show upload progress
-    const progressContainer = createProgressIndicator(file.name);
-    const previewContainer = document.getElementById('imagePreview');
-    if (previewContainer) {
-        previewContainer.appendChild(progressContainer);
-    }
+const CHUNK_RETRIES = 5;
 
-    fetch(`/upload_file/${sessionId}`, {
+// Reserve a slot in the session for each file; resolves to the init response
+function startChunkedUploads(sessionId, files) {
+    return fetch(`/upload_init/${sessionId}`, {
         method: 'POST',
-        body: formData
+        headers: {'Content-Type': 'application/json'},
+        body: JSON.stringify({files: files.map(file => ({name: file.name, size: file.size}))})
     })
     .then(response => response.json())
     .then(data => {
-        if (data.success) {
-            // Remove progress indicator
-            progressContainer.remove();
-            
-            // Add image preview
-            addImagePreview(data);
-            
-            // Update counter
-            updateImageCounter(data.current_count, data.total_needed);
-            
-            // Enable process button if all images uploaded
-            if (data.current_count >= data.total_needed) {
-                enableProcessButton();
+        if (!data.success) {
+            throw new Error(data.error);
+        }
+        return data;
+    });
+}
+
+// Send a file chunk by chunk, resuming where the server left off after a
+// dropped connection, then finalize it; resolves to the finalize response
+async function sendFileInChunks(upload, file, chunkSize, onProgress) {
+    let offset = upload.received_bytes;
+    let failures = 0;
+    
+    while (offset < file.size) {
+        let response;
+        try {
+            response = await fetch(`${upload.chunk_url}?offset=${offset}`, {
+                method: 'PUT',
+                headers: {'Content-Type': 'application/octet-stream'},
+                body: file.slice(offset, offset + chunkSize)
+            });
+        } catch (error) {
+            if (++failures > CHUNK_RETRIES) {
+                throw error;
             }
-        } else {
-            progressContainer.remove();
-            showAlert(data.error, 'error');
+            await new Promise(resolve => setTimeout(resolve, 1000 * failures));
+            offset = await fetch(upload.status_url)
+                .then(response => response.json())
+                .then(state => state.received_bytes)
+                .catch(() => offset);
+            continue;
         }
-    })
+        
+        const data = await response.json();
+        if (!response.ok && data.received_bytes === undefined) {
+            throw new Error(data.error || 'Upload failed');
+        }
+        // A 409 carries the offset the server expects next
+        offset = data.received_bytes;
+        failures = 0;
+        if (onProgress) {
+            onProgress(offset, file.size);
+        }
+    }
+    
+    const response = await fetch(upload.finalize_url, {method: 'POST'});
+    const data = await response.json();
+    if (!data.success) {
+        throw new Error(data.error);
+    }
+    return data;
+}
+
+// Upload several files to a session in one batch. onStart(file) returns
+// that file's progress element; onDone(data) and onError(file, error)
+// are called per file.
+function uploadFilesChunked(sessionId, files, onStart, onDone, onError) {
+    const indicators = files.map(onStart);
+    
+    return startChunkedUploads(sessionId, files)
+    .then(batch => Promise.all(batch.uploads.map((upload, i) =>
+        sendFileInChunks(upload, files[i], batch.chunk_size, (sent, total) => {
+            updateProgressIndicator(indicators[i], sent, total);
+        })
+        .then(data => {
+            indicators[i].remove();
+            onDone(data);
+        })
+        .catch(error => {
+            indicators[i].remove();
+            onError(files[i], error);
+        })
+    )))
     .catch(error => {
-        progressContainer.remove();
-        showAlert('Upload failed: ' + error.message, 'error');
+        indicators.forEach(indicator => indicator.remove());
+        files.forEach(file => onError(file, error));
+    });
+}
+
+function updateProgressIndicator(container, sent, total) {
+    const bar = container.querySelector('.progress-bar');
+    if (bar) {
+        bar.style.width = Math.round(sent / total * 100) + '%';
+    }
+}
+
+function uploadFile(file) {
+    // Get session ID from global variable or window
+    const sessionId = window.fusionSessionId || fusionSessionId;
+    
+    // Show upload progress
+    const showProgress = file => {
+        const progressContainer = createProgressIndicator(file.name);
+        const previewContainer = document.getElementById('imagePreview');
+        if (previewContainer) {
+            previewContainer.appendChild(progressContainer);
+        }
+        return progressContainer;
+    };
+    
+    uploadFilesChunked(sessionId, [file], showProgress, data => {
+        // Add image preview
+        addImagePreview(data);
+        
+        // Update counter
+        updateImageCounter(data.current_count, data.total_needed);
+        
+        // Enable process button if all images uploaded
+        if (data.current_count >= data.total_needed) {
+            enableProcessButton();
+        }
+    }, (file, error) => {
+        showAlert('Upload failed: ' + file.name + ': ' + error.message, 'error');
     });
 }
 
@@ -148,7 +232,7 @@ function createProgressIndicator(filename) {
                 <p class="small mb-0">${filename}</p>
                 <div class="progress mt-2">
                     <div class="progress-bar progress-bar-striped progress-bar-animated" 
-                         role="progressbar" style="width: 100%"></div>
+                         role="progressbar" style="width: 0%"></div>
                 </div>
             </div>
         </div>
@@ -235,28 +319,58 @@ function processFusion() {
     // Show processing overlay
     showProcessingOverlay();
     
+    const resetProcessing = (message) => {
+        hideProcessingOverlay();
+        showAlert(message, 'error');
+        processBtn.disabled = false;
+        processBtn.innerHTML = '<i class="fas fa-cog me-2"></i>Process Fusion';
+        processingInProgress = false;
+    };
+    
     fetch(`/process_fusion/${fusionSessionId}`, {
         method: 'POST'
     })
     .then(response => response.json())
     .then(data => {
         if (data.success) {
-            // Redirect to result page
-            window.location.href = data.result_url;
+            // Go to the result page as soon as a preview is ready
+            waitForFusion(data.status_url, null, 1000, true)
+                .then(status => {
+                    window.location.href = status.result_url;
+                })
+                .catch(error => resetProcessing('Processing failed: ' + error.message));
         } else {
-            hideProcessingOverlay();
-            showAlert(data.error, 'error');
-            processBtn.disabled = false;
-            processBtn.innerHTML = '<i class="fas fa-cog me-2"></i>Process Fusion';
-            processingInProgress = false;
+            resetProcessing(data.error);
         }
     })
-    .catch(error => {
-        hideProcessingOverlay();
-        showAlert('Processing failed: ' + error.message, 'error');
-        processBtn.disabled = false;
-        processBtn.innerHTML = '<i class="fas fa-cog me-2"></i>Process Fusion';
-        processingInProgress = false;
+    .catch(error => resetProcessing('Processing failed: ' + error.message));
+}
+
+// Poll a fusion status URL until the job completes or fails, or with
+// untilPreview until its low-resolution preview is ready. Polling starts
+// fast, since previews take well under a second, and slows to interval.
+function waitForFusion(statusUrl, onProgress, interval = 1000, untilPreview = false) {
+    return new Promise((resolve, reject) => {
+        let delay = 100;
+        const poll = () => {
+            fetch(statusUrl)
+                .then(response => response.json())
+                .then(data => {
+                    if (data.status === 'completed' || (untilPreview && data.preview_url)) {
+                        resolve(data);
+                    } else if (data.status === 'failed') {
+                        reject(new Error(data.error || 'Fusion processing failed'));
+                    } else {
+                        if (onProgress) {
+                            onProgress(data);
+                        }
+                        setTimeout(poll, delay);
+                        delay = Math.min(delay * 2, interval);
+                    }
+                })
+                .catch(reject);
+        };
+        poll();
     });
 }
 
@@ -404,6 +518,7 @@ window.handleDrop = handleDrop;
 window.handleDragOver = handleDragOver;
 window.handleFileSelect = handleFileSelect;
 window.processFusion = processFusion;
+window.waitForFusion = waitForFusion;
 window.removeImage = removeImage;
 window.setFusionSessionId = setFusionSessionId;
 window.shareResult = function() {
@@ -0,0 +1,422 @@
+import os
+import time
+import queue
+import shutil
+import logging
+import threading
+from datetime import datetime, timedelta
+from flask import current_app
+from previews import preview_path
+from incremental import state_path
+from encoders import rendition_filenames
+import metrics
+
+# Storage lifecycle: what each user stores, quotas, and a background
+# manager that deletes files in batches off the request thread. It also
+# sweeps periodically:
+#
+#   - pending sessions idle past PENDING_SESSION_TTL and failed sessions
+#     past FAILED_SESSION_TTL are deleted with their files
+#   - completed sessions idle past DERIVED_DATA_TTL are compacted: their
+#     precomputed coefficients and running fusion state, which can be
+#     rebuilt from the uploads, are dropped
+#   - unreferenced cached results are evicted (result_cache.evict_results)
+#   - files in the storage folders that no row references are deleted
+#     once older than ORPHAN_GRACE_SECONDS
+#
+# and records the bytes and files in each folder for /metrics.
+
+STORAGE_FOLDERS = {
+    'uploads': 'UPLOAD_FOLDER',
+    'results': 'RESULT_FOLDER',
+    'coefficients': 'COEFFICIENT_FOLDER'
+}
+
+STORAGE_SWEEP_INTERVAL = 600
+PENDING_SESSION_TTL = 7 * 24 * 60 * 60
+FAILED_SESSION_TTL = 7 * 24 * 60 * 60
+DERIVED_DATA_TTL = 24 * 60 * 60
+
+# Files written but not yet recorded in the database (an upload being
+# saved, a state or result being replaced) are younger than this
+ORPHAN_GRACE_SECONDS = 60 * 60
+
+# Files deleted per batch, with a pause between batches so deleting a
+# large backlog does not monopolize the disk
+DELETE_BATCH_SIZE = 200
+DELETE_BATCH_PAUSE = 0.05
+
+# Sessions expired or compacted per sweep, so one sweep stays short
+SWEEP_BATCH_SIZE = 100
+
+def user_storage_bytes(user_id):
+    """Bytes a user stores: uploads, unfinished uploads and results
+
+    Unfinished uploads count at their declared size. A cached result
+    shared by several sessions counts once per session.
+    """
+    from app import db
+    from models import FusionSession, UploadedImage, ChunkedUpload, ResultCacheEntry
+
+    uploads = db.session.query(db.func.coalesce(db.func.sum(UploadedImage.file_size), 0)) \
+        .join(FusionSession).filter(FusionSession.user_id == user_id).scalar()
+    partial = db.session.query(db.func.coalesce(db.func.sum(ChunkedUpload.total_size), 0)) \
+        .join(FusionSession).filter(FusionSession.user_id == user_id).scalar()
+    results = db.session.query(db.func.coalesce(db.func.sum(ResultCacheEntry.size_bytes), 0)) \
+        .join(FusionSession, FusionSession.result_filename == ResultCacheEntry.filename) \
+        .filter(FusionSession.user_id == user_id).scalar()
+    return int(uploads + partial + results)
+
+def storage_usage(user_id):
+    """A user's storage use and quota (None when unlimited), in bytes"""
+    return {
+        'used_bytes': user_storage_bytes(user_id),
+        'quota_bytes': current_app.config.get('USER_STORAGE_QUOTA') or None
+    }
+
+def quota_exceeded(user_id, additional_bytes=0):
+    """Return the storage_usage of a user if additional_bytes would take
+    them over their quota, else None
+
+    The check and the write that follows are not atomic, so parallel
+    uploads can overshoot the quota by the uploads in flight.
+    """
+    if not current_app.config.get('USER_STORAGE_QUOTA'):
+        return None
+    usage = storage_usage(user_id)
+    if usage['used_bytes'] + additional_bytes > usage['quota_bytes']:
+        return usage
+    return None
+
+def image_files(image, config):
+    """Paths of an uploaded image and its precomputed coefficients"""
+    paths = [os.path.join(config['UPLOAD_FOLDER'], image.filename)]
+    if image.coeffs_filename:
+        paths.append(os.path.join(config['COEFFICIENT_FOLDER'], image.coeffs_filename))
+    return paths
+
+def session_files(fusion_session, config):
+    """Paths of the files a session owns, other than its result
+
+    Results may be shared through the result cache, so they are released
+    with result_cache.release_result instead.
+    """
+    from uploads import partial_upload_path
+
+    paths = []
+    for image in fusion_session.images:
+        paths.extend(image_files(image, config))
+    for upload in fusion_session.uploads:
+        paths.append(partial_upload_path(upload))
+    if fusion_session.preview_filename:
+        paths.append(preview_path(fusion_session.preview_filename, config))
+    if fusion_session.fusion_state_filename:
+        paths.append(state_path(fusion_session.fusion_state_filename, config))
+    return paths
+
+def remove_session(fusion_session):
+    """Delete a session from the database and return the paths of its files
+
+    The caller commits, then passes the paths to schedule_deletion, so a
+    failed commit leaves the files in place.
+    """
+    from app import db
+    from uploads import forget_upload
+    from result_cache import release_result
+
+    paths = session_files(fusion_session, current_app.config)
+    for upload in fusion_session.uploads:
+        forget_upload(upload)
+    release_result(fusion_session.result_filename)
+    db.session.delete(fusion_session)
+    return paths
+
+def schedule_deletion(paths, reason='session'):
+    """Queue files for deletion by the storage manager
+
+    Without a storage manager (for example in a CLI context) the files are
+    deleted straight away.
+    """
+    manager = current_app.extensions.get('fusion_storage')
+    if manager is not None:
+        manager.delete(paths, reason)
+    else:
+        delete_files(paths, reason)
+
+def delete_files(paths, reason='session'):
+    """Delete files that exist; returns the bytes freed"""
+    freed = deleted = 0
+    for path in paths:
+        try:
+            size = os.path.getsize(path)
+            os.remove(path)
+        except FileNotFoundError:
+            continue
+        except OSError as e:
+            logging.error(f"Error deleting {path}: {str(e)}")
+            continue
+        freed += size
+        deleted += 1
+    if deleted:
+        metrics.STORAGE_DELETED_FILES.inc(deleted, reason=reason)
+        metrics.STORAGE_DELETED_BYTES.inc(freed, reason=reason)
+    return freed
+
+def expire_sessions(config):
+    """Delete pending and failed sessions idle past their TTL
+
+    Returns the paths of their files, to be deleted once the caller has
+    committed.
+    """
+    from app import db
+    from models import FusionSession, FusionJob, UploadedImage, ChunkedUpload
+
+    now = datetime.utcnow()
+    pending_cutoff = now - timedelta(seconds=config.get('PENDING_SESSION_TTL', PENDING_SESSION_TTL))
+    failed_cutoff = now - timedelta(seconds=config.get('FAILED_SESSION_TTL', FAILED_SESSION_TTL))
+
+    # A pending session is idle once nothing was uploaded to it for the TTL
+    recent_image = db.select(UploadedImage.id).where(UploadedImage.fusion_session_id == FusionSession.id,
+                                                     UploadedImage.uploaded_at >= pending_cutoff).exists()
+    recent_upload = db.select(ChunkedUpload.id).where(ChunkedUpload.fusion_session_id == FusionSession.id,
+                                                      ChunkedUpload.updated_at >= pending_cutoff).exists()
+    failed_at = db.func.coalesce(FusionJob.finished_at, FusionSession.created_at)
+    expired = FusionSession.query.outerjoin(FusionJob).filter(db.or_(
+        db.and_(FusionSession.status == 'pending', FusionSession.created_at < pending_cutoff,
+                ~recent_image, ~recent_upload),
+        db.and_(FusionSession.status == 'failed', failed_at < failed_cutoff)
+    )).limit(SWEEP_BATCH_SIZE).all()
+
+    paths = []
+    for fusion_session in expired:
+        metrics.STORAGE_EXPIRED_SESSIONS.inc(status=fusion_session.status)
+        paths.extend(remove_session(fusion_session))
+    if expired:
+        logging.info(f"Expired {len(expired)} idle pending or failed sessions")
+    return paths
+
+def compact_sessions(config):
+    """Drop the coefficients and fusion state of long completed sessions
+
+    Both are derived from the uploads and are rebuilt if the session is
+    fused again. Returns the paths to delete once the caller has committed.
+    """
+    from app import db
+    from models import FusionSession, UploadedImage
+
+    cutoff = datetime.utcnow() - timedelta(seconds=config.get('DERIVED_DATA_TTL', DERIVED_DATA_TTL))
+    has_coefficients = db.select(UploadedImage.id).where(UploadedImage.fusion_session_id == FusionSession.id,
+                                                         UploadedImage.coeffs_filename.is_not(None)).exists()
+    sessions = FusionSession.query.filter(
+        FusionSession.status == 'completed', FusionSession.completed_at < cutoff,
+        db.or_(FusionSession.fusion_state_filename.is_not(None), has_coefficients)
+    ).limit(SWEEP_BATCH_SIZE).all()
+
+    paths = []
+    for fusion_session in sessions:
+        for image in fusion_session.images:
+            if image.coeffs_filename:
+                paths.append(os.path.join(config['COEFFICIENT_FOLDER'], image.coeffs_filename))
+                image.coeffs_filename = None
+        if fusion_session.fusion_state_filename:
+            paths.append(state_path(fusion_session.fusion_state_filename, config))
+            fusion_session.fusion_state_filename = None
+    if sessions:
+        logging.info(f"Compacted {len(sessions)} completed sessions")
+    return paths
+
+def referenced_files():
+    """Names of every file the database refers to, by storage folder"""
+    from app import db
+    from models import FusionSession, UploadedImage, ChunkedUpload, FusionJob, ResultCacheEntry
+
+    def names(*columns):
+        return {name for row in db.session.query(*columns).all() for name in row if name}
+
+    results = names(FusionSession.result_filename) | names(FusionJob.result_filename) \
+        | names(ResultCacheEntry.filename)
+    return {
+        'uploads': names(UploadedImage.filename)
+                   | {f"{name}.part" for name in names(ChunkedUpload.filename)},
+        'results': results | names(FusionSession.preview_filename)
+                   | {rendition for name in results for rendition in rendition_filenames(name)},
+        'coefficients': names(UploadedImage.coeffs_filename) | names(FusionSession.fusion_state_filename)
+    }
+
+def sweep_orphans(config):
+    """Find unreferenced files and measure the storage folders
+
+    Returns (orphan paths, {folder: (bytes, files)}). Files younger than
+    ORPHAN_GRACE_SECONDS are never orphans, as they may be recorded in
+    the database a moment after they are written.
+    """
+    referenced = referenced_files()
+    cutoff = time.time() - config.get('ORPHAN_GRACE_SECONDS', ORPHAN_GRACE_SECONDS)
+    orphans = []
+    usage = {}
+    for name, key in STORAGE_FOLDERS.items():
+        total_bytes = total_files = 0
+        try:
+            entries = list(os.scandir(config[key]))
+        except FileNotFoundError:
+            entries = []
+        for entry in entries:
+            try:
+                if not entry.is_file():
+                    continue
+                stat = entry.stat()
+            except OSError:
+                continue
+            if entry.name not in referenced[name] and stat.st_mtime < cutoff:
+                orphans.append(entry.path)
+                continue
+            total_bytes += stat.st_size
+            total_files += 1
+        usage[name] = (total_bytes, total_files)
+    return orphans, usage
+
+class StorageManager:
+    """Delete files in batches and sweep storage, on a background thread
+
+    Deletions are queued by schedule_deletion and carried out in batches
+    of DELETE_BATCH_SIZE. Every STORAGE_SWEEP_INTERVAL seconds the thread
+    also expires idle sessions, compacts old ones, evicts cached results,
+    deletes orphaned files and refreshes the storage metrics. Every
+    process runs its own manager; the sweeps are idempotent, so several
+    may overlap.
+    """
+
+    def __init__(self, app, interval):
+        self.app = app
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._queue = queue.Queue()
+        self._thread = None
+        self._pid = None
+
+    def start(self):
+        """Start the manager thread once per process"""
+        with self._lock:
+            if self._pid == os.getpid() and self._thread.is_alive():
+                return
+            if self._pid != os.getpid():
+                # Deletions queued in the parent are the parent's to carry out
+                self._queue = queue.Queue()
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._run, name='fusion-storage', daemon=True)
+            self._thread.start()
+
+    def delete(self, paths, reason='session'):
+        for path in paths:
+            self._queue.put((path, reason))
+        metrics.STORAGE_PENDING_DELETIONS.set(self._queue.qsize())
+
+    def pending(self):
+        return self._queue.qsize()
+
+    def drain(self):
+        """Delete every queued file on the calling thread"""
+        while True:
+            batch = []
+            while len(batch) < DELETE_BATCH_SIZE:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            if not batch:
+                return
+            self._delete_batch(batch)
+
+    def _run(self):
+        next_sweep = time.monotonic()
+        while True:
+            timeout = max(0.0, next_sweep - time.monotonic()) if self.interval else None
+            try:
+                batch = [self._queue.get(timeout=timeout)]
+            except queue.Empty:
+                batch = []
+            while len(batch) < DELETE_BATCH_SIZE:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            if batch:
+                self._delete_batch(batch)
+                time.sleep(DELETE_BATCH_PAUSE)
+
+            if self.interval and time.monotonic() >= next_sweep:
+                next_sweep = time.monotonic() + self.interval
+                self.sweep()
+
+    def _delete_batch(self, batch):
+        by_reason = {}
+        for path, reason in batch:
+            by_reason.setdefault(reason, []).append(path)
+        for reason, paths in by_reason.items():
+            delete_files(paths, reason)
+        metrics.STORAGE_PENDING_DELETIONS.set(self._queue.qsize())
+
+    def sweep(self):
+        """Expire, compact, evict and collect orphans once; returns the usage"""
+        from app import db
+        from result_cache import evict_results
+
+        config = self.app.config
+        start = time.perf_counter()
+        with self.app.app_context():
+            try:
+                paths = expire_sessions(config)
+                db.session.commit()
+                self.delete(paths, 'expired')
+
+                paths = compact_sessions(config)
+                db.session.commit()
+                self.delete(paths, 'compacted')
+
+                evict_results()
+                db.session.commit()
+
+                orphans, usage = sweep_orphans(config)
+                self.delete(orphans, 'orphan')
+                if orphans:
+                    logging.info(f"Found {len(orphans)} orphaned files")
+            except Exception as e:
+                db.session.rollback()
+                logging.error(f"Error in storage sweep: {str(e)}")
+                return None
+            finally:
+                db.session.remove()
+
+        for name, (total_bytes, total_files) in usage.items():
+            metrics.STORAGE_BYTES.set(total_bytes, folder=name)
+            metrics.STORAGE_FILES.set(total_files, folder=name)
+            if os.path.isdir(config[STORAGE_FOLDERS[name]]):
+                disk = shutil.disk_usage(config[STORAGE_FOLDERS[name]])
+                metrics.STORAGE_DISK_FREE_BYTES.set(disk.free, folder=name)
+        metrics.STORAGE_SWEEP_SECONDS.observe(time.perf_counter() - start)
+        return usage
+
+def init_app(app):
+    """Attach the storage manager to the app
+
+    Like the job dispatcher it is started by the first request each
+    process serves. STORAGE_SWEEP_INTERVAL = 0 keeps the batched
+    deletions but turns the periodic sweep off.
+    """
+    manager = StorageManager(app, app.config.get('STORAGE_SWEEP_INTERVAL', STORAGE_SWEEP_INTERVAL))
+    app.extensions['fusion_storage'] = manager
+
+    @app.before_request
+    def start_storage_manager():
+        manager.start()
+
+    @app.cli.command('storage-sweep')
+    def storage_sweep_command():
+        """Expire, compact and collect orphaned files once, then report usage"""
+        usage = manager.sweep()
+        manager.drain()
+        for name, (total_bytes, total_files) in (usage or {}).items():
+            print(f"{name:>14} {total_files:>8} files {total_bytes / 2 ** 20:>12.1f} MiB")
+
+    return manager
@@ -0,0 +1,321 @@
+"""Fuse a stream of frames, such as a burst or a video, in constant memory
+
+Frames come from a video file or a directory of images and are fused one
+at a time with the same rules as fusion.nway_dwt_fusion: the approximation
+band is averaged and the detail bands are combined by a fusion rule, by
+default keeping the coefficient of largest magnitude. Only running
+accumulators are held, so memory does not grow with the number of frames.
+
+    python stream_fusion.py burst.mp4 fused.png --levels 2 --step 2
+    python stream_fusion.py burst.mp4 fused.png --rule local_energy
+    python stream_fusion.py frames/ fused.png
+"""
+import os
+import sys
+import time
+import argparse
+import logging
+import numpy as np
+import cv2
+import pywt
+from fusion import (load_gray_image, read_image_size, coefficient_shapes, unpack_coefficients, effective_levels,
+                    enhance_contrast, FUSION_DTYPES, SUPPORTED_WAVELETS, MAX_LEVELS,
+                    DEFAULT_WAVELET, DEFAULT_LEVELS, DEFAULT_PRECISION)
+from fusion_rules import RULES, DEFAULT_RULE, get_rule
+from profiling import timed
+from encoders import (save_result_image, write_renditions, RESULT_FORMATS, DEFAULT_RESULT_FORMAT,
+                      DEFAULT_PNG_COMPRESS_LEVEL)
+
+IMAGE_EXTENSIONS = {'png', 'jpg', 'jpeg', 'tiff', 'tif'}
+
+# Log the frame rate every this many frames
+REPORT_INTERVAL = 100
+
+def even_size(height, width):
+    return height - height % 2, width - width % 2
+
+def iter_video_frames(video_path, size=None, step=1, max_frames=None):
+    """Yield the frames of a video as gray uint8 arrays
+
+    size (height, width) defaults to the video's own, made even. Every
+    step-th frame is used, up to max_frames. The capture, gray and resize
+    buffers are allocated once, so the array yielded is overwritten by the
+    next frame; copy it to keep it.
+    """
+    capture = cv2.VideoCapture(video_path)
+    if not capture.isOpened():
+        raise ValueError(f"Cannot open video {video_path}")
+    try:
+        if size is None:
+            size = even_size(int(capture.get(cv2.CAP_PROP_FRAME_HEIGHT)),
+                             int(capture.get(cv2.CAP_PROP_FRAME_WIDTH)))
+        frame = gray = None
+        resized = np.empty(size, dtype=np.uint8)
+        index = yielded = 0
+        while max_frames is None or yielded < max_frames:
+            if index % step:
+                if not capture.grab():
+                    break
+                index += 1
+                continue
+            ok, frame = capture.read(frame)
+            if not ok:
+                break
+            index += 1
+            if frame.ndim == 3:
+                gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY, gray)
+            else:
+                gray = frame
+            if gray.shape != tuple(size):
+                gray = cv2.resize(gray, (size[1], size[0]), resized, interpolation=cv2.INTER_AREA)
+            yield gray
+            yielded += 1
+    finally:
+        capture.release()
+
+def iter_image_frames(image_paths, size=None):
+    """Yield images decoded to gray, resized to size
+
+    size defaults to that of the first image, made even. Paths may be any
+    iterable, so frames are decoded only as they are fused.
+    """
+    for path in image_paths:
+        if size is None:
+            size = even_size(*read_image_size(path))
+        gray = load_gray_image(path, size, cv2.INTER_AREA)
+        if gray is None:
+            raise ValueError(f"Cannot decode {path}")
+        yield gray
+
+def iter_directory_frames(directory, size=None):
+    """Yield the images of a directory, in name order, as gray frames"""
+    names = sorted(entry.name for entry in os.scandir(directory)
+                   if entry.is_file() and entry.name.rsplit('.', 1)[-1].lower() in IMAGE_EXTENSIONS)
+    return iter_image_frames((os.path.join(directory, name) for name in names), size)
+
+def iter_frames(source, size=None, step=1, max_frames=None):
+    """Frames of a video file or an image directory"""
+    if os.path.isdir(source):
+        frames = iter_directory_frames(source, size)
+        if step > 1 or max_frames is not None:
+            from itertools import islice
+            frames = islice(frames, 0, None if max_frames is None else max_frames * step, step)
+        return frames
+    return iter_video_frames(source, size, step, max_frames)
+
+class StreamFusion:
+    """Running DWT fusion of equally sized gray frames
+
+    Holds the sum of the approximation bands and, for the detail bands,
+    the coefficient of highest activity seen so far together with that
+    activity, each in one packed array allocated up front. Adding a frame
+    transforms it and folds it into these in place. Ties go to the later
+    frame, as in fuse_packed_coefficients, so the result matches
+    nway_dwt_fusion on the same frames up to rounding of the average.
+    Weighted rules keep the activity-weighted sum of the coefficients and
+    the sum of the activities instead, divided in result(). Rules with
+    consistency verification need every frame at once and are refused.
+    """
+
+    def __init__(self, shape, wavelet=DEFAULT_WAVELET, levels=DEFAULT_LEVELS, precision=DEFAULT_PRECISION,
+                 rule=DEFAULT_RULE):
+        self.rule = get_rule(rule)
+        if not self.rule.streamable:
+            raise ValueError(f"The {self.rule.name} rule cannot fuse a stream")
+        self.shape = tuple(shape)
+        self.wavelet = wavelet
+        self.levels = effective_levels(self.shape, wavelet, levels)
+        self.frames = 0
+
+        dtype = FUSION_DTYPES[precision]
+        self._shapes = coefficient_shapes(self.shape, wavelet, self.levels)
+        self._approximation_size = self._shapes[0][0] * self._shapes[0][1]
+        total = self._approximation_size + sum(3 * h * w for h, w in self._shapes[1:])
+
+        self._image = np.empty(self.shape, dtype=dtype)
+        self._fused = np.zeros(total, dtype=dtype)
+        self._activity = np.zeros(total, dtype=dtype)
+        self._scratch = np.empty(total, dtype=dtype)
+        self._mask = np.empty(total, dtype=bool)
+
+        # wavedec2-shaped views into the packed buffers, one per band
+        self._fused_bands = self._band_views(self._fused)
+        self._activity_bands = self._band_views(self._activity)
+        self._scratch_bands = self._band_views(self._scratch)
+        self._mask_bands = self._band_views(self._mask)
+
+    def _band_views(self, packed):
+        coeffs = unpack_coefficients(packed, self._shapes)
+        return [coeffs[0]] + [band for level in coeffs[1:] for band in level]
+
+    def add(self, frame, timer=None):
+        """Fold one gray frame of the stream's shape into the fusion"""
+        with timed(timer, 'dwt'):
+            np.copyto(self._image, frame)
+            coeffs = pywt.wavedec2(self._image, self.wavelet, level=self.levels)
+        self._fold(coeffs, timer)
+
+    def add_coefficients(self, packed, timer=None):
+        """Fold in a frame already decomposed, as fusion.dwt_coefficients packs it"""
+        self._fold(unpack_coefficients(packed, self._shapes), timer)
+
+    def _fold(self, coeffs, timer=None):
+        with timed(timer, 'rules'):
+            # Approximation: running sum, averaged in result()
+            np.add(self._fused_bands[0], coeffs[0], out=self._fused_bands[0])
+
+            # Details: keep the coefficient of highest activity so far, or
+            # accumulate the weighted sum
+            bands = [band for level in coeffs[1:] for band in level]
+            for i, band in enumerate(bands, 1):
+                best, fused = self._activity_bands[i], self._fused_bands[i]
+                scratch, mask = self._scratch_bands[i], self._mask_bands[i]
+                self.rule.activity(band[np.newaxis], self.rule.window, scratch[np.newaxis])
+                if self.rule.combine == 'weighted':
+                    np.add(best, scratch, out=best)
+                    np.multiply(scratch, band, out=scratch)
+                    np.add(fused, scratch, out=fused)
+                    continue
+                np.greater_equal(scratch, best, out=mask)
+                np.copyto(fused, band, where=mask)
+                np.copyto(best, scratch, where=mask)
+        self.frames += 1
+
+    def matches(self, shape, wavelet=DEFAULT_WAVELET, levels=DEFAULT_LEVELS, precision=DEFAULT_PRECISION,
+                rule=DEFAULT_RULE):
+        """Check that frames of this shape and transform can be folded in"""
+        return (self.shape == tuple(shape) and self.wavelet == wavelet
+                and self.levels == effective_levels(shape, wavelet, levels)
+                and self._fused.dtype == FUSION_DTYPES[precision] and self.rule.name == rule)
+
+    def save(self, path, **arrays):
+        """Write the accumulators, plus any extra arrays, to an .npz file
+
+        For the max_abs rule only the packed coefficients are stored, as
+        the magnitudes are recomputed from them on load; other rules store
+        their activities too.
+        """
+        if self.rule.name != 'max_abs':
+            arrays['activity'] = self._activity
+        with open(path, 'wb') as f:
+            np.savez(f, fused=self._fused, frames=self.frames, shape=self.shape, wavelet=self.wavelet,
+                     levels=self.levels, rule=self.rule.name, **arrays)
+
+    @classmethod
+    def load(cls, path):
+        """Read a fusion written by save; returns (fusion, extra arrays)"""
+        with np.load(path) as data:
+            fused = data['fused']
+            # States written before rules were selectable have none
+            rule = str(data['rule']) if 'rule' in data.files else 'max_abs'
+            fusion = cls(tuple(int(n) for n in data['shape']), str(data['wavelet']), int(data['levels']),
+                         fused.dtype.name, rule)
+            np.copyto(fusion._fused, fused)
+            if rule == 'max_abs':
+                np.abs(fusion._fused, out=fusion._activity)
+            else:
+                np.copyto(fusion._activity, data['activity'])
+            fusion.frames = int(data['frames'])
+            arrays = {name: data[name] for name in data.files
+                      if name not in ('fused', 'frames', 'shape', 'wavelet', 'levels', 'rule', 'activity')}
+        return fusion, arrays
+
+    def result(self, timer=None):
+        """The fused image so far as uint8, or None before any frame"""
+        if not self.frames:
+            return None
+        with timed(timer, 'idwt'):
+            np.copyto(self._scratch, self._fused)
+            self._scratch[:self._approximation_size] /= self.frames
+            if self.rule.combine == 'weighted':
+                details = self._scratch[self._approximation_size:]
+                total = self._activity[self._approximation_size:]
+                np.divide(details, total, out=details, where=total > 0)
+            image = pywt.waverec2(unpack_coefficients(self._scratch, self._shapes), self.wavelet)
+            image = image[:self.shape[0], :self.shape[1]]
+        return np.clip(image, 0, 255).astype(np.uint8)
+
+def process_stream_fusion(frames, output_path, wavelet=DEFAULT_WAVELET, levels=DEFAULT_LEVELS,
+                          precision=DEFAULT_PRECISION, timer=None, result_format=DEFAULT_RESULT_FORMAT,
+                          compress_level=DEFAULT_PNG_COMPRESS_LEVEL, renditions=False, rule=DEFAULT_RULE):
+    """Fuse an iterable of gray frames and save the contrast-enhanced result
+
+    The stream takes its shape from the first frame, made even; later
+    frames must be at least that large and are cropped to it. Returns a
+    dict with the frame count, seconds and frames per second, or None on
+    failure. The frame rate so far is logged every REPORT_INTERVAL frames.
+    """
+    try:
+        fusion = None
+        start = time.perf_counter()
+        for frame in frames:
+            if fusion is None:
+                fusion = StreamFusion(even_size(*frame.shape[:2]), wavelet, levels, precision, rule)
+            fusion.add(frame[:fusion.shape[0], :fusion.shape[1]], timer)
+            if fusion.frames % REPORT_INTERVAL == 0:
+                fps = fusion.frames / (time.perf_counter() - start)
+                logging.info(f"Fused {fusion.frames} frames, {fps:.1f} frames/s")
+        fuse_seconds = time.perf_counter() - start
+
+        if fusion is None or fusion.frames < 2:
+            logging.error("Need at least 2 frames for fusion")
+            return None
+
+        fused_gray = fusion.result(timer)
+        with timed(timer, 'enhance'):
+            fused_enhanced = enhance_contrast(fused_gray)
+        with timed(timer, 'encode'):
+            save_result_image(fused_enhanced, output_path, result_format, compress_level)
+        if renditions:
+            with timed(timer, 'renditions'):
+                write_renditions(fused_enhanced, output_path)
+
+        if timer is not None:
+            timer.input_pixels = fusion.frames * fusion.shape[0] * fusion.shape[1]
+
+        stats = {
+            'frames': fusion.frames,
+            'seconds': round(time.perf_counter() - start, 6),
+            'frames_per_second': round(fusion.frames / fuse_seconds, 2) if fuse_seconds > 0 else None
+        }
+        logging.info(f"Stream fusion of {stats['frames']} frames saved to {output_path} "
+                     f"({stats['frames_per_second']} frames/s)")
+        return stats
+    except Exception as e:
+        logging.error(f"Error in stream fusion: {str(e)}")
+        return None
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('source', help='video file or directory of images')
+    parser.add_argument('output', help='fused image to write')
+    parser.add_argument('--wavelet', default=DEFAULT_WAVELET, choices=SUPPORTED_WAVELETS)
+    parser.add_argument('--levels', type=int, default=DEFAULT_LEVELS, choices=range(1, MAX_LEVELS + 1))
+    parser.add_argument('--precision', default=DEFAULT_PRECISION, choices=list(FUSION_DTYPES))
+    parser.add_argument('--rule', default=DEFAULT_RULE,
+                        choices=[name for name, rule in RULES.items() if rule.streamable],
+                        help='detail coefficient rule (see fusion_rules)')
+    parser.add_argument('--step', type=int, default=1, help='use every step-th frame')
+    parser.add_argument('--max-frames', type=int, help='stop after this many frames')
+    parser.add_argument('--size', type=int, nargs=2, metavar=('HEIGHT', 'WIDTH'),
+                        help='resize frames to this size (default: that of the first frame)')
+    args = parser.parse_args(argv)
+
+    extension = args.output.rsplit('.', 1)[-1].lower()
+    result_format = next((name for name, (_, ext, _) in RESULT_FORMATS.items() if ext == extension), None)
+    if result_format is None:
+        parser.error(f"output must end in one of: {', '.join(ext for _, ext, _ in RESULT_FORMATS.values())}")
+
+    logging.basicConfig(level=logging.INFO)
+
+    frames = iter_frames(args.source, even_size(*args.size) if args.size else None, max(1, args.step),
+                         args.max_frames)
+    stats = process_stream_fusion(frames, args.output, args.wavelet, args.levels, args.precision,
+                                  result_format=result_format, rule=args.rule)
+    if stats is None:
+        return 1
+    print(f"{stats['frames']} frames in {stats['seconds']:.2f}s, {stats['frames_per_second']} frames/s")
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,88 @@
+import os
+import sys
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+def synthetic_images(shape, count=3, kind='blocks', seed=0):
+    """Deterministic gray test images
+
+    blocks are flat 16x16 patches, whose detail coefficients tie between
+    images along many edges; smooth are noisy sinusoids as in the
+    benchmarks.
+    """
+    rng = np.random.default_rng(seed)
+    height, width = shape
+    if kind == 'blocks':
+        cells = rng.integers(0, 256, (count, -(-height // 16), -(-width // 16)), dtype=np.uint8)
+        return [np.repeat(np.repeat(c, 16, axis=0), 16, axis=1)[:height, :width].copy() for c in cells]
+    y, x = np.mgrid[0:height, 0:width] / max(shape)
+    return [np.clip(127 + 100 * np.sin(2 * np.pi * (x * (i + 1) + y)) + rng.normal(0, 20, shape), 0, 255)
+            .astype(np.uint8) for i in range(count)]
+
+@pytest.fixture
+def make_images():
+    return synthetic_images
+
+@pytest.fixture
+def app(tmp_path):
+    """An app on a fresh SQLite database and storage folders
+
+    The background threads are not started; tests drive the dispatcher
+    and storage manager directly.
+    """
+    from app import create_app, init_db
+
+    app = create_app({
+        'TESTING': True,
+        'SQLALCHEMY_DATABASE_URI': f"sqlite:///{tmp_path / 'test.db'}",
+        'UPLOAD_FOLDER': str(tmp_path / 'uploads'),
+        'RESULT_FOLDER': str(tmp_path / 'results'),
+        'COEFFICIENT_FOLDER': str(tmp_path / 'coefficients'),
+        'FUSION_WORKERS': 1,
+        'PRECOMPUTE_COEFFICIENTS': False,
+        'FUSION_PREVIEWS': False,
+        'INCREMENTAL_FUSION': False,
+        'QUALITY_METRICS': False,
+        'STORAGE_SWEEP_INTERVAL': 0
+    })
+    init_db(app)
+    app.extensions['fusion_jobs'].start = lambda: None
+    app.extensions['fusion_storage'].start = lambda: None
+    with app.app_context():
+        yield app
+        from app import db
+        db.session.remove()
+        db.engine.dispose()
+
+@pytest.fixture
+def user(app):
+    from app import db
+    from models import User
+
+    user = User(username='alice', email='alice@example.com')
+    user.set_password('secret123')
+    db.session.add(user)
+    db.session.commit()
+    return user
+
+@pytest.fixture
+def client(app, user):
+    """A test client logged in as user"""
+    client = app.test_client()
+    response = client.post('/login', data={'username': 'alice', 'password': 'secret123'})
+    assert response.status_code == 302
+    return client
+
+@pytest.fixture
+def make_session(user):
+    def make_session(num_images=2, **values):
+        from app import db
+        from models import FusionSession
+
+        fusion_session = FusionSession(user_id=user.id, session_name='test', num_images=num_images, **values)
+        db.session.add(fusion_session)
+        db.session.commit()
+        return fusion_session
+    return make_session
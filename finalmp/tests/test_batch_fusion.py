@@ -0,0 +1,39 @@
+import json
+from PIL import Image
+from batch_fusion import sets_from_manifest, run_batch
+
+OPTIONS = {'wavelet': 'haar', 'levels': 1, 'precision': 'float32', 'color': False, 'rule': 'max_abs'}
+
+def write_manifest(tmp_path, make_images, entries):
+    for i, image in enumerate(make_images((64, 96), 2, 'smooth')):
+        Image.fromarray(image).save(tmp_path / f"image_{i}.png")
+    manifest = tmp_path / 'sets.json'
+    manifest.write_text(json.dumps(entries))
+    return str(manifest)
+
+def test_manifest_output_path_and_format(tmp_path, make_images, capsys):
+    images = ['image_0.png', 'image_1.png']
+    manifest = write_manifest(tmp_path, make_images, [
+        {'name': 'lossless_webp', 'images': images, 'output': 'out/a.webp'},
+        {'name': 'tiff', 'images': images, 'output': 'out/b.TIFF'},
+        {'name': 'default', 'images': images},
+    ])
+    image_sets = sets_from_manifest(manifest, str(tmp_path / 'fused'), 'webp')
+    assert [s['format'] for s in image_sets] == ['webp', 'tiff', 'webp']
+
+    assert run_batch(image_sets, 1, None, OPTIONS)
+    for path, pil_format in [('out/a.webp', 'WEBP'), ('out/b.TIFF', 'TIFF'), ('fused/default.webp', 'WEBP')]:
+        with Image.open(tmp_path / path) as result:
+            assert result.format == pil_format
+    assert '3 fused, 0 skipped, 0 failed' in capsys.readouterr().out
+
+def test_sets_that_cannot_be_fused_fail_the_batch(tmp_path, make_images, capsys):
+    manifest = write_manifest(tmp_path, make_images, [
+        {'name': 'single', 'images': ['image_0.png']},
+        {'name': 'jpeg', 'images': ['image_0.png', 'image_1.png'], 'output': 'out/c.jpg'},
+    ])
+    assert not run_batch(sets_from_manifest(manifest, str(tmp_path / 'fused')), 1, None, OPTIONS)
+    out = capsys.readouterr().out
+    assert 'FAIL  single' in out and 'FAIL  jpeg' in out
+    assert '0 fused, 0 skipped, 2 failed' in out
+    assert not (tmp_path / 'out' / 'c.jpg').exists()
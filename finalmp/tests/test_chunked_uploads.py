@@ -0,0 +1,73 @@
+import io
+import os
+import hashlib
+import pytest
+from app import db
+from models import ChunkedUpload, UploadedImage
+from uploads import UploadError, append_chunk, partial_upload_path
+
+DATA = bytes(range(256)) * 40
+
+@pytest.fixture
+def upload(client, make_session):
+    fusion_session = make_session(num_images=2, image_slots=0)
+    response = client.post(f'/upload_init/{fusion_session.id}',
+                           json={'files': [{'name': 'scan.png', 'size': len(DATA)}]})
+    assert response.status_code == 200
+    return response.get_json()['uploads'][0]
+
+def put_chunk(client, upload, offset, data):
+    return client.put(f"{upload['chunk_url']}?offset={offset}", data=data)
+
+def received_data(upload_id):
+    return open(partial_upload_path(db.session.get(ChunkedUpload, upload_id)), 'rb').read()
+
+def test_chunks_resume_and_finalize(client, upload):
+    assert upload['received_bytes'] == 0
+    assert put_chunk(client, upload, 0, DATA[:4000]).get_json()['received_bytes'] == 4000
+
+    # A client that lost track asks where to resume
+    status = client.get(upload['status_url']).get_json()
+    assert (status['received_bytes'], status['total_size']) == (4000, len(DATA))
+    assert put_chunk(client, upload, 4000, DATA[4000:]).status_code == 200
+
+    response = client.post(upload['finalize_url'])
+    assert response.status_code == 200
+    image = UploadedImage.query.filter_by(filename=response.get_json()['filename']).one()
+    assert image.content_hash == hashlib.sha256(DATA).hexdigest()
+    with open(os.path.join(client.application.config['UPLOAD_FOLDER'], image.filename), 'rb') as f:
+        assert f.read() == DATA
+    assert ChunkedUpload.query.count() == 0
+
+def test_duplicate_and_out_of_order_chunks_are_refused(client, upload):
+    assert put_chunk(client, upload, 0, DATA[:4000]).status_code == 200
+
+    duplicate = put_chunk(client, upload, 0, b'x' * 4000)
+    assert duplicate.status_code == 409 and duplicate.get_json()['received_bytes'] == 4000
+    ahead = put_chunk(client, upload, 8000, DATA[8000:])
+    assert ahead.status_code == 409 and ahead.get_json()['received_bytes'] == 4000
+    assert received_data(upload['upload_id']) == DATA[:4000]
+
+    assert client.post(upload['finalize_url']).status_code == 409
+    assert put_chunk(client, upload, 4000, DATA[4000:]).status_code == 200
+    assert client.post(upload['finalize_url']).status_code == 200
+
+def test_losing_a_race_leaves_the_data_intact(client, upload):
+    # Both requests read received_bytes == 4000; the other one wins
+    assert put_chunk(client, upload, 0, DATA[:4000]).status_code == 200
+    stale = db.session.get(ChunkedUpload, upload['upload_id'])
+    db.session.expunge(stale)
+    assert put_chunk(client, upload, 4000, DATA[4000:6000]).status_code == 200
+
+    with pytest.raises(UploadError) as error:
+        append_chunk(stale, 4000, io.BytesIO(b'y' * 3000))
+    assert error.value.status == 409
+    db.session.rollback()
+    assert received_data(upload['upload_id']) == DATA[:6000]
+    assert not [name for name in os.listdir(client.application.config['UPLOAD_FOLDER']) if name.endswith('.chunk')]
+
+def test_chunk_past_the_declared_size_is_refused(client, upload):
+    assert put_chunk(client, upload, 0, DATA[:4000]).status_code == 200
+    assert put_chunk(client, upload, 4000, DATA[4000:] + b'extra').status_code == 400
+    assert received_data(upload['upload_id']) == DATA[:4000]
+    assert client.get(upload['status_url']).get_json()['received_bytes'] == 4000
@@ -0,0 +1,41 @@
+import numpy as np
+import pytest
+from PIL import Image
+from fusion import (load_gray_images, load_color_images, fuse_chroma, color_to_rgb, color_dwt_fusion,
+                    nway_dwt_fusion, chroma_size)
+
+@pytest.fixture
+def color_paths(tmp_path, make_images):
+    paths = []
+    for i in range(3):
+        planes = make_images((96, 128), 3, 'smooth', seed=i)
+        path = tmp_path / f"image_{i}.{'jpg' if i else 'png'}"
+        Image.fromarray(np.dstack(planes)).save(path)
+        paths.append(str(path))
+    return paths
+
+def test_color_luma_matches_gray(color_paths):
+    size = (96, 128)
+    luma, chroma = load_color_images(color_paths, size)
+    gray = load_gray_images(color_paths, size)
+    for luma_plane, gray_plane in zip(luma, gray):
+        np.testing.assert_array_equal(luma_plane, gray_plane)
+    assert chroma.shape == (3,) + chroma_size(size) + (2,)
+
+    fused_luma, fused_chroma = color_dwt_fusion(luma, chroma, 'db4', 2, 'float64')
+    np.testing.assert_array_equal(fused_luma, nway_dwt_fusion(gray, 'db4', 2, 'float64'))
+    assert fused_chroma.shape == chroma_size(size) + (2,)
+
+def test_gray_chroma_stays_gray():
+    stack = np.full((3, 8, 8, 2), 128, dtype=np.uint8)
+    stack[1, ..., 0] = 200
+    stack[1, :4] = 128
+    fused = fuse_chroma(stack)
+    # Where one source is colorful it dominates; where none is, the average
+    assert (fused[4:, :, 0] > 180).all()
+    assert (fused[:4] == 128).all()
+
+    luma = np.arange(256, dtype=np.uint8).reshape(16, 16)
+    rgb = color_to_rgb(luma, np.full((8, 8, 2), 128, dtype=np.uint8))
+    for channel in range(3):
+        np.testing.assert_array_equal(rgb[..., channel], luma)
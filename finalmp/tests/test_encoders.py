@@ -0,0 +1,16 @@
+import numpy as np
+import pytest
+from PIL import Image
+from encoders import RENDITIONS, ensure_rendition, save_result_image
+
+@pytest.mark.parametrize('mode', ['L', 'RGB'])
+def test_rendition_keeps_result_mode(tmp_path, make_images, mode):
+    planes = make_images((600, 800), 3, 'smooth')
+    image = planes[0] if mode == 'L' else np.dstack(planes)
+    result_path = str(tmp_path / 'fusion_1.png')
+    save_result_image(image, result_path)
+
+    for name, max_side in RENDITIONS.items():
+        with Image.open(ensure_rendition(result_path, name)) as rendition:
+            assert rendition.mode == mode
+            assert max(rendition.size) == min(max_side, 800)
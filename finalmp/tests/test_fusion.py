@@ -0,0 +1,15 @@
+import numpy as np
+import pytest
+from fusion import multi_image_dwt_fusion
+
+@pytest.mark.parametrize('wavelet', ['haar', 'db2', 'db4'])
+@pytest.mark.parametrize('kind', ['blocks', 'smooth'])
+def test_nway_matches_pairwise_for_two_images(make_images, wavelet, kind):
+    # process_fusion always fuses at an even size (see target_size)
+    images = make_images((130, 98), 2, kind)
+    pairwise = multi_image_dwt_fusion(images, wavelet, pairwise=True)
+    nway = multi_image_dwt_fusion(images, wavelet, levels=1, precision='float64', rule='max_abs')
+    np.testing.assert_array_equal(nway, pairwise)
+
+def test_fusion_needs_two_images(make_images):
+    assert multi_image_dwt_fusion(make_images((32, 32), 1)) is None
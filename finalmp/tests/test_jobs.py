@@ -0,0 +1,61 @@
+import queue
+from app import db
+from models import FusionSession, FusionJob, UploadedImage
+from jobs import enqueue_fusion_job, max_running_jobs, WAITING_FOR_WORKER
+
+def queue_job(make_session):
+    fusion_session = make_session()
+    job = enqueue_fusion_job(fusion_session)
+    db.session.commit()
+    return job
+
+def test_max_running_jobs_defaults_to_fusion_workers(app):
+    assert max_running_jobs({'FUSION_WORKERS': 3}) == 3
+    assert max_running_jobs({'FUSION_WORKERS': 3, 'FUSION_MAX_RUNNING_JOBS': 5}) == 5
+
+def test_claim_holds_all_dispatchers_to_the_running_limit(app, make_session):
+    from jobs import JobDispatcher
+
+    # Two dispatchers, as in two web processes, sharing one database
+    dispatchers = [JobDispatcher(app, 4), JobDispatcher(app, 4)]
+    jobs = [queue_job(make_session) for _ in range(3)]
+
+    assert dispatchers[0]._claim(jobs[0], limit=2)
+    assert dispatchers[1]._claim(jobs[1], limit=2)
+    assert not dispatchers[0]._claim(jobs[2], limit=2)
+    db.session.commit()
+    assert [db.session.get(FusionJob, job.id).status for job in jobs] == ['running', 'running', 'queued']
+
+    jobs[0].status = 'completed'
+    db.session.commit()
+    assert dispatchers[1]._claim(jobs[2], limit=2)
+
+def test_tick_shows_jobs_waiting_for_a_worker(app, make_session):
+    app.config['FUSION_MAX_RUNNING_JOBS'] = 1
+    dispatcher = app.extensions['fusion_jobs']
+    running, waiting = queue_job(make_session), queue_job(make_session)
+    assert dispatcher._claim(running, limit=1)
+    db.session.commit()
+
+    dispatcher._progress_queue = queue.Queue()
+    dispatcher._tick()
+    db.session.refresh(waiting)
+    assert waiting.status == 'queued'
+    assert waiting.stage == WAITING_FOR_WORKER
+
+def test_job_that_cannot_start_fails(app, make_session):
+    job = queue_job(make_session)
+    db.session.add(UploadedImage(fusion_session_id=job.fusion_session_id, filename='missing.png',
+                                 original_filename='missing.png'))
+    db.session.commit()
+
+    dispatcher = app.extensions['fusion_jobs']
+    assert dispatcher._claim(job, limit=1)
+    db.session.commit()
+    dispatcher._submit(job)
+
+    job = db.session.get(FusionJob, job.id)
+    assert job.status == 'failed'
+    assert job.error
+    assert db.session.get(FusionSession, job.fusion_session_id).status == 'failed'
+    assert job.id not in dispatcher._futures
@@ -0,0 +1,28 @@
+import numpy as np
+import pytest
+from fusion import nway_dwt_fusion
+from fusion_rules import RULES
+from parallel_fusion import parallel_multi_image_dwt_fusion, split_stripes
+
+@pytest.mark.parametrize('rule', list(RULES))
+@pytest.mark.parametrize('wavelet', ['haar', 'db2', 'db4'])
+@pytest.mark.parametrize('levels', [1, 2, 3])
+def test_striped_matches_serial(make_images, rule, wavelet, levels):
+    images = make_images((514, 258), 3, 'blocks')
+    serial = nway_dwt_fusion(images, wavelet, levels, 'float64', rule=rule)
+    striped = parallel_multi_image_dwt_fusion(images, wavelet, levels, 'float64', workers=3, rule=rule)
+    np.testing.assert_array_equal(striped, serial)
+
+@pytest.mark.parametrize('rule', list(RULES))
+def test_striped_matches_serial_float32(make_images, rule):
+    images = make_images((514, 258), 4, 'smooth')
+    serial = nway_dwt_fusion(images, 'db4', 2, 'float32', rule=rule)
+    striped = parallel_multi_image_dwt_fusion(images, 'db4', 2, 'float32', workers=3, rule=rule)
+    np.testing.assert_array_equal(striped, serial)
+
+def test_stripes_are_aligned_and_cover_the_image():
+    stripes = split_stripes(514, 258, 3, levels=3)
+    assert len(stripes) == 3
+    assert stripes[0][0] == 0 and stripes[-1][1] == 514
+    for (_, end, _, _), (start, _, _, _) in zip(stripes, stripes[1:]):
+        assert end == start and start % 8 == 0
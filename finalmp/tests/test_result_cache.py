@@ -0,0 +1,60 @@
+import os
+import pytest
+from app import db
+from models import UploadedImage, ResultCacheEntry
+from fusion_settings import fusion_parameters
+from result_cache import fusion_cache_key, lookup_result, store_result
+
+@pytest.fixture
+def images(app, make_session):
+    fusion_session = make_session()
+    images = []
+    for i in range(2):
+        filename = f"image_{i}.png"
+        with open(os.path.join(app.config['UPLOAD_FOLDER'], filename), 'wb') as f:
+            f.write(f"image {i}".encode())
+        image = UploadedImage(fusion_session_id=fusion_session.id, filename=filename, original_filename=filename)
+        db.session.add(image)
+        images.append(image)
+    db.session.commit()
+    return images
+
+def cache_result(app, cache_key):
+    path = os.path.join(app.config['RESULT_FOLDER'], 'fusion_1.png')
+    with open(path, 'wb') as f:
+        f.write(b'result')
+    return store_result(cache_key, path)
+
+def test_same_inputs_and_parameters_hit(app, images):
+    cache_key = fusion_cache_key(images, fusion_parameters())
+    assert lookup_result(cache_key) is None
+
+    filename = cache_result(app, cache_key)
+    db.session.commit()
+    # The order the images were uploaded in does not matter
+    assert fusion_cache_key(images[::-1], fusion_parameters()) == cache_key
+    assert lookup_result(cache_key).filename == filename
+    assert os.path.exists(os.path.join(app.config['RESULT_FOLDER'], filename))
+
+@pytest.mark.parametrize('changed', [
+    {'wavelet': 'haar'}, {'levels': 2}, {'precision': 'float32'}, {'rule': 'local_energy'},
+    {'color': True}, {'tiled': True}, {'result_format': 'webp'}, {'compress_level': 6}
+])
+def test_parameter_changes_miss(app, images, changed):
+    cache_result(app, fusion_cache_key(images, fusion_parameters()))
+    db.session.commit()
+    assert lookup_result(fusion_cache_key(images, fusion_parameters(**changed))) is None
+
+def test_input_changes_miss(app, images):
+    cache_key = fusion_cache_key(images, fusion_parameters())
+    cache_result(app, cache_key)
+    db.session.commit()
+    assert lookup_result(fusion_cache_key(images[:1], fusion_parameters())) is None
+
+def test_entry_with_missing_file_is_dropped(app, images):
+    cache_key = fusion_cache_key(images, fusion_parameters())
+    filename = cache_result(app, cache_key)
+    db.session.commit()
+    os.remove(os.path.join(app.config['RESULT_FOLDER'], filename))
+    assert lookup_result(cache_key) is None
+    assert ResultCacheEntry.query.count() == 0
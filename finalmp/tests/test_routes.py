@@ -0,0 +1,25 @@
+import pytest
+from models import FusionSession
+
+VALID_FORM = {'session_name': 'scene', 'num_images': '3', 'wavelet': 'db4', 'levels': '2',
+              'precision': 'float64', 'color_mode': 'gray', 'fusion_rule': 'max_abs'}
+
+def test_fusion_form_creates_a_session(client):
+    response = client.post('/fusion', data=VALID_FORM)
+    assert response.status_code == 302
+    fusion_session = FusionSession.query.one()
+    assert (fusion_session.num_images, fusion_session.levels) == (3, 2)
+
+@pytest.mark.parametrize('field, value', [
+    ('num_images', 'three'), ('num_images', ''), ('num_images', '1'), ('num_images', '2.5'),
+    ('levels', 'x'), ('levels', '0'), ('session_name', '')
+])
+def test_fusion_form_rejects_bad_input(client, field, value):
+    response = client.post('/fusion', data=dict(VALID_FORM, **{field: value}))
+    assert response.status_code == 400
+    assert FusionSession.query.count() == 0
+
+def test_fusion_form_without_num_images_is_rejected(client):
+    form = dict(VALID_FORM)
+    del form['num_images']
+    assert client.post('/fusion', data=form).status_code == 400
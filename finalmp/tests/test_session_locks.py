@@ -0,0 +1,35 @@
+import threading
+import time
+from session_locks import SessionLocks
+
+def test_tasks_on_a_session_are_serialized_and_forgotten():
+    locks = SessionLocks()
+    active = {1: 0, 2: 0}
+    overlaps = []
+
+    def task(session_id):
+        with locks.hold(session_id):
+            active[session_id] += 1
+            overlaps.append(active[session_id] > 1)
+            time.sleep(0.01)
+            active[session_id] -= 1
+
+    threads = [threading.Thread(target=task, args=(session_id,)) for session_id in (1, 2) * 4]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(overlaps) == 8 and not any(overlaps)
+    assert len(locks) == 0
+
+def test_lock_is_released_when_the_task_fails():
+    locks = SessionLocks()
+    try:
+        with locks.hold(1):
+            raise RuntimeError
+    except RuntimeError:
+        pass
+    assert len(locks) == 0
+    with locks.hold(1):
+        assert len(locks) == 1
@@ -0,0 +1,75 @@
+import io
+import os
+from datetime import datetime, timedelta
+from app import db
+from models import FusionSession, UploadedImage
+from storage import user_storage_bytes
+
+def add_image(app, fusion_session, filename, size=100, **values):
+    with open(os.path.join(app.config['UPLOAD_FOLDER'], filename), 'wb') as f:
+        f.write(b'x' * size)
+    image = UploadedImage(fusion_session_id=fusion_session.id, filename=filename, original_filename=filename,
+                          file_size=size, **values)
+    db.session.add(image)
+    db.session.commit()
+    return image
+
+def age(path, seconds):
+    then = datetime.now().timestamp() - seconds
+    os.utime(path, (then, then))
+
+def test_uploads_over_quota_are_rejected(app, client, make_session):
+    app.config['USER_STORAGE_QUOTA'] = 250
+    fusion_session = make_session(num_images=4, image_slots=0)
+    add_image(app, fusion_session, 'stored.png', 200)
+    assert user_storage_bytes(fusion_session.user_id) == 200
+
+    response = client.post(f'/upload_file/{fusion_session.id}',
+                           data={'file': (io.BytesIO(b'x' * 100), 'more.png')})
+    assert response.status_code == 413
+    assert response.get_json()['used_bytes'] == 200
+    app.extensions['fusion_storage'].drain()
+    assert sorted(os.listdir(app.config['UPLOAD_FOLDER'])) == ['stored.png']
+    db.session.expire_all()
+    assert db.session.get(FusionSession, fusion_session.id).image_slots == 0
+
+    response = client.post(f'/upload_init/{fusion_session.id}', json={'files': [{'name': 'big.png', 'size': 51}]})
+    assert response.status_code == 413
+    response = client.post(f'/upload_init/{fusion_session.id}', json={'files': [{'name': 'fits.png', 'size': 50}]})
+    assert response.status_code == 200
+
+def test_sweep_expires_idle_pending_and_failed_sessions(app, make_session):
+    old = datetime.utcnow() - timedelta(days=8)
+    idle = make_session(created_at=old)
+    failed = make_session(status='failed', created_at=old)
+    recent = make_session(created_at=old)
+    completed = make_session(status='completed', created_at=old)
+    add_image(app, idle, 'idle.png', uploaded_at=old)
+    add_image(app, recent, 'recent.png')
+    add_image(app, completed, 'completed.png', uploaded_at=old)
+    ids = [s.id for s in (idle, failed, recent, completed)]
+
+    storage = app.extensions['fusion_storage']
+    storage.sweep()
+    storage.drain()
+
+    db.session.expire_all()
+    assert [db.session.get(FusionSession, i) is not None for i in ids] == [False, False, True, True]
+    assert sorted(os.listdir(app.config['UPLOAD_FOLDER'])) == ['completed.png', 'recent.png']
+
+def test_sweep_collects_old_orphans_only(app, make_session):
+    add_image(app, make_session(), 'kept.png')
+    folder = app.config['RESULT_FOLDER']
+    for name in ('orphan.png', 'fresh.png'):
+        with open(os.path.join(folder, name), 'wb') as f:
+            f.write(b'x')
+    age(os.path.join(folder, 'orphan.png'), 2 * 60 * 60)
+    age(os.path.join(app.config['UPLOAD_FOLDER'], 'kept.png'), 2 * 60 * 60)
+
+    storage = app.extensions['fusion_storage']
+    usage = storage.sweep()
+    storage.drain()
+
+    assert os.listdir(folder) == ['fresh.png']
+    assert os.listdir(app.config['UPLOAD_FOLDER']) == ['kept.png']
+    assert usage['uploads'] == (100, 1)
@@ -0,0 +1,101 @@
+import os
+import struct
+import subprocess
+import sys
+from itertools import accumulate
+import numpy as np
+import pytest
+from PIL import Image, TiffImagePlugin, TiffTags
+from fusion import nway_dwt_fusion, load_gray_image
+from fusion_rules import RULES, box_mean
+from tiled_fusion import tiled_multi_image_dwt_fusion, spill_gray_image, TiffStrips
+
+APP_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def save_tiled_tiff(path, pixels, tile=32):
+    """Write pixels as an uncompressed tiled TIFF, which PIL cannot save"""
+    height, width = pixels.shape[:2]
+    samples = 1 if pixels.ndim == 2 else pixels.shape[2]
+    padded = np.zeros((-(-height // tile) * tile, -(-width // tile) * tile) + pixels.shape[2:], np.uint8)
+    padded[:height, :width] = pixels
+    tiles = [padded[y:y + tile, x:x + tile].tobytes()
+             for y in range(0, padded.shape[0], tile) for x in range(0, padded.shape[1], tile)]
+    data = b''.join(tiles)
+
+    ifd = TiffImagePlugin.ImageFileDirectory_v2()
+    ifd[256], ifd[257], ifd[258], ifd[259] = width, height, (8,) * samples, 1
+    ifd[262], ifd[277], ifd[322], ifd[323] = 1 if samples == 1 else 2, samples, tile, tile
+    ifd.tagtype[324] = ifd.tagtype[325] = TiffTags.LONG
+    ifd[324] = tuple(accumulate((len(t) for t in tiles[:-1]), initial=8))
+    ifd[325] = tuple(len(t) for t in tiles)
+    with open(path, 'wb') as f:
+        f.write(b'II*\x00' + struct.pack('<I', 8 + len(data)) + data + ifd.tobytes(8 + len(data)))
+
+@pytest.mark.parametrize('rule', list(RULES))
+@pytest.mark.parametrize('wavelet', ['haar', 'db2', 'db4'])
+@pytest.mark.parametrize('levels', [1, 3])
+@pytest.mark.parametrize('kind', ['blocks', 'smooth'])
+def test_tiled_matches_serial(make_images, rule, wavelet, levels, kind):
+    images = make_images((514, 258), 3, kind)
+    serial = nway_dwt_fusion(images, wavelet, levels, 'float64', rule=rule)
+    tiled = np.zeros_like(serial)
+    assert tiled_multi_image_dwt_fusion(images, tiled, wavelet, 64, levels, 'float64', rule=rule)
+    np.testing.assert_array_equal(tiled, serial)
+
+@pytest.mark.parametrize('window', [3, 5, 8])
+def test_box_mean_ignores_crop_origin(window):
+    planes = np.random.default_rng(1).normal(size=(2, 60, 50))
+    whole = box_mean(planes, window)
+    crop = box_mean(planes[:, 7:, 13:], window)
+    reach = window // 2
+    np.testing.assert_array_equal(crop[:, reach:-reach, reach:-reach],
+                                  whole[:, 7 + reach:-reach, 13 + reach:-reach])
+
+@pytest.mark.parametrize('compression', [None, 'tiff_deflate', 'tiff_lzw', 'packbits', 'jpeg', 'tiled', 'png'])
+@pytest.mark.parametrize('channels', [1, 3])
+def test_spill_matches_untiled_inputs(tmp_path, make_images, compression, channels):
+    planes = make_images((301, 413), channels, 'smooth')
+    pixels = planes[0] if channels == 1 else np.dstack(planes)
+    path = str(tmp_path / f"input.{'png' if compression == 'png' else 'tif'}")
+    if compression == 'tiled':
+        save_tiled_tiff(path, pixels)
+    else:
+        Image.fromarray(pixels).save(path, compression=compression)
+    assert (TiffStrips.open(path) is None) == (compression == 'png')
+
+    # Unresized pixels are exact; resized ones within a grey level of cv2
+    spill = spill_gray_image(path, (301, 413), str(tmp_path / 'same.npy'))
+    np.testing.assert_array_equal(spill, load_gray_image(path, (301, 413)))
+    for size in [(300, 412), (150, 206), (640, 500)]:
+        spill = spill_gray_image(path, size, str(tmp_path / 'resized.npy'))
+        assert spill.shape == size
+        assert np.abs(spill.astype(int) - load_gray_image(path, size)).max() <= 1
+
+SPILL_PEAK = """
+import sys
+from tiled_fusion import spill_gray_image
+
+def peak_kb():
+    # VmHWM belongs to this process image; ru_maxrss would carry the peak
+    # of the forking pytest process over the exec
+    with open('/proc/self/status') as status:
+        return next(int(line.split()[1]) for line in status if line.startswith('VmHWM:'))
+
+before = peak_kb()
+assert spill_gray_image(sys.argv[1], (int(sys.argv[2]), int(sys.argv[3])), sys.argv[4]) is not None
+print(peak_kb() - before)
+"""
+
+@pytest.mark.skipif(not os.path.exists('/proc/self/status'), reason='peak memory is read from /proc')
+def test_spill_peak_memory_is_bounded(tmp_path):
+    y, x = np.ogrid[:12000, :6000]
+    path = str(tmp_path / 'large.tif')
+    Image.fromarray(((x // 7 + y // 5) % 256).astype(np.uint8)).save(path, compression='tiff_deflate')
+    del x, y
+
+    # Decoding whole would take 72 MB for the image, and as much again for
+    # its copy; spilling by strips stays well under half of one
+    for size in [(12000, 6000), (11998, 5990)]:
+        result = subprocess.run([sys.executable, '-c', SPILL_PEAK, path, *map(str, size), str(tmp_path / 'spill.npy')],
+                                cwd=APP_ROOT, capture_output=True, text=True, check=True)
+        assert int(result.stdout) * 1024 < 12000 * 6000 // 2
@@ -0,0 +1,39 @@
+import threading
+from app import db
+from models import FusionSession
+from uploads import reserve_image_slots, release_image_slots
+
+def test_concurrent_reservations_never_exceed_the_session(app, make_session):
+    fusion_session = make_session(num_images=5, image_slots=0)
+    session_id = fusion_session.id
+    barrier = threading.Barrier(12)
+    claimed = []
+
+    def upload():
+        with app.app_context():
+            target = db.session.get(FusionSession, session_id)
+            barrier.wait()
+            if reserve_image_slots(target):
+                claimed.append(True)
+            db.session.commit()
+            db.session.remove()
+
+    threads = [threading.Thread(target=upload) for _ in range(12)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    db.session.expire_all()
+    assert len(claimed) == 5
+    assert db.session.get(FusionSession, session_id).image_slots == 5
+
+def test_released_slots_can_be_claimed_again(app, make_session):
+    fusion_session = make_session(num_images=2, image_slots=0)
+    assert reserve_image_slots(fusion_session, 2)
+    assert not reserve_image_slots(fusion_session)
+    release_image_slots(fusion_session.id)
+    assert reserve_image_slots(fusion_session)
+    db.session.commit()
+    db.session.expire_all()
+    assert db.session.get(FusionSession, fusion_session.id).image_slots == 2
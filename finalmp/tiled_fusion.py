@@ -0,0 +1,314 @@
+import io
+import os
+import shutil
+import struct
+import tempfile
+import logging
+from itertools import accumulate
+import numpy as np
+from PIL import Image, TiffImagePlugin, TiffTags
+from fusion import load_gray_image, target_size, nway_dwt_fusion, enhance_contrast, report_progress, effective_levels
+from fusion_settings import tile_halo, tiff_strip_rows, SPILL_BAND_ROWS
+from fusion_rules import DEFAULT_RULE
+from profiling import timed
+from encoders import save_result_image, write_renditions, DEFAULT_RESULT_FORMAT, DEFAULT_PNG_COMPRESS_LEVEL
+
+DEFAULT_TILE_SIZE = 1024
+
+# Tags a one-strip TIFF takes from its source: everything describing how
+# pixels are stored, but none of the file offsets
+STRIP_LAYOUT_TAGS = (256, 258, 259, 262, 277, 284, 317, 320, 322, 323, 338, 339, 347, 530, 531, 532)
+
+# Fixed-point scale of the interpolation weights in cv2.INTER_LINEAR
+LINEAR_WEIGHT_SCALE = 2048
+
+class TiffStrips:
+    """Decode a TIFF to gray a strip at a time
+
+    A strip, or a row of tiles, is the smallest part of a TIFF that can be
+    decoded on its own, but PIL only decodes whole images. So each strip
+    is copied, with the source's layout tags, into a one-strip TIFF in
+    memory and decoded from there, which works for every compression
+    libtiff reads. The gray conversion is pointwise, so converting strip by
+    strip gives the pixels of converting the whole image.
+    """
+
+    def __init__(self, image_path, img):
+        tags = img.tag_v2
+        self.image_path = image_path
+        self.width, self.height = img.size
+        self.strip_rows = tiff_strip_rows(img)
+        self.tiled = 324 in tags
+        if self.tiled:
+            across = -(-self.width // tags[322])
+            offsets, counts = tags[324], tags[325]
+        else:
+            across = 1
+            offsets, counts = tags[273], tags[279]
+        self.strips = [(offsets[i:i + across], counts[i:i + across]) for i in range(0, len(offsets), across)]
+        self.layout = {tag: (tags.tagtype[tag], tags[tag]) for tag in STRIP_LAYOUT_TAGS if tag in tags}
+        self.decoded = {}
+
+    @classmethod
+    def open(cls, image_path):
+        """TiffStrips for image_path, or None if it cannot be read by strips"""
+        with Image.open(image_path) as img:
+            if tiff_strip_rows(img) is None:
+                return None
+            strips = cls(image_path, img)
+        if len(strips.strips) != -(-strips.height // strips.strip_rows):
+            return None
+        return strips
+
+    def decode_strip(self, index):
+        offsets, counts = self.strips[index]
+        rows = min(self.strip_rows, self.height - index * self.strip_rows)
+
+        ifd = TiffImagePlugin.ImageFileDirectory_v2()
+        for tag, (tagtype, value) in self.layout.items():
+            ifd.tagtype[tag] = tagtype
+            ifd[tag] = value
+        ifd[257] = rows
+        offset_tag, count_tag = (324, 325) if self.tiled else (273, 279)
+        if not self.tiled:
+            ifd[278] = rows
+        ifd.tagtype[offset_tag] = ifd.tagtype[count_tag] = TiffTags.LONG
+        ifd[count_tag] = counts
+        starts = tuple(accumulate(counts[:-1], initial=0))
+        if self.tiled:
+            # tobytes moves strip offsets past the directory, tile offsets
+            # have to be placed by hand
+            ifd[offset_tag] = starts
+            data_start = 8 + len(ifd.tobytes(8))
+            starts = tuple(data_start + start for start in starts)
+        ifd[offset_tag] = starts
+
+        parts = [b'II*\x00' + struct.pack('<I', 8) + ifd.tobytes(8)]
+        with open(self.image_path, 'rb') as source:
+            for offset, count in zip(offsets, counts):
+                source.seek(offset)
+                parts.append(source.read(count))
+
+        with Image.open(io.BytesIO(b''.join(parts))) as strip:
+            if strip.mode != 'L':
+                strip = strip.convert('L')
+            return np.asarray(strip)
+
+    def rows(self, y0, y1):
+        """Gray rows [y0, y1), decoding only the strips they lie in
+
+        The strips of the last call are kept, so reading consecutive,
+        overlapping bands decodes every strip once.
+        """
+        first, last = y0 // self.strip_rows, (y1 - 1) // self.strip_rows
+        self.decoded = {index: self.decoded[index] if index in self.decoded else self.decode_strip(index)
+                        for index in range(first, last + 1)}
+        strips = [self.decoded[index] for index in range(first, last + 1)]
+        band = strips[0] if len(strips) == 1 else np.concatenate(strips)
+        return band[y0 - first * self.strip_rows:y1 - first * self.strip_rows]
+
+def linear_taps(size, source_size):
+    """Source indices and fixed-point weights of cv2.INTER_LINEAR resizing
+
+    Returns, for every output index, the two source indices it blends and
+    the weight of the second one, in units of LINEAR_WEIGHT_SCALE.
+    """
+    position = (np.arange(size) + 0.5) * (source_size / size) - 0.5
+    first = np.floor(position)
+    fraction = position - first
+    first = first.astype(np.intp)
+    fraction[first < 0] = 0
+    first[first < 0] = 0
+    edge = first >= source_size - 1
+    fraction[edge] = 0
+    first[edge] = source_size - 1
+    weight = np.rint(fraction * LINEAR_WEIGHT_SCALE).astype(np.int32)
+    return first, np.minimum(first + 1, source_size - 1), weight
+
+def resize_rows(read_rows, source_size, size, band_rows=SPILL_BAND_ROWS):
+    """Yield an image resized to size, a band of rows at a time
+
+    read_rows(y0, y1) returns source rows y0 to y1. A band holds at most
+    band_rows rows, and reads about as many source rows, plus the row below
+    them that the interpolation blends in. Resizing uses the taps and fixed-point rounding of
+    cv2.resize with INTER_LINEAR, but not OpenCV's vectorised shortcuts,
+    so pixels can differ from cv2.resize by one grey level.
+    """
+    height, width = size
+    if source_size == size:
+        for y0 in range(0, height, band_rows):
+            yield read_rows(y0, min(y0 + band_rows, height))
+        return
+
+    x_first, x_next, x_weight = linear_taps(width, source_size[1])
+    y_first, y_next, y_weight = linear_taps(height, source_size[0])
+    step = max(1, min(band_rows, band_rows * height // source_size[0]))
+    for y0 in range(0, height, step):
+        y1 = min(y0 + step, height)
+        top = y_first[y0]
+        rows = read_rows(top, y_next[y1 - 1] + 1)
+        blended = rows[:, x_first] * (LINEAR_WEIGHT_SCALE - x_weight)
+        blended += rows[:, x_next] * x_weight
+        blended >>= 4
+        weight = y_weight[y0:y1, None]
+        upper = blended[y_first[y0:y1] - top]
+        upper *= LINEAR_WEIGHT_SCALE - weight
+        upper >>= 16
+        lower = blended[y_next[y0:y1] - top]
+        lower *= weight
+        lower >>= 16
+        upper += lower
+        upper += 2
+        upper >>= 2
+        yield upper.astype(np.uint8)
+
+def spill_gray_image(image_path, size, spill_path):
+    """Decode one image to gray at the target size into a memory-mapped file
+
+    TIFFs are decoded a few strips at a time with TiffStrips and resized
+    band by band with resize_rows, so spilling them holds a band, not the
+    image. Other formats cannot be decoded in parts and are loaded whole
+    with load_gray_image. The spilled pixels match the untiled inputs
+    exactly unless a TIFF has to be resized, see resize_rows.
+    """
+    height, width = size
+    try:
+        strips = TiffStrips.open(image_path)
+        with open(spill_path, 'wb') as spill:
+            np.lib.format.write_array_header_1_0(spill, {'descr': '|u1', 'fortran_order': False,
+                                                         'shape': (height, width)})
+            if strips is None:
+                gray_img = load_gray_image(image_path, size)
+                if gray_img is None:
+                    return None
+                gray_img.tofile(spill)
+            else:
+                for band in resize_rows(strips.rows, (strips.height, strips.width), size):
+                    band.tofile(spill)
+    except Exception as e:
+        logging.error(f"Error spilling image {image_path}: {str(e)}")
+        return None
+
+    return np.load(spill_path, mmap_mode='r')
+
+def iter_tiles(height, width, tile_size):
+    """Yield (y0, y1, x0, x1) bounds of the tiles covering an image"""
+    for y0 in range(0, height, tile_size):
+        for x0 in range(0, width, tile_size):
+            yield y0, min(y0 + tile_size, height), x0, min(x0 + tile_size, width)
+
+def fuse_tile(sources, output, bounds, halo, wavelet='db4', levels=1, precision='float64', timer=None,
+              rule=DEFAULT_RULE):
+    """Fuse one tile of the sources into output
+
+    The tile is read with a halo from every source, clamped to the image,
+    fused with nway_dwt_fusion and cropped back to its interior. Tile
+    bounds must lie on the dyadic grid of every level (multiples of
+    2**levels, or the image edge), which keeps the expanded bounds aligned
+    because the halo is a multiple of 2**levels too. The halo must cover
+    the reach of rule, see tile_halo.
+    """
+    height, width = output.shape
+    y0, y1, x0, x1 = bounds
+    ry0, ry1 = max(y0 - halo, 0), min(y1 + halo, height)
+    rx0, rx1 = max(x0 - halo, 0), min(x1 + halo, width)
+
+    tiles = [np.asarray(source[ry0:ry1, rx0:rx1]) for source in sources]
+    fused_tile = nway_dwt_fusion(tiles, wavelet, levels, precision, timer, rule)
+    if fused_tile is None:
+        logging.error(f"Fusion failed for tile at ({y0}, {x0})")
+        return False
+
+    output[y0:y1, x0:x1] = fused_tile[y0 - ry0:y1 - ry0, x0 - rx0:x1 - rx0]
+    return True
+
+def tiled_multi_image_dwt_fusion(sources, output, wavelet='db4', tile_size=DEFAULT_TILE_SIZE, levels=1,
+                                 precision='float64', timer=None, rule=DEFAULT_RULE):
+    """Fuse equally sized sources tile by tile into a preallocated output
+
+    sources are 2-D arrays, usually memory-mapped, and output is a writable
+    array of the same shape. Tiles are fused one at a time with fuse_tile,
+    so peak memory depends on the tile size and not on the image size.
+    """
+    if len(sources) < 2:
+        logging.error("Need at least 2 images for fusion")
+        return False
+
+    if tile_size % (2 ** levels):
+        logging.error(f"Tile size must be a multiple of {2 ** levels}, got {tile_size}")
+        return False
+
+    height, width = output.shape
+    halo = tile_halo(wavelet, levels, rule)
+
+    for bounds in iter_tiles(height, width, tile_size):
+        if not fuse_tile(sources, output, bounds, halo, wavelet, levels, precision, timer, rule):
+            return False
+
+    return True
+
+def process_tiled_fusion(image_paths, output_path, wavelet='db4', tile_size=DEFAULT_TILE_SIZE, work_dir=None,
+                         progress=None, levels=1, precision='float64', timer=None,
+                         result_format=DEFAULT_RESULT_FORMAT, compress_level=DEFAULT_PNG_COMPRESS_LEVEL,
+                         renditions=False, rule=DEFAULT_RULE):
+    """Fuse large images out of core and save the result
+
+    Inputs are decoded one at a time into memory-mapped gray files, fused
+    tile by tile into a memory-mapped output and contrast enhanced per tile.
+    The result is encoded as a single-channel image straight from the
+    mapping, so no full-size copy is made. Peak memory is the larger of
+    what spilling one input holds, a band for TIFFs but the whole decoded
+    image for other formats (see spill_gray_image), and the working set of
+    one tile; estimate_fusion_memory counts both.
+    """
+    spill_dir = tempfile.mkdtemp(prefix='tiled_fusion_', dir=work_dir)
+    try:
+        logging.info(f"Starting tiled fusion process with {len(image_paths)} images")
+        report_progress(progress, 'loading', 5)
+
+        size = target_size(image_paths)
+        logging.info(f"Images resized to: {size}")
+
+        sources = []
+        for i, path in enumerate(image_paths):
+            with timed(timer, 'decode'):
+                source = spill_gray_image(path, size, os.path.join(spill_dir, f"source_{i}.npy"))
+            if source is None:
+                logging.error(f"Failed to load image: {path}")
+                return False
+            sources.append(source)
+
+        report_progress(progress, 'fusing', 40)
+        output = np.lib.format.open_memmap(os.path.join(spill_dir, 'fused.npy'), mode='w+',
+                                           dtype=np.uint8, shape=size)
+        levels = effective_levels(size, wavelet, levels)
+        if not tiled_multi_image_dwt_fusion(sources, output, wavelet, tile_size, levels, precision, timer, rule):
+            logging.error("Tiled DWT fusion failed")
+            return False
+
+        # Contrast enhancement is pointwise, so it can run tile by tile too
+        report_progress(progress, 'enhancing', 80)
+        with timed(timer, 'enhance'):
+            for y0, y1, x0, x1 in iter_tiles(size[0], size[1], tile_size):
+                output[y0:y1, x0:x1] = enhance_contrast(output[y0:y1, x0:x1])
+            output.flush()
+
+        report_progress(progress, 'saving', 90)
+        with timed(timer, 'encode'):
+            save_result_image(output, output_path, result_format, compress_level)
+        if renditions:
+            with timed(timer, 'renditions'):
+                write_renditions(output, output_path)
+        del output, sources
+
+        if timer is not None:
+            timer.input_pixels = len(image_paths) * size[0] * size[1]
+
+        logging.info(f"Tiled fusion completed successfully. Result saved to: {output_path}")
+        return True
+
+    except Exception as e:
+        logging.error(f"Error in tiled fusion process: {str(e)}")
+        return False
+    finally:
+        shutil.rmtree(spill_dir, ignore_errors=True)
@@ -0,0 +1,234 @@
+import os
+import uuid
+import hashlib
+import shutil
+import logging
+import threading
+from datetime import datetime, timedelta
+from flask import current_app
+from app import db
+from models import FusionSession, UploadedImage, ChunkedUpload
+from result_cache import file_content_hash, HASH_CHUNK_SIZE
+from storage import quota_exceeded
+
+# Chunk size suggested to clients; must stay below MAX_CONTENT_LENGTH
+UPLOAD_CHUNK_SIZE = 4 * 1024 * 1024
+
+# Unfinished uploads idle for longer than this give their slot back
+UPLOAD_EXPIRY_SECONDS = 24 * 60 * 60
+
+class UploadError(Exception):
+    """A chunked upload request that cannot be honoured
+
+    status is the HTTP status the route should answer with.
+    """
+
+    def __init__(self, message, status=400, **details):
+        super().__init__(message)
+        self.status = status
+        self.details = details
+
+# Running SHA-256 of uploads whose chunks all arrived in this process, as
+# upload id -> (bytes hashed, hash object). Uploads resumed elsewhere, or
+# after a restart, are hashed from disk when they are finalized.
+_hashers = {}
+_hashers_lock = threading.Lock()
+
+def reserve_image_slots(fusion_session, count=1):
+    """Atomically claim room for count more images in a session
+
+    image_slots counts uploaded images plus unfinished uploads. It is only
+    ever changed with conditional updates, so concurrent uploads cannot
+    take more slots than the session has. Returns True if the slots were
+    claimed; the caller commits.
+    """
+    # Sessions created before the counter existed start from their images
+    FusionSession.query.filter_by(id=fusion_session.id, image_slots=None).update({
+        'image_slots': db.session.query(db.func.count(UploadedImage.id))
+                         .filter(UploadedImage.fusion_session_id == fusion_session.id).scalar_subquery()
+    }, synchronize_session=False)
+
+    claimed = FusionSession.query.filter(
+        FusionSession.id == fusion_session.id,
+        FusionSession.image_slots + count <= FusionSession.num_images
+    ).update({'image_slots': FusionSession.image_slots + count}, synchronize_session=False)
+    return claimed == 1
+
+def release_image_slots(fusion_session_id, count=1):
+    """Give back slots claimed by reserve_image_slots; the caller commits"""
+    FusionSession.query.filter(FusionSession.id == fusion_session_id, FusionSession.image_slots >= count) \
+        .update({'image_slots': FusionSession.image_slots - count}, synchronize_session=False)
+
+def partial_upload_path(upload):
+    """Where the received data of an unfinished upload is kept"""
+    return os.path.join(current_app.config['UPLOAD_FOLDER'], upload.filename + '.part')
+
+def create_uploads(fusion_session, files):
+    """Start a batch of chunked uploads, one per {'name', 'size'} entry
+
+    All files get a slot or none do. The caller commits.
+    """
+    max_size = current_app.config['MAX_UPLOAD_FILE_SIZE']
+    allowed = current_app.config['ALLOWED_EXTENSIONS']
+    for entry in files:
+        name = entry.get('name') or ''
+        size = entry.get('size')
+        if '.' not in name or name.rsplit('.', 1)[1].lower() not in allowed:
+            raise UploadError(f"Invalid file type: {name}")
+        if not isinstance(size, int) or size <= 0:
+            raise UploadError(f"Invalid size for {name}")
+        if size > max_size:
+            raise UploadError(f"File too large: {name}", 413)
+
+    usage = quota_exceeded(fusion_session.user_id, sum(entry['size'] for entry in files))
+    if usage:
+        raise UploadError('Storage quota exceeded', 413, **usage)
+
+    expire_stale_uploads(fusion_session.id)
+    if not reserve_image_slots(fusion_session, len(files)):
+        raise UploadError('Maximum number of images reached')
+
+    uploads = []
+    for entry in files:
+        name = entry['name']
+        upload = ChunkedUpload(
+            id=uuid.uuid4().hex,
+            fusion_session_id=fusion_session.id,
+            original_filename=name,
+            filename=str(uuid.uuid4()) + '.' + name.rsplit('.', 1)[1].lower(),
+            total_size=entry['size'],
+            received_bytes=0
+        )
+        db.session.add(upload)
+        open(partial_upload_path(upload), 'wb').close()
+        with _hashers_lock:
+            _hashers[upload.id] = (0, hashlib.sha256())
+        uploads.append(upload)
+
+    return uploads
+
+def append_chunk(upload, offset, stream):
+    """Write one chunk read from stream at offset and advance the upload
+
+    offset must equal the bytes received so far; a client that lost track
+    after a dropped connection asks for the upload status and resumes from
+    there. The chunk is hashed as it is read into a file of its own, and
+    only spliced into the partial upload once the conditional update of
+    received_bytes has claimed the offset. A duplicated or retried chunk
+    that loses that race, or one that runs past the declared size, never
+    touches the data already received.
+    """
+    if offset != upload.received_bytes:
+        raise UploadError('Offset does not match received bytes', 409, received_bytes=upload.received_bytes)
+
+    # Hash a copy, so the running hash only moves on if this chunk is kept
+    with _hashers_lock:
+        hash_state = _hashers.get(upload.id)
+    hasher = hash_state[1].copy() if hash_state is not None and hash_state[0] == offset else None
+
+    path = partial_upload_path(upload)
+    chunk_path = f"{path}.{uuid.uuid4().hex}.chunk"
+    remaining = upload.total_size - offset
+    written = 0
+    try:
+        with open(chunk_path, 'wb') as f:
+            for block in iter(lambda: stream.read(HASH_CHUNK_SIZE), b''):
+                written += len(block)
+                if written > remaining:
+                    raise UploadError('Chunk runs past the declared file size')
+                f.write(block)
+                if hasher is not None:
+                    hasher.update(block)
+
+        # Only one request may advance the upload from this offset; the
+        # row stays locked until the caller commits, so no later chunk can
+        # be claimed before this one is in place
+        advanced = ChunkedUpload.query.filter_by(id=upload.id, received_bytes=offset).update({
+            'received_bytes': offset + written,
+            'updated_at': datetime.utcnow()
+        }, synchronize_session=False)
+        if advanced != 1:
+            raise UploadError('Upload was advanced by another request', 409)
+
+        if offset == 0:
+            os.replace(chunk_path, path)
+        else:
+            with open(chunk_path, 'rb') as source, open(path, 'r+b') as f:
+                f.seek(offset)
+                f.truncate()
+                shutil.copyfileobj(source, f, HASH_CHUNK_SIZE)
+    finally:
+        if os.path.exists(chunk_path):
+            os.remove(chunk_path)
+
+    with _hashers_lock:
+        if hasher is not None:
+            _hashers[upload.id] = (offset + written, hasher)
+        else:
+            _hashers.pop(upload.id, None)
+
+    return offset + written
+
+def finalize_upload(upload):
+    """Turn a completely received upload into an UploadedImage
+
+    The upload's slot passes to the image. The caller commits.
+    """
+    if upload.received_bytes != upload.total_size:
+        raise UploadError('Upload is incomplete', 409, received_bytes=upload.received_bytes)
+
+    with _hashers_lock:
+        hash_state = _hashers.pop(upload.id, None)
+
+    partial_path = partial_upload_path(upload)
+    if hash_state is not None and hash_state[0] == upload.total_size:
+        content_hash = hash_state[1].hexdigest()
+    else:
+        content_hash = file_content_hash(partial_path)
+
+    filepath = os.path.join(current_app.config['UPLOAD_FOLDER'], upload.filename)
+    os.replace(partial_path, filepath)
+
+    image = UploadedImage(
+        fusion_session_id=upload.fusion_session_id,
+        filename=upload.filename,
+        original_filename=upload.original_filename,
+        file_size=upload.total_size,
+        content_hash=content_hash
+    )
+    db.session.add(image)
+    db.session.delete(upload)
+    return image
+
+def forget_upload(upload):
+    """Drop the running hash of an upload that will not be finalized"""
+    with _hashers_lock:
+        _hashers.pop(upload.id, None)
+
+def remove_partial_upload(upload):
+    """Delete the received data of an unfinished upload"""
+    forget_upload(upload)
+    path = partial_upload_path(upload)
+    if os.path.exists(path):
+        os.remove(path)
+
+def abort_upload(upload):
+    """Drop an unfinished upload and free its slot; the caller commits"""
+    remove_partial_upload(upload)
+    release_image_slots(upload.fusion_session_id)
+    db.session.delete(upload)
+
+def expire_stale_uploads(fusion_session_id=None):
+    """Abort unfinished uploads that have been idle too long"""
+    cutoff = datetime.utcnow() - timedelta(seconds=current_app.config.get('UPLOAD_EXPIRY_SECONDS',
+                                                                          UPLOAD_EXPIRY_SECONDS))
+    query = ChunkedUpload.query.filter(ChunkedUpload.updated_at < cutoff)
+    if fusion_session_id is not None:
+        query = query.filter_by(fusion_session_id=fusion_session_id)
+
+    expired = query.all()
+    for upload in expired:
+        abort_upload(upload)
+    if expired:
+        logging.info(f"Expired {len(expired)} unfinished uploads")
+    return len(expired)